@@ -0,0 +1,209 @@
+"""
+上游准入控制：限制每个上游的在途请求数，超出时按用户轮转排队
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Hashable, Optional
+from llm_errors import UpstreamOverloaded
+
+# 保留最近的排队耗时样本用于计算分位数
+_WAIT_SAMPLES = 1000
+
+# 估算的请求占用时长（秒）的平滑系数
+_HOLD_EWMA_ALPHA = 0.2
+
+# 后台任务（标题、摘要）没有用户，共用一个排队位置
+BACKGROUND_USER = "_background"
+
+
+class Permit:
+    """一次准入许可，release 可重复调用"""
+
+    __slots__ = ("_controller", "_acquired_at", "released")
+
+    def __init__(self, controller: "AdmissionController"):
+        self._controller = controller
+        self._acquired_at = time.monotonic()
+        self.released = False
+
+    @property
+    def key(self) -> str:
+        """许可所属的上游（scheme://host:port）"""
+        return self._controller.key
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self._controller._release(time.monotonic() - self._acquired_at)
+
+    def transfer(self) -> "Permit":
+        """
+        把名额转交给新的持有者（例如比发起者活得更久的合并流上游读取任务）
+
+        原对象视为已释放（之后 release 不再归还名额），释放返回的新对象时才归还。
+        """
+        permit = Permit(self._controller)
+        permit._acquired_at = self._acquired_at
+        permit.released = self.released
+        self.released = True
+        return permit
+
+
+class AdmissionController:
+    """
+    单个上游的准入控制
+
+    - 在途请求数不超过 max_in_flight，空闲时请求直接通过
+    - 超出时进入等待队列，每个用户一个子队列，释放名额时按用户轮转分配，
+      单个用户的大量并发请求不会把其他用户挤到队尾
+    - 排队总数达到 max_queue 时立即拒绝，等待超过 queue_timeout 时超时拒绝，
+      拒绝时根据平均占用时长估算 Retry-After
+    """
+
+    def __init__(self, key: str, max_in_flight: int, max_queue: int, queue_timeout: float):
+        self.key = key
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+        self._waiting = 0
+        self._hold_ewma: Optional[float] = None
+        self._wait_samples: Deque[float] = deque(maxlen=_WAIT_SAMPLES)
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+
+    @property
+    def waiting(self) -> int:
+        """排队中的请求数"""
+        return self._waiting
+
+    @property
+    def full(self) -> bool:
+        """在途请求已满（新请求需要排队）"""
+        return self.in_flight >= self.max_in_flight or self._waiting > 0
+
+    async def acquire(self, user_key: Optional[Hashable] = None) -> Permit:
+        """
+        获取准入许可
+
+        Args:
+            user_key: 排队公平性的分组（用户ID），为None时归入后台任务
+
+        Returns:
+            许可，请求结束后必须调用 release
+
+        Raises:
+            UpstreamOverloaded: 排队已满或等待超时
+        """
+        if self.in_flight < self.max_in_flight and not self._waiting:
+            self.in_flight += 1
+            self.admitted += 1
+            return Permit(self)
+
+        if self._waiting >= self.max_queue:
+            self.rejected += 1
+            raise UpstreamOverloaded("模型服务繁忙，请稍后重试", self.retry_after())
+
+        user_key = BACKGROUND_USER if user_key is None else user_key
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user_key, deque()).append(future)
+        self._waiting += 1
+        self.queued += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 超时或取消与分配名额同时发生：名额已转给本请求，交还给下一个等待者
+                self._release(None)
+            else:
+                future.cancel()
+                self._remove_waiter(user_key, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise UpstreamOverloaded("模型服务繁忙，排队超时，请稍后重试", self.retry_after())
+            raise
+        finally:
+            self._record_wait(time.monotonic() - started)
+
+        self.admitted += 1
+        return Permit(self)
+
+    def _remove_waiter(self, user_key: Hashable, future: asyncio.Future):
+        queue = self._waiters.get(user_key)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            return
+        self._waiting -= 1
+        if not queue:
+            del self._waiters[user_key]
+
+    def _release(self, held_seconds: Optional[float]):
+        if held_seconds is not None:
+            if self._hold_ewma is None:
+                self._hold_ewma = held_seconds
+            else:
+                self._hold_ewma += _HOLD_EWMA_ALPHA * (held_seconds - self._hold_ewma)
+
+        # 名额直接转给下一个用户的最早请求（轮转），否则归还
+        while self._waiters:
+            user_key, queue = next(iter(self._waiters.items()))
+            future = queue.popleft()
+            self._waiting -= 1
+            if queue:
+                self._waiters.move_to_end(user_key)
+            else:
+                del self._waiters[user_key]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def _record_wait(self, seconds: float):
+        self._wait_samples.append(seconds)
+        self.wait_seconds_total += seconds
+        if seconds > self.max_wait_seconds:
+            self.max_wait_seconds = seconds
+
+    def retry_after(self) -> int:
+        """按平均占用时长估算排到当前队尾所需的秒数（1-60）"""
+        hold = self._hold_ewma if self._hold_ewma is not None else 1.0
+        estimate = hold * (self._waiting + 1) / max(self.max_in_flight, 1)
+        return min(max(math.ceil(estimate), 1), 60)
+
+    def stats(self) -> Dict:
+        """准入和排队统计"""
+        samples = sorted(self._wait_samples)
+
+        def percentile(p: float) -> float:
+            if not samples:
+                return 0.0
+            return round(samples[min(int(len(samples) * p), len(samples) - 1)], 4)
+
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "waiting": self._waiting,
+            "waiting_users": len(self._waiters),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+            "wait_seconds_max": round(self.max_wait_seconds, 3),
+            "wait_seconds_p50": percentile(0.5),
+            "wait_seconds_p95": percentile(0.95)
+        }
@@ -0,0 +1,110 @@
+"""
+数据库访问对事件循环的阻塞基准测试
+
+模拟若干个并发的SSE流（每10ms发送一个片段），同时让其他请求不断加载对话历史、写入消息，
+对比旧的同步会话（直接在事件循环线程执行）与新的异步会话路径下，SSE片段的发送延迟。
+
+用法（在 backend 目录下运行）:
+    python benchmarks/bench_async_db.py --streams 50 --workers 8 --messages 2000 --seconds 5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# 使用临时数据库，必须在导入 database 之前设置
+_tmpdir = tempfile.mkdtemp(prefix="bench_db_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal, AsyncSessionLocal, init_db, dispose_engines, User, Conversation, Message  # noqa: E402
+from conversation_service import ConversationService  # noqa: E402
+
+TICK = 0.01
+
+
+def seed(messages: int) -> str:
+    """创建一个包含大量消息的对话，返回session_id"""
+    db = SessionLocal()
+    session_id = "bench-session"
+    user = User(username="bench", hashed_password="x")
+    db.add(user)
+    db.commit()
+    conversation = Conversation(session_id=session_id, user_id=user.id)
+    db.add(conversation)
+    db.commit()
+    db.add_all([
+        Message(conversation_id=conversation.id, role="user" if i % 2 == 0 else "assistant", content="测试消息内容 " * 40)
+        for i in range(messages)
+    ])
+    db.commit()
+    db.close()
+    return session_id
+
+
+async def fake_stream(stop: asyncio.Event, lateness: list):
+    """模拟SSE流：每TICK秒发送一次，记录实际唤醒相对预期的延迟"""
+    while not stop.is_set():
+        expected = time.perf_counter() + TICK
+        await asyncio.sleep(TICK)
+        lateness.append(time.perf_counter() - expected)
+
+
+async def sync_worker(session_id: str, stop: asyncio.Event, ops: list):
+    """旧路径：同步Session直接在事件循环线程上查询和写入"""
+    while not stop.is_set():
+        db = SessionLocal()
+        conversation = db.query(Conversation).filter(Conversation.session_id == session_id).first()
+        db.query(Message).filter(Message.conversation_id == conversation.id).order_by(Message.created_at).all()
+        db.add(Message(conversation_id=conversation.id, role="user", content="新消息"))
+        db.commit()
+        db.close()
+        ops.append(1)
+        await asyncio.sleep(0)
+
+
+async def async_worker(session_id: str, stop: asyncio.Event, ops: list):
+    """新路径：异步会话"""
+    while not stop.is_set():
+        async with AsyncSessionLocal() as db:
+            await ConversationService.get_conversation_history(db, session_id)
+            await ConversationService.save_message(db, session_id, "user", "新消息")
+        ops.append(1)
+
+
+async def run(mode: str, session_id: str, streams: int, workers: int, seconds: float):
+    stop = asyncio.Event()
+    lateness, ops = [], []
+    worker = sync_worker if mode == "sync" else async_worker
+    tasks = [asyncio.create_task(fake_stream(stop, lateness)) for _ in range(streams)]
+    tasks += [asyncio.create_task(worker(session_id, stop, ops)) for _ in range(workers)]
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+
+    lateness_ms = sorted(x * 1000 for x in lateness)
+    p99 = lateness_ms[int(len(lateness_ms) * 0.99) - 1]
+    print(f"[{mode:5}] 流片段数={len(lateness_ms):6d}  延迟p50={statistics.median(lateness_ms):7.2f}ms  "
+          f"p99={p99:7.2f}ms  max={lateness_ms[-1]:7.2f}ms  数据库操作={len(ops)}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="同步/异步数据库路径对并发SSE流延迟的影响")
+    parser.add_argument("--streams", type=int, default=50, help="并发SSE流数量")
+    parser.add_argument("--workers", type=int, default=8, help="并发数据库请求数量")
+    parser.add_argument("--messages", type=int, default=2000, help="对话中的历史消息数")
+    parser.add_argument("--seconds", type=float, default=5.0, help="每种模式的运行时间")
+    args = parser.parse_args()
+
+    init_db()
+    session_id = seed(args.messages)
+    for mode in ("sync", "async"):
+        await run(mode, session_id, args.streams, args.workers, args.seconds)
+    await dispose_engines()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""
+非流式请求对冲测试
+
+在本机启动两个桩服务（benchmarks/stub_llm.py）作为同一模型的副本，每个副本都有一小部分请求
+首字节很慢（长尾），对比不对冲与按分位数对冲时的延迟分位数和额外请求量。
+
+用法（在 backend 目录下运行）:
+    python benchmarks/bench_hedging.py --requests 1000 --concurrency 10
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+os.environ["LLM_HEALTH_CHECK_INTERVAL"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from llm_service import LLMService  # noqa: E402
+from load_balancer import LoadBalancer  # noqa: E402
+from model_registry import ModelTarget  # noqa: E402
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_llm.py")
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+def url(port: int) -> str:
+    return f"http://127.0.0.1:{port}/v1/chat/completions"
+
+
+async def wait_ready(ports):
+    async with httpx.AsyncClient() as client:
+        for port in ports:
+            for _ in range(100):
+                try:
+                    await client.get(f"http://127.0.0.1:{port}/v1/models")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+
+
+async def upstream_requests(ports) -> int:
+    async with httpx.AsyncClient() as client:
+        return sum([(await client.get(f"http://127.0.0.1:{port}/stats")).json()["requests"] for port in ports])
+
+
+def percentile(ordered, value: float) -> float:
+    return ordered[min(int(len(ordered) * value / 100), len(ordered) - 1)]
+
+
+async def run(args, label: str, hedge_percentile: float, ports):
+    service = LLMService()
+    # 每轮使用新的副本组，延迟样本和对冲额度从零开始
+    service.balancer = LoadBalancer(interval=0)
+    urls = tuple(url(port) for port in ports)
+    target = ModelTarget(model_type="bench", api_url=urls[0], api_urls=urls, model="stub", api_key="k",
+                         hedge_percentile=hedge_percentile, hedge_budget=args.budget)
+    before = await upstream_requests(ports)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def one(index: int):
+        async with semaphore:
+            started = time.perf_counter()
+            await service.chat_completion(MESSAGES, target=target, user_id=index % 10)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    # 被取消的请求在桩服务中可能稍后才计数
+    await asyncio.sleep(0.2)
+    sent = await upstream_requests(ports) - before
+
+    ordered = sorted(latencies)
+    print(f"  {label:<10} p50 {percentile(ordered, 50) * 1000:>7.1f}ms  p95 {percentile(ordered, 95) * 1000:>7.1f}ms  "
+          f"p99 {percentile(ordered, 99) * 1000:>7.1f}ms  max {ordered[-1] * 1000:>7.1f}ms  "
+          f"上游请求 {sent}（额外 {(sent - args.requests) / args.requests:.1%}）  耗时 {elapsed:.2f}s")
+    hedge = service.balancer.group(target).hedge.stats()
+    if hedge_percentile:
+        print(f"    对冲 {hedge['hedged']} 次，其中对冲请求先返回 {hedge['hedge_wins']} 次，额度不足 {hedge['budget_exhausted']} 次")
+    await service.shutdown()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="非流式请求对冲测试")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--slow-rate", type=float, default=0.03, help="每个副本慢请求的比例")
+    parser.add_argument("--slow-ttfb", type=float, default=1.0, help="慢请求的首字节延迟（秒）")
+    parser.add_argument("--percentile", type=float, default=95)
+    parser.add_argument("--budget", type=float, default=0.05)
+    parser.add_argument("--base-port", type=int, default=19201)
+    args = parser.parse_args()
+
+    ports = (args.base_port, args.base_port + 1)
+    stubs = [
+        subprocess.Popen([sys.executable, STUB, "--port", str(port), "--ttfb", "0.03", "--tokens", "5",
+                          "--slow-rate", str(args.slow_rate), "--slow-ttfb", str(args.slow_ttfb)])
+        for port in ports
+    ]
+    try:
+        await wait_ready(ports)
+        print(f"两个副本：首字节 30ms，{args.slow_rate:.0%} 的请求 {args.slow_ttfb * 1000:.0f}ms；"
+              f"并发 {args.concurrency}，共 {args.requests} 个非流式请求")
+        await run(args, "不对冲", 0, ports)
+        await run(args, f"p{args.percentile:g}对冲", args.percentile, ports)
+    finally:
+        for stub in stubs:
+            stub.terminate()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+"""
+多副本负载均衡和故障切换测试
+
+在本机启动几个桩服务（benchmarks/stub_llm.py）作为同一模型的副本：
+1. 均衡：一慢一快一中等的三个副本，对比只用第一个地址（旧行为）与负载均衡下的请求分布和延迟；
+2. 故障切换：一个正常副本、一个总是返回500的副本、一个没有监听的地址，检查请求是否全部成功、
+   发生了多少次切换、坏副本是否被熔断。
+
+用法（在 backend 目录下运行）:
+    python benchmarks/bench_load_balancer.py --requests 200 --concurrency 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# 缩短熔断和健康检查间隔，必须在导入 config 之前设置
+os.environ.setdefault("LLM_BREAKER_OPEN_SECONDS", "5")
+os.environ.setdefault("LLM_HEALTH_CHECK_INTERVAL", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from llm_service import LLMService  # noqa: E402
+from model_registry import ModelTarget  # noqa: E402
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_llm.py")
+
+
+def url(port: int) -> str:
+    return f"http://127.0.0.1:{port}/v1/chat/completions"
+
+
+def start_stub(port: int, *args: str) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, STUB, "--port", str(port), *args])
+
+
+async def wait_ready(ports):
+    async with httpx.AsyncClient() as client:
+        for port in ports:
+            for _ in range(100):
+                try:
+                    await client.get(f"http://127.0.0.1:{port}/v1/models")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+
+
+async def run_load(service: LLMService, target: ModelTarget, requests: int, concurrency: int, stream: bool):
+    """并发发送请求，返回 (延迟列表, 失败数)"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+    messages = [{"role": "user", "content": "你好"}]
+
+    async def one(index: int):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                if stream:
+                    async for _ in service.chat_completion_stream(messages, target=target, user_id=index % 10):
+                        pass
+                else:
+                    await service.chat_completion(messages, target=target, user_id=index % 10)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors += 1
+                if errors <= 3:
+                    print(f"    请求失败: {e}")
+
+    await asyncio.gather(*(one(index) for index in range(requests)))
+    return latencies, errors
+
+
+def report(label: str, latencies, errors: int, elapsed: float):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] if latencies else 0
+    p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] if latencies else 0
+    print(f"  {label:<12} 成功 {len(latencies):>4}  失败 {errors:>3}  "
+          f"p50 {p50 * 1000:>7.1f}ms  p95 {p95 * 1000:>7.1f}ms  "
+          f"平均 {statistics.mean(latencies) * 1000 if latencies else 0:>7.1f}ms  耗时 {elapsed:.2f}s")
+
+
+async def scenario_balance(args):
+    print("场景1：三个副本（首字节 300ms / 20ms / 60ms），非流式")
+    ports = (args.base_port, args.base_port + 1, args.base_port + 2)
+    stubs = [start_stub(ports[0], "--ttfb", "0.3"), start_stub(ports[1], "--ttfb", "0.02"),
+             start_stub(ports[2], "--ttfb", "0.06")]
+    try:
+        await wait_ready(ports)
+        for label, urls in (("只用第一个", (url(ports[0]),)), ("负载均衡", tuple(url(port) for port in ports))):
+            service = LLMService()
+            target = ModelTarget(model_type="bench", api_url=urls[0], api_urls=urls, model="stub", api_key="k",
+                                 max_in_flight=args.concurrency)
+            started = time.perf_counter()
+            latencies, errors = await run_load(service, target, args.requests, args.concurrency, stream=False)
+            report(label, latencies, errors, time.perf_counter() - started)
+            if len(urls) > 1:
+                print(f"    分布: {service.balancer.group(target).selections}")
+            await service.shutdown()
+    finally:
+        for stub in stubs:
+            stub.terminate()
+
+
+async def scenario_failover(args):
+    print("场景2：正常副本 + 总是返回500的副本 + 无监听的地址，流式")
+    ports = (args.base_port + 10, args.base_port + 11, args.base_port + 12)
+    stubs = [start_stub(ports[0]), start_stub(ports[1], "--status", "500")]
+    try:
+        await wait_ready(ports[:2])
+        service = LLMService()
+        urls = tuple(url(port) for port in ports)
+        target = ModelTarget(model_type="bench", api_url=urls[0], api_urls=urls, model="stub", api_key="k",
+                             max_in_flight=args.concurrency)
+        group = service.balancer.group(target)
+        started = time.perf_counter()
+        latencies, errors = await run_load(service, target, args.requests, args.concurrency, stream=True)
+        report("故障切换", latencies, errors, time.perf_counter() - started)
+        print(f"    分布: {group.selections}，切换 {group.failovers} 次")
+        for endpoint in group.endpoints:
+            stats = endpoint.upstream.stats()
+            print(f"    {endpoint.url}: 熔断 {stats['breaker']['opens']} 次，当前状态 {stats['breaker']['state']}")
+        await service.shutdown()
+    finally:
+        for stub in stubs:
+            stub.terminate()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="多副本负载均衡和故障切换测试")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--base-port", type=int, default=19001)
+    args = parser.parse_args()
+
+    await scenario_balance(args)
+    await scenario_failover(args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
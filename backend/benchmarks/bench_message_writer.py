@@ -0,0 +1,127 @@
+"""
+消息写入吞吐测试
+
+模拟 --clients 个并发请求在 --conversations 个对话中不断完成对话轮次（每轮一条用户消息和一条回复），持续 --seconds 秒：
+1. 逐条提交（旧路径）：每条消息按 session_id 查询对话、插入消息、更新对话计数并单独提交；
+2. 合并提交（message_writer）：每轮一次写入，后台把并发请求的写入合并在一个事务中提交。
+对比每秒写入的轮数、消息数、事务提交数和单轮写入延迟。
+
+用法（在 backend 目录下运行）:
+    python benchmarks/bench_message_writer.py --clients 50 --seconds 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# 使用临时数据库，必须在导入 database 之前设置
+_tmpdir = tempfile.mkdtemp(prefix="bench_writer_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import select, update  # noqa: E402
+from database import (  # noqa: E402
+    SessionLocal, AsyncSessionLocal, init_db, dispose_engines, get_beijing_time, User, Conversation, Message
+)
+from context_builder import estimate_tokens  # noqa: E402
+from message_writer import MessageWriter, message_record  # noqa: E402
+
+REPLY = "这是一段模拟的助手回复内容。" * 30
+
+
+def seed(conversations: int):
+    db = SessionLocal()
+    user = User(username="bench", hashed_password="x")
+    db.add(user)
+    db.commit()
+    db.add_all([Conversation(session_id=f"bench-{index}", user_id=user.id) for index in range(conversations)])
+    db.commit()
+    db.close()
+
+
+async def legacy_save_message(session_id: str, role: str, content: str):
+    """旧的 save_message：每条消息查询对话并单独提交"""
+    async with AsyncSessionLocal() as db:
+        conversation = (await db.execute(select(Conversation).where(Conversation.session_id == session_id))).scalars().first()
+        now = get_beijing_time()
+        db.add(Message(conversation_id=conversation.id, role=role, content=content,
+                       token_count=estimate_tokens(content), created_at=now))
+        await db.execute(
+            update(Conversation)
+            .where(Conversation.id == conversation.id)
+            .values(message_count=Conversation.message_count + 1, last_message_at=now)
+        )
+        await db.commit()
+
+
+async def run(mode: str, args, conversation_ids):
+    writer = MessageWriter(max_queue=args.clients * 4, batch_size=args.batch_size)
+    if mode == "batched":
+        writer.start()
+    stop = time.perf_counter() + args.seconds
+    latencies = []
+    errors = []
+
+    async def client(index: int):
+        while time.perf_counter() < stop:
+            conversation = index % args.conversations
+            session_id = f"bench-{conversation}"
+            started = time.perf_counter()
+            try:
+                if mode == "legacy":
+                    await legacy_save_message(session_id, "user", "用户的问题")
+                    await legacy_save_message(session_id, "assistant", REPLY)
+                else:
+                    await writer.write(conversation_ids[conversation], session_id,
+                                       [message_record("user", "用户的问题"), message_record("assistant", REPLY)])
+            except Exception as e:
+                # SQLite 读事务升级为写事务时与其他提交冲突会立即报 database is locked
+                errors.append(type(e).__name__)
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(index) for index in range(args.clients)))
+    await writer.shutdown()
+    elapsed = time.perf_counter() - started
+
+    turns = len(latencies)
+    commits = turns * 2 if mode == "legacy" else writer.commits
+    latencies.sort()
+    label = "逐条提交" if mode == "legacy" else "合并提交"
+    print(f"[{label}] 轮次 {turns / elapsed:7.0f}/s  消息 {turns * 2 / elapsed:7.0f}/s  事务提交 {commits / elapsed:7.0f}/s  "
+          f"单轮延迟 p50 {latencies[turns // 2] * 1000:6.1f}ms  p99 {latencies[int(turns * 0.99)] * 1000:6.1f}ms  "
+          f"失败 {len(errors)} 轮")
+    if mode == "batched":
+        stats = writer.stats()
+        print(f"           平均每次提交 {stats['avg_batch']} 轮，最多 {stats['max_batch']} 轮")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="消息写入吞吐测试")
+    parser.add_argument("--clients", type=int, default=50, help="并发请求数")
+    parser.add_argument("--conversations", type=int, default=200, help="对话数")
+    parser.add_argument("--batch-size", type=int, default=100, help="每次提交最多合并的轮数")
+    parser.add_argument("--seconds", type=float, default=5.0, help="每种模式的运行时间")
+    args = parser.parse_args()
+
+    init_db()
+    seed(args.conversations)
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(select(Conversation.id).order_by(Conversation.id))).all()
+    conversation_ids = [row[0] for row in rows]
+
+    for mode in ("legacy", "batched"):
+        await run(mode, args, conversation_ids)
+    async with AsyncSessionLocal() as db:
+        total = sum(row[0] for row in (await db.execute(select(Conversation.message_count))).all())
+        stored = len((await db.execute(select(Message.id))).all())
+    # 逐条提交失败的轮次可能只写入了用户消息，计数仍与消息表一致
+    print(f"对话计数合计 {total}，消息表 {stored} 条（应一致）")
+    await dispose_engines()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
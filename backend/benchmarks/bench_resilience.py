@@ -0,0 +1,144 @@
+"""
+上游重试和熔断测试
+
+在本机启动桩服务（benchmarks/stub_llm.py），检查：
+1. 重试：副本随机返回503（30%），对比不重试与有限次数重试（带抖动退避）下的成功率；
+2. 熔断：副本始终返回500，对比没有熔断与开启熔断时打到上游的请求数和失败耗时；
+3. Retry-After：上游返回429并给出较短/较长的 Retry-After，较短时等待后重试，较长时直接把等待时间交给客户端。
+
+用法（在 backend 目录下运行）:
+    python benchmarks/bench_resilience.py --requests 100
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+# 关闭主动健康检查，只观察被动熔断；必须在导入 config 之前设置
+os.environ["LLM_HEALTH_CHECK_INTERVAL"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from llm_service import LLMService  # noqa: E402
+from llm_errors import LLMError  # noqa: E402
+from model_registry import ModelTarget  # noqa: E402
+from resilience import RetryPolicy  # noqa: E402
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_llm.py")
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+def start_stub(port: int, *args: str) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, STUB, "--port", str(port), "--tokens", "5", *args])
+
+
+async def wait_ready(port: int):
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(f"http://127.0.0.1:{port}/v1/models")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+
+
+async def upstream_requests(port: int) -> int:
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"http://127.0.0.1:{port}/stats")).json()["requests"]
+
+
+def target_for(port: int) -> ModelTarget:
+    url = f"http://127.0.0.1:{port}/v1/chat/completions"
+    return ModelTarget(model_type="bench", api_url=url, model="stub", api_key="k")
+
+
+async def run_sequential(service: LLMService, target: ModelTarget, requests: int):
+    """依次发送请求，返回 (成功数, 失败数, 平均失败耗时秒, 错误类型计数)"""
+    succeeded, failed_seconds, kinds = 0, [], {}
+    for _ in range(requests):
+        started = time.perf_counter()
+        try:
+            await service.chat_completion(MESSAGES, target=target)
+            succeeded += 1
+        except LLMError as e:
+            failed_seconds.append(time.perf_counter() - started)
+            kinds[type(e).__name__] = kinds.get(type(e).__name__, 0) + 1
+    average = sum(failed_seconds) / len(failed_seconds) if failed_seconds else 0.0
+    return succeeded, len(failed_seconds), average, kinds
+
+
+async def scenario_retry(args):
+    print("场景1：30% 请求返回503")
+    port = args.base_port
+    stub = start_stub(port, "--fail-rate", "0.3")
+    try:
+        await wait_ready(port)
+        for label, retries in (("不重试", 0), (f"重试{args.retries}次", args.retries)):
+            service = LLMService()
+            service.retry_policy = RetryPolicy(max_retries=retries, base_delay=0.05)
+            # 这里只看重试，熔断阈值放大
+            service.balancer.group(target_for(port)).endpoints[0].upstream.breaker.failure_threshold = 10 ** 9
+            ok, failed, _, kinds = await run_sequential(service, target_for(port), args.requests)
+            print(f"  {label:<8} 成功率 {ok / args.requests:>6.1%}  失败 {failed:>3}  {kinds or ''}  "
+                  f"重试统计 {service.retry_policy.stats()}")
+            await service.shutdown()
+    finally:
+        stub.terminate()
+
+
+async def scenario_breaker(args):
+    print("场景2：副本始终返回500（首字节 200ms）")
+    for index, (label, threshold) in enumerate((("无熔断", 10 ** 9), ("熔断", 3))):
+        port = args.base_port + 1 + index
+        stub = start_stub(port, "--status", "500", "--ttfb", "0.2")
+        try:
+            await wait_ready(port)
+            service = LLMService()
+            service.retry_policy = RetryPolicy(max_retries=0)
+            service.balancer.group(target_for(port)).endpoints[0].upstream.breaker.failure_threshold = threshold
+            started = time.perf_counter()
+            ok, failed, average, kinds = await run_sequential(service, target_for(port), args.requests)
+            elapsed = time.perf_counter() - started
+            print(f"  {label:<8} 打到上游 {await upstream_requests(port):>4} 次  平均失败耗时 {average * 1000:>7.1f}ms  "
+                  f"总耗时 {elapsed:.2f}s  {kinds}")
+            await service.shutdown()
+        finally:
+            stub.terminate()
+
+
+async def scenario_retry_after(args):
+    print("场景3：上游返回429和 Retry-After")
+    for index, retry_after in enumerate((1, 30)):
+        port = args.base_port + 3 + index
+        stub = start_stub(port, "--status", "429", "--retry-after", str(retry_after))
+        try:
+            await wait_ready(port)
+            service = LLMService()
+            service.retry_policy = RetryPolicy(max_retries=1, max_delay=5)
+            started = time.perf_counter()
+            try:
+                await service.chat_completion(MESSAGES, target=target_for(port))
+            except LLMError as e:
+                print(f"  Retry-After={retry_after:<3} 耗时 {time.perf_counter() - started:.2f}s  "
+                      f"打到上游 {await upstream_requests(port)} 次  返回 {e.status_code}，Retry-After {e.retry_after}")
+            await service.shutdown()
+        finally:
+            stub.terminate()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="上游重试和熔断测试")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--base-port", type=int, default=19101)
+    args = parser.parse_args()
+
+    await scenario_retry(args)
+    await scenario_breaker(args)
+    await scenario_retry_after(args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
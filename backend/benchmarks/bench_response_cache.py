@@ -0,0 +1,121 @@
+"""
+大模型回复缓存测试
+
+在本机启动一个桩服务（benchmarks/stub_llm.py），按长尾分布从一组提示中抽取 temperature=0 的请求：
+1. 不缓存 / 内存缓存：对比延迟和打到上游的请求数，输出命中率；
+2. 磁盘层：用同一个SQLite文件新建缓存（模拟重启），检查重启后的命中；
+3. 查询开销：计算缓存键并命中内存层的耗时。
+
+用法（在 backend 目录下运行）:
+    python benchmarks/bench_response_cache.py --requests 2000 --prompts 200
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ["LLM_HEALTH_CHECK_INTERVAL"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from llm_service import LLMService  # noqa: E402
+from model_registry import ModelTarget  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_llm.py")
+
+
+async def wait_ready(port: int):
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(f"http://127.0.0.1:{port}/v1/models")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+
+
+async def upstream_requests(port: int) -> int:
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"http://127.0.0.1:{port}/stats")).json()["requests"]
+
+
+def workload(requests: int, prompts: int, seed: int = 7):
+    """按Zipf分布抽取提示，少数常见问题占大部分请求"""
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(prompts)]
+    return [f"常见问题 {index}: 如何用Python读取文件？" for index in rng.choices(range(prompts), weights, k=requests)]
+
+
+async def run(label: str, service: LLMService, target: ModelTarget, prompts, port: int, concurrency: int):
+    before = await upstream_requests(port)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(prompt: str):
+        async with semaphore:
+            started = time.perf_counter()
+            await service.chat_completion([{"role": "user", "content": prompt}], temperature=0, target=target)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(prompt) for prompt in prompts))
+    elapsed = time.perf_counter() - started
+    ordered = sorted(latencies)
+    stats = service.response_cache.stats()
+    print(f"  {label:<10} p50 {ordered[len(ordered) // 2] * 1000:>7.2f}ms  平均 {sum(ordered) / len(ordered) * 1000:>7.2f}ms  "
+          f"上游请求 {await upstream_requests(port) - before:>5}  命中率 {stats['hit_ratio']:.1%}"
+          f"（磁盘 {stats['disk_hits']}）  耗时 {elapsed:.2f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="大模型回复缓存测试")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--prompts", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--port", type=int, default=19301)
+    args = parser.parse_args()
+
+    stub = subprocess.Popen([sys.executable, STUB, "--port", str(args.port), "--ttfb", "0.1", "--tokens", "20"])
+    url = f"http://127.0.0.1:{args.port}/v1/chat/completions"
+    target = ModelTarget(model_type="bench", api_url=url, model="stub", api_key="k")
+    prompts = workload(args.requests, args.prompts)
+    db_path = os.path.join(tempfile.mkdtemp(), "response_cache.db")
+    try:
+        await wait_ready(args.port)
+        print(f"{args.requests} 个 temperature=0 的请求，{args.prompts} 种提示（Zipf分布），上游首字节 100ms")
+
+        service = LLMService()
+        service.response_cache = ResponseCache(enabled=False)
+        await run("不缓存", service, target, prompts, args.port, args.concurrency)
+
+        service.response_cache = ResponseCache(enabled=True, db_path=db_path)
+        await service.response_cache.startup()
+        await run("内存+磁盘", service, target, prompts, args.port, args.concurrency)
+        await service.response_cache.shutdown()
+
+        # 新建缓存实例，内存为空，只能从磁盘层命中
+        service.response_cache = ResponseCache(enabled=True, db_path=db_path)
+        await service.response_cache.startup()
+        await run("重启后", service, target, prompts, args.port, args.concurrency)
+
+        cache = service.response_cache
+        messages = [{"role": "system", "content": "你是一个助手。" * 50}, {"role": "user", "content": prompts[0]}]
+        await cache.put(cache.make_key(target, messages, 0, 2000), "缓存的回复")
+        rounds = 20000
+        started = time.perf_counter()
+        for _ in range(rounds):
+            await cache.get(cache.make_key(target, messages, 0, 2000))
+        print(f"  查询开销（计算键 + 命中内存层）: {(time.perf_counter() - started) / rounds * 1e6:.1f}µs/次")
+        await cache.shutdown()
+        await service.shutdown()
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
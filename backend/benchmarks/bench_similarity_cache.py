@@ -0,0 +1,98 @@
+"""
+近似重复提示缓存测试（纯本地计算，不需要桩服务）
+
+1. 匹配效果：一组编程类问题及其变体（空白、标点、大小写、全角、语气词），统计变体的命中率和不同问题之间的误命中；
+2. 查询开销：向索引中登记 --entries 个条目（默认100万，随机指纹模拟不同的问题），
+   测量查询耗时（含计算指纹）、平均候选数和内存占用。
+
+用法（在 backend 目录下运行）:
+    python benchmarks/bench_similarity_cache.py --entries 1000000
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from similarity_cache import SimilarityCache  # noqa: E402
+
+LANGUAGES = ["Python", "Java", "Go", "JavaScript", "C++", "Rust", "TypeScript", "Kotlin"]
+TASKS = [
+    "读取一个CSV文件并按第二列排序", "把列表去重并保持原来的顺序", "实现一个线程安全的单例模式",
+    "解析JSON字符串并处理异常", "写一个二分查找并说明边界条件", "计算两个日期之间相差的天数",
+    "实现LRU缓存并说明时间复杂度", "发送带超时的HTTP请求", "递归遍历目录下的所有文件",
+    "用正则表达式校验邮箱地址", "合并两个有序链表", "统计一段文本中每个单词出现的次数",
+]
+
+
+def variants(text: str):
+    """常见的无关差异：空白、标点、大小写、全角、语气词"""
+    return [
+        text.replace("一个", " 一个 "),
+        text + "？",
+        text.lower(),
+        text.replace("并", "，并"),
+        text.replace("Python", "ｐｙｔｈｏｎ").replace("Java", "ＪＡＶＡ"),
+        text + "。谢谢",
+    ]
+
+
+def quality(threshold: float):
+    cache = SimilarityCache(enabled=True, max_entries=100000, threshold=threshold)
+    questions = [f"用{language}{task}" for language in LANGUAGES for task in TASKS]
+    for question in questions:
+        cache.put(0, question, question)
+
+    hits = total = wrong = 0
+    for question in questions:
+        for variant in variants(question):
+            total += 1
+            reply = cache.get(0, variant)
+            if reply is not None:
+                hits += 1
+                wrong += reply != question
+    print(f"  阈值 {threshold:.2f}: {len(questions)} 个问题的 {total} 个变体命中 {hits}（{hits / total:.1%}），"
+          f"命中到其他问题 {wrong} 次")
+
+
+def lookup_cost(entries: int, rounds: int):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cache = SimilarityCache(enabled=True, max_entries=entries, threshold=0.95)
+    rng = random.Random(1)
+    contexts = [rng.getrandbits(44) for _ in range(16)]
+    started = time.perf_counter()
+    for index in range(entries):
+        cache.put_fingerprint(contexts[index % len(contexts)], rng.getrandbits(64), "回复")
+    build = time.perf_counter() - started
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"  登记 {entries} 个条目耗时 {build:.1f}s，内存约增加 {(rss_after - rss_before) / 1024:.0f}MB")
+
+    question = "用Python读取一个CSV文件并按第二列排序"
+    cache.put(contexts[0], question, "回复")
+    for label, text in (("未命中", "用Rust实现一个带过期时间的LRU缓存并说明复杂度"), ("命中", question + "？")):
+        candidates_before = cache.candidates
+        started = time.perf_counter()
+        for _ in range(rounds):
+            cache.get(contexts[0], text)
+        elapsed = time.perf_counter() - started
+        print(f"  查询（{label}）: {elapsed / rounds * 1e6:.1f}µs/次，平均候选 {(cache.candidates - candidates_before) / rounds:.1f} 个")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="近似重复提示缓存测试")
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args()
+
+    print("匹配效果：")
+    for threshold in (0.95, 0.9, 0.85):
+        quality(threshold)
+    print(f"查询开销（{args.entries} 个条目）：")
+    lookup_cost(args.entries, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+相同请求合并测试
+
+在本机启动一个桩服务（benchmarks/stub_llm.py），模拟很多用户在短时间内发送同一个开场问题（temperature=0）：
+1. 非流式：同时到达的相同请求，对比不合并与合并时打到上游的请求数和延迟；
+2. 流式：请求在上游生成期间陆续到达，后到的请求先回放已收到的片段再跟随，检查每个请求收到的回复是否完整一致；
+3. 按用户隔离：带有历史消息的请求（scope为用户ID）不会跨用户合并。
+
+用法（在 backend 目录下运行）:
+    python benchmarks/bench_singleflight.py --clients 50
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+os.environ["LLM_HEALTH_CHECK_INTERVAL"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from llm_service import LLMService  # noqa: E402
+from model_registry import ModelTarget  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+from singleflight import SingleFlight  # noqa: E402
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_llm.py")
+MESSAGES = [{"role": "user", "content": "介绍一下Python"}]
+
+
+async def wait_ready(port: int):
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(f"http://127.0.0.1:{port}/v1/models")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+
+
+async def upstream_requests(port: int) -> int:
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"http://127.0.0.1:{port}/stats")).json()["requests"]
+
+
+def make_service(enabled: bool) -> LLMService:
+    service = LLMService()
+    # 只看合并的效果，关闭回复缓存
+    service.response_cache = ResponseCache(enabled=False)
+    service.singleflight = SingleFlight(enabled=enabled)
+    return service
+
+
+async def scenario_plain(args, target: ModelTarget):
+    print(f"场景1：{args.clients} 个相同的非流式请求同时到达")
+    for label, enabled in (("不合并", False), ("合并", True)):
+        service = make_service(enabled)
+        before = await upstream_requests(args.port)
+        started = time.perf_counter()
+        replies = await asyncio.gather(*(
+            service.chat_completion(MESSAGES, temperature=0, target=target, user_id=index)
+            for index in range(args.clients)
+        ))
+        elapsed = time.perf_counter() - started
+        print(f"  {label:<6} 上游请求 {await upstream_requests(args.port) - before:>4}  "
+              f"回复一致 {len(set(replies)) == 1}  耗时 {elapsed:.2f}s  {service.singleflight.stats()}")
+        await service.shutdown()
+
+
+async def scenario_stream(args, target: ModelTarget):
+    print(f"场景2：{args.clients} 个相同的流式请求在 {args.spread:.1f}s 内陆续到达")
+    for label, enabled in (("不合并", False), ("合并", True)):
+        service = make_service(enabled)
+        before = await upstream_requests(args.port)
+        first_chunk = []
+
+        async def one(index: int) -> str:
+            await asyncio.sleep(args.spread * index / args.clients)
+            started = time.perf_counter()
+            parts = []
+            async for piece in service.chat_completion_stream(MESSAGES, temperature=0, target=target, user_id=index):
+                if not parts:
+                    first_chunk.append(time.perf_counter() - started)
+                parts.append(piece)
+            return "".join(parts)
+
+        started = time.perf_counter()
+        replies = await asyncio.gather(*(one(index) for index in range(args.clients)))
+        elapsed = time.perf_counter() - started
+        first_chunk.sort()
+        print(f"  {label:<6} 上游请求 {await upstream_requests(args.port) - before:>4}  "
+              f"回复完整一致 {len(set(replies)) == 1 and len(replies[0]) > 0}  "
+              f"首个片段 p50 {first_chunk[len(first_chunk) // 2] * 1000:.1f}ms  耗时 {elapsed:.2f}s")
+        stats = service.singleflight.stats()
+        if enabled:
+            print(f"    加入已有的流 {stats['stream_joined']} 次，回放 {stats['replayed_chunks']} 个片段")
+        await service.shutdown()
+
+
+async def scenario_scoped(args, target: ModelTarget):
+    print("场景3：带历史消息的相同请求（scope为用户ID），10个用户各2个并发请求")
+    service = make_service(True)
+    before = await upstream_requests(args.port)
+    history = [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好！"}] + MESSAGES
+    await asyncio.gather(*(
+        service.chat_completion(history, temperature=0, target=target, user_id=user, scope=user)
+        for user in range(10) for _ in range(2)
+    ))
+    print(f"  上游请求 {await upstream_requests(args.port) - before}（期望10：同一用户内合并，不跨用户）")
+    await service.shutdown()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="相同请求合并测试")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--spread", type=float, default=0.5, help="流式请求陆续到达的时间跨度（秒）")
+    parser.add_argument("--port", type=int, default=19401)
+    args = parser.parse_args()
+
+    stub = subprocess.Popen([sys.executable, STUB, "--port", str(args.port), "--ttfb", "0.2",
+                             "--token-delay", "0.01", "--tokens", "100"])
+    target = ModelTarget(model_type="bench", api_url=f"http://127.0.0.1:{args.port}/v1/chat/completions",
+                         model="stub", api_key="k", max_in_flight=args.clients)
+    try:
+        await wait_ready(args.port)
+        await scenario_plain(args, target)
+        await scenario_stream(args, target)
+        await scenario_scoped(args, target)
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
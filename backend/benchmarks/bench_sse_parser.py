@@ -0,0 +1,134 @@
+"""
+上游SSE流解析的微基准测试
+
+把一段录制的（或生成的）上游流式响应按不同大小切成TCP分块后反复回放，
+对比旧的字符串拼接+split解析与新的字节级增量解析器的吞吐，并检查解析出的文本是否完整。
+
+录制真实上游的响应（可选）:
+    curl -sN http://上游地址/v1/chat/completions -H "Authorization: Bearer KEY" \\
+         -H "Content-Type: application/json" \\
+         -d '{"model": "...", "stream": true, "messages": [{"role": "user", "content": "写一篇500字的短文"}]}' > stream.bin
+
+用法（在 backend 目录下运行）:
+    python benchmarks/bench_sse_parser.py --rounds 200
+    python benchmarks/bench_sse_parser.py --record stream.bin
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jsonutil  # noqa: E402
+from sse_parser import SSEDecoder  # noqa: E402
+from llm_service import LLMService  # noqa: E402
+
+
+def synthesize_stream(chars: int) -> bytes:
+    """生成一段OpenAI兼容格式的流式响应，每个事件一个汉字或几个英文字符"""
+    text = ("快速排序是一种分治算法，平均时间复杂度为 O(n log n)。" * (chars // 30 + 1))[:chars]
+    events = []
+    for index, ch in enumerate(text):
+        payload = {
+            "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1700000000, "model": "bench",
+            "choices": [{"index": 0, "delta": {"content": ch}, "finish_reason": None}]
+        }
+        events.append(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n")
+    events.append("data: [DONE]\n\n")
+    return "".join(events).encode("utf-8")
+
+
+def split_chunks(raw: bytes, min_size: int, max_size: int, seed: int = 42):
+    """按随机大小切分，模拟TCP分包（会切断多字节字符）"""
+    rng = random.Random(seed)
+    chunks, pos = [], 0
+    while pos < len(raw):
+        size = rng.randint(min_size, max_size)
+        chunks.append(raw[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def legacy_parse(chunks) -> str:
+    """旧实现：逐块 decode(errors='ignore') 后拼接字符串并 split"""
+    parts = []
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk.decode("utf-8", errors="ignore")
+        while "\n" in buffer:
+            line, buffer = buffer.split("\n", 1)
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("data: "):
+                data = line[6:].strip()
+                if data == "[DONE]":
+                    return "".join(parts)
+                try:
+                    chunk_data = json.loads(data)
+                    if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
+                        content = chunk_data["choices"][0].get("delta", {}).get("content", "")
+                        if content:
+                            parts.append(content)
+                except json.JSONDecodeError:
+                    continue
+    return "".join(parts)
+
+
+def decoder_parse(chunks) -> str:
+    """新实现：SSEDecoder + jsonutil（安装了 orjson 时使用 orjson）"""
+    parts = []
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        for event in decoder.feed(chunk):
+            for chunk_data in LLMService._parse_stream_event(event.raw):
+                if chunk_data is None:
+                    return "".join(parts)
+                content = LLMService._delta_content(chunk_data)
+                if content:
+                    parts.append(content)
+    return "".join(parts)
+
+
+def run(name: str, parse, chunks, rounds: int, expected: str):
+    text = parse(chunks)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        parse(chunks)
+    elapsed = time.perf_counter() - started
+    total_bytes = sum(len(chunk) for chunk in chunks) * rounds
+    lost = len(expected) - len(text) if text != expected else 0
+    print(f"  {name:<10} {len(chunks) * rounds / elapsed:>12,.0f} chunks/s  "
+          f"{total_bytes / elapsed / 1024 / 1024:>8.1f} MB/s  "
+          f"{'文本完整' if text == expected else f'文本不一致（少 {lost} 个字符）'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="上游SSE流解析吞吐对比")
+    parser.add_argument("--record", help="录制的上游原始响应文件，不指定时自动生成")
+    parser.add_argument("--chars", type=int, default=2000, help="自动生成时的回复长度（字符）")
+    parser.add_argument("--rounds", type=int, default=100, help="每种分块方式回放的次数")
+    args = parser.parse_args()
+
+    if args.record:
+        with open(args.record, "rb") as f:
+            raw = f.read()
+    else:
+        raw = synthesize_stream(args.chars)
+    expected = decoder_parse([raw])
+
+    print(f"流大小 {len(raw) / 1024:.1f} KB，JSON后端: {jsonutil.JSON_BACKEND}")
+    # 小分块：每个TCP包不到一个事件；大分块：上游积压时一个包里有上百个事件
+    for label, min_size, max_size in (("小分块 1-64B", 1, 64), ("中分块 256-1KB", 256, 1024),
+                                      ("大分块 16-64KB", 16384, 65536)):
+        chunks = split_chunks(raw, min_size, max_size)
+        print(f"{label}（{len(chunks)} 块）:")
+        run("旧实现", legacy_parse, chunks, args.rounds, expected)
+        run("新实现", decoder_parse, chunks, args.rounds, expected)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+SSE帧合并与压缩测试（纯本地计算，不需要桩服务）
+
+模拟一次 --tokens 个片段的回复（中英文混合，每个片段一个token），按 --rate 个/秒写入事件缓冲，
+三个订阅者同时读取同一次生成：
+1. 逐个发送（旧路径）：每个片段一帧，每帧 json.dumps 一次、写出一次；
+2. 合并发送：第一帧立即发送，之后 --interval-ms 毫秒内的片段合并成一帧（orjson 编码）；
+3. 合并 + gzip：同上，整个流gzip压缩，每次写出后同步刷新。
+对比帧数、写出次数（约等于TCP报文数）、线上字节数、编码耗时和首帧延迟；最后测试片段已全部生成时（缓存命中、续传补发）的输出。
+
+用法（在 backend 目录下运行）:
+    python benchmarks/bench_sse_writer.py --tokens 2000 --rate 100
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stream_buffer import StreamBuffer  # noqa: E402
+from sse_writer import SSEEncoder  # noqa: E402
+from jsonutil import JSON_BACKEND  # noqa: E402
+
+WORDS = ["排序", "算法", "的", "时间", "复杂度", "是", "，", "。", " the", " list", " is", " sorted", " in", " place",
+         "\n", "```", "python", " def", " quick", "_sort", "(", "arr", "):", " return", " 我们", "可以", "使用"]
+
+
+def reply_tokens(count: int):
+    rng = random.Random(1)
+    return [rng.choice(WORDS) for _ in range(count)]
+
+
+async def produce(tokens, rate: float):
+    for token in tokens:
+        if rate:
+            await asyncio.sleep(1 / rate)
+        yield {"chunk": token}
+    yield {"done": True}
+
+
+async def legacy_subscriber(buffer: StreamBuffer, started: float):
+    """旧路径：每个事件一帧一次写出"""
+    result = {"frames": 0, "writes": 0, "bytes": 0, "encode": 0.0, "first": None}
+    async for batch in buffer.subscribe(0):
+        for event_id, event in batch:
+            encode_started = time.perf_counter()
+            data = f"id: {event_id}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8")
+            result["encode"] += time.perf_counter() - encode_started
+            result["frames"] += 1
+            result["writes"] += 1
+            result["bytes"] += len(data)
+            if result["first"] is None:
+                result["first"] = time.perf_counter() - started
+    return result
+
+
+async def coalesced_subscriber(buffer: StreamBuffer, started: float, interval: float, max_bytes: int, compress: bool):
+    encoder = SSEEncoder(compress=compress)
+    decoder = zlib.decompressobj(31) if compress else None
+    result = {"frames": 0, "writes": 0, "bytes": 0, "encode": 0.0, "first": None}
+    text = []
+    async for batch in buffer.subscribe(0, interval, max_bytes):
+        encode_started = time.perf_counter()
+        data = encoder.encode(batch)
+        result["encode"] += time.perf_counter() - encode_started
+        result["writes"] += 1
+        result["bytes"] += len(data)
+        plain = decoder.decompress(data) if decoder else data
+        frames = [frame for frame in plain.decode("utf-8").split("\n\n") if frame]
+        result["frames"] += len(frames)
+        for frame in frames:
+            event = json.loads(frame.split("data: ", 1)[1])
+            text.append(event.get("chunk", ""))
+        if result["first"] is None:
+            result["first"] = time.perf_counter() - started
+    tail = encoder.close()
+    result["bytes"] += len(tail)
+    if decoder:
+        decoder.decompress(tail)
+        assert decoder.eof
+    result["text"] = "".join(text)
+    return result
+
+
+def report(label: str, result, elapsed: float, live: bool):
+    # 已全部生成时三个订阅者在同一个事件循环中依次编码，首帧延迟没有意义
+    first = f"  首帧 {result['first'] * 1000:5.1f}ms" if live else ""
+    print(f"  [{label}] 帧 {result['frames']:5d}（{result['frames'] / elapsed:6.1f}/s）  写出 {result['writes']:5d} 次  "
+          f"线上 {result['bytes'] / 1024:7.1f}KB  编码 {result['encode'] * 1000:6.1f}ms{first}")
+
+
+async def run(tokens, rate: float, interval: float, max_bytes: int):
+    buffer = StreamBuffer("bench", 0, 64 * 1024 * 1024, 60, 60)
+    started = time.perf_counter()
+    buffer.start(produce(tokens, rate))
+    results = await asyncio.gather(
+        legacy_subscriber(buffer, started),
+        coalesced_subscriber(buffer, started, interval, max_bytes, False),
+        coalesced_subscriber(buffer, started, interval, max_bytes, True)
+    )
+    elapsed = time.perf_counter() - started
+    expected = "".join(tokens)
+    assert results[1]["text"] == expected and results[2]["text"] == expected
+    for label, result in zip(("逐个发送", "合并发送", "合并+gzip"), results):
+        report(label, result, elapsed, rate > 0)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="SSE帧合并与压缩测试")
+    parser.add_argument("--tokens", type=int, default=2000, help="回复的片段数")
+    parser.add_argument("--rate", type=float, default=100, help="每秒生成的片段数")
+    parser.add_argument("--interval-ms", type=int, default=50, help="合并等待时间（毫秒）")
+    parser.add_argument("--flush-bytes", type=int, default=4096, help="合并的字节上限")
+    args = parser.parse_args()
+
+    tokens = reply_tokens(args.tokens)
+    print(f"JSON编码: {JSON_BACKEND}，回复 {len(''.join(tokens))} 个字符")
+    print(f"实时生成（{args.tokens} 个片段，{args.rate:g} 个/秒，合并等待 {args.interval_ms}ms）：")
+    await run(tokens, args.rate, args.interval_ms / 1000, args.flush_bytes)
+    print("已全部生成（缓存命中、续传补发）：")
+    await run(tokens, 0, args.interval_ms / 1000, args.flush_bytes)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""
+OpenAI兼容接口的本地桩服务，用于在没有真实模型的情况下测试负载均衡、故障切换和限流
+
+用法（在 backend 目录下运行）:
+    python benchmarks/stub_llm.py --port 9001
+    python benchmarks/stub_llm.py --port 9002 --ttfb 0.3            # 首字节较慢的副本
+    python benchmarks/stub_llm.py --port 9003 --fail-rate 0.5        # 一半请求返回503
+    python benchmarks/stub_llm.py --port 9004 --status 500           # 所有请求返回500（健康检查仍正常）
+    python benchmarks/stub_llm.py --port 9005 --status 429 --retry-after 2   # 限流并给出 Retry-After
+    python benchmarks/stub_llm.py --port 9006 --slow-rate 0.05 --slow-ttfb 2  # 5%的请求首字节延迟2秒（长尾）
+
+然后把多个地址配置到同一个模型，例如:
+    LLM_API_URLS=http://127.0.0.1:9001/v1/chat/completions,http://127.0.0.1:9002/v1/chat/completions
+"""
+import argparse
+import asyncio
+import json
+import random
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.requests import ClientDisconnect
+
+
+def create_app(ttfb: float = 0.05, token_delay: float = 0.005, tokens: int = 50,
+               fail_rate: float = 0.0, status: int = 200, name: str = "stub",
+               retry_after: Optional[int] = None, slow_rate: float = 0.0, slow_ttfb: float = 1.0) -> FastAPI:
+    """
+    创建桩服务
+
+    Args:
+        ttfb: 首字节延迟（秒）
+        token_delay: 流式响应每个片段的间隔（秒）
+        tokens: 回复的片段数
+        fail_rate: 随机返回503的比例
+        status: 非200时所有对话请求都返回该状态码
+        name: 回复中带上的副本名，便于区分请求落到了哪个副本
+        retry_after: 错误响应带上的 Retry-After（秒）
+        slow_rate: 首字节延迟为 slow_ttfb 的请求比例（模拟长尾延迟）
+        slow_ttfb: 慢请求的首字节延迟（秒）
+    """
+    app = FastAPI()
+    app.state.requests = 0
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": name}]}
+
+    @app.get("/stats")
+    async def stats():
+        return {"name": name, "requests": app.state.requests}
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        app.state.requests += 1
+        try:
+            body = await request.json()
+        except ClientDisconnect:
+            # 调用方取消了请求（例如对冲请求中落后的一方）
+            return Response(status_code=499)
+        await asyncio.sleep(slow_ttfb if slow_rate and random.random() < slow_rate else ttfb)
+        error_headers = {"Retry-After": str(retry_after)} if retry_after is not None else None
+        if status != 200:
+            return JSONResponse({"error": {"message": f"{name} 固定返回 {status}"}}, status_code=status,
+                                headers=error_headers)
+        if fail_rate and random.random() < fail_rate:
+            return JSONResponse({"error": {"message": f"{name} 随机失败"}}, status_code=503, headers=error_headers)
+
+        pieces = [f"{name}:{index} " for index in range(tokens)]
+        if not body.get("stream"):
+            await asyncio.sleep(token_delay * tokens)
+            return {"choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)}}]}
+
+        async def generate():
+            for piece in pieces:
+                await asyncio.sleep(token_delay)
+                payload = {"choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                yield f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="OpenAI兼容接口的本地桩服务")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--ttfb", type=float, default=0.05, help="首字节延迟（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="流式片段间隔（秒）")
+    parser.add_argument("--tokens", type=int, default=50, help="回复的片段数")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="随机返回503的比例")
+    parser.add_argument("--status", type=int, default=200, help="所有对话请求固定返回的状态码")
+    parser.add_argument("--name", default=None, help="副本名，默认为 stub-端口")
+    parser.add_argument("--retry-after", type=int, default=None, help="错误响应带上的 Retry-After（秒）")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="慢请求的比例")
+    parser.add_argument("--slow-ttfb", type=float, default=1.0, help="慢请求的首字节延迟（秒）")
+    args = parser.parse_args()
+
+    app = create_app(args.ttfb, args.token_delay, args.tokens, args.fail_rate, args.status,
+                     args.name or f"stub-{args.port}", args.retry_after, args.slow_rate, args.slow_ttfb)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,109 @@ LLM_API_URL = os.getenv("LLM_API_URL", "http://111.19.168.151:11551/v1/chat/comp
 LLM_MODEL = os.getenv("LLM_MODEL", "codegeex4-all-9b")
 LLM_API_KEY = os.getenv("LLM_API_KEY", "codegeex")
 
+# 上游HTTP连接池配置（每个上游地址一个连接池）
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "100"))  # 单个上游最大连接数
+LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "20"))  # 单个上游最大空闲保活连接数
+LLM_POOL_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "30"))  # 空闲连接保活时间（秒）
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))  # 建立连接超时（秒）
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "false").lower() in ("1", "true", "yes")  # 是否启用HTTP/2（需安装h2）
+
+# 上游准入控制（每个上游地址独立计数）
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "32"))  # 单个上游最大在途请求数，超出的请求排队
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "200"))  # 单个上游最大排队数，超出时立即返回503
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))  # 最长排队时间（秒），超时返回503
+
+# 多副本负载均衡和健康检查
+LLM_API_URLS = [url.strip() for url in os.getenv("LLM_API_URLS", "").split(",") if url.strip()]  # 默认模型的多个副本地址，留空时只用 LLM_API_URL
+LLM_HEALTH_CHECK_INTERVAL = float(os.getenv("LLM_HEALTH_CHECK_INTERVAL", "10"))  # 主动健康检查间隔（秒），0表示关闭
+LLM_HEALTH_CHECK_PATH = os.getenv("LLM_HEALTH_CHECK_PATH", "/v1/models")  # 健康检查请求的路径
+LLM_HEALTH_CHECK_TIMEOUT = float(os.getenv("LLM_HEALTH_CHECK_TIMEOUT", "3"))  # 健康检查超时（秒）
+
+# 上游调用的重试和熔断
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))  # 收到内容之前失败时的最多重试次数（换副本也计入）
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))  # 首次重试的退避上限（秒），之后逐次翻倍并随机抖动
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "5"))  # 单次等待上限（秒），上游 Retry-After 超过该值时不重试
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))  # 连续失败多少次后熔断该上游
+LLM_BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))  # 熔断时长（秒），连续熔断时翻倍
+LLM_BREAKER_MAX_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_MAX_OPEN_SECONDS", "300"))  # 熔断时长上限（秒）
+
+# 非流式请求的对冲（预设模型可用 hedge_percentile/hedge_budget 单独设置）
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))  # 超过近期延迟的该分位数仍未返回时向另一个副本发送副本请求，0表示关闭
+LLM_HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.05"))  # 对冲请求占请求总数的比例上限
+
+# 上下文窗口配置
+CONTEXT_HISTORY_LIMIT = int(os.getenv("CONTEXT_HISTORY_LIMIT", "50"))  # 每轮最多从数据库读取的历史消息数
+CONTEXT_WINDOW_TOKENS = int(os.getenv("CONTEXT_WINDOW_TOKENS", "8192"))  # 未配置上下文长度的模型（自定义模型）使用的默认值
+CONTEXT_RESERVED_TOKENS = int(os.getenv("CONTEXT_RESERVED_TOKENS", "256"))  # token估算误差的安全余量
+
+# 滚动摘要配置
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", "40"))  # 未摘要消息超过该数量时触发摘要
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "20"))  # 始终保留原文的最近消息数
+SUMMARY_BATCH_LIMIT = int(os.getenv("SUMMARY_BATCH_LIMIT", "60"))  # 单次摘要最多合并的消息数
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "800"))  # 摘要的最大token数
+
+# 对话状态缓存配置（进程内LRU；多进程部署时各进程独立，需配合会话粘滞或关闭）
+HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+HISTORY_CACHE_MAX_ENTRIES = int(os.getenv("HISTORY_CACHE_MAX_ENTRIES", "1000"))  # 最多缓存的对话数
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 缓存占用上限（字节）
+
+# 消息写入队列（一轮对话的消息在一个事务中写入，后台合并多个请求一起提交）
+MESSAGE_WRITER_QUEUE_SIZE = int(os.getenv("MESSAGE_WRITER_QUEUE_SIZE", "1000"))  # 排队上限（轮），达到上限时写入方等待
+MESSAGE_WRITER_BATCH_SIZE = int(os.getenv("MESSAGE_WRITER_BATCH_SIZE", "100"))  # 每次提交最多合并的轮数
+
+# 大模型回复缓存配置（只缓存 temperature 为0的确定性请求和标题请求）
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))  # 内存中最多缓存的回复数
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 内存缓存占用上限（字节）
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))  # 缓存有效期
+RESPONSE_CACHE_DB_PATH = os.getenv("RESPONSE_CACHE_DB_PATH", "")  # 磁盘缓存的SQLite文件路径，留空则只使用内存缓存
+RESPONSE_CACHE_DB_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DB_MAX_ENTRIES", "100000"))  # 磁盘缓存最多保留的回复数
+
+# 相同请求合并：同时进行的相同确定性请求（与回复缓存的范围相同）只向上游发送一次
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# 近似重复提示缓存（回复缓存的第二层，按最后一条用户消息的 SimHash 匹配；有效期同 RESPONSE_CACHE_TTL_SECONDS）
+SIMILARITY_CACHE_ENABLED = os.getenv("SIMILARITY_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+SIMILARITY_CACHE_MAX_ENTRIES = int(os.getenv("SIMILARITY_CACHE_MAX_ENTRIES", "100000"))  # 最多登记的回复数
+SIMILARITY_CACHE_THRESHOLD = float(os.getenv("SIMILARITY_CACHE_THRESHOLD", "0.95"))  # 相似度阈值（1 - 汉明距离/64），不低于0.95时索引不会漏掉匹配
+
+# 流式响应配置
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))  # 检查客户端是否断开的间隔（秒）
+STREAM_CHECKPOINT_ENABLED = os.getenv("STREAM_CHECKPOINT_ENABLED", "true").lower() in ("1", "true", "yes")  # 生成过程中定期保存回复
+STREAM_CHECKPOINT_INTERVAL = float(os.getenv("STREAM_CHECKPOINT_INTERVAL", "5"))  # 距上次保存超过该时间（秒）时保存检查点
+STREAM_CHECKPOINT_BYTES = int(os.getenv("STREAM_CHECKPOINT_BYTES", "8192"))  # 距上次保存新增超过该字节数时保存检查点
+STREAM_RESUME_GRACE_SECONDS = float(os.getenv("STREAM_RESUME_GRACE_SECONDS", "15"))  # 客户端断开后继续生成、等待重新连接的时间（秒），0表示断开即停止
+STREAM_ATTACH_TIMEOUT_SECONDS = float(os.getenv("STREAM_ATTACH_TIMEOUT_SECONDS", "10"))  # 生成开始后等待第一个连接订阅的时间（秒），必须大于0
+STREAM_BUFFER_MAX_BYTES = int(os.getenv("STREAM_BUFFER_MAX_BYTES", str(1024 * 1024)))  # 每次生成保留的事件字节上限，超出时丢弃最早的事件
+STREAM_BUFFER_TTL_SECONDS = float(os.getenv("STREAM_BUFFER_TTL_SECONDS", "300"))  # 生成结束后事件缓冲的保留时间（秒）
+GENERATION_MAX_PER_USER = int(os.getenv("GENERATION_MAX_PER_USER", "3"))  # 每个用户同时进行的流式生成数上限，超出时返回429
+GENERATION_MAX_ACTIVE = int(os.getenv("GENERATION_MAX_ACTIVE", "256"))  # 进程同时进行的流式生成数上限，超出时返回503
+SSE_FLUSH_INTERVAL_MS = int(os.getenv("SSE_FLUSH_INTERVAL_MS", "50"))  # 流式输出合并片段的最长等待时间（毫秒），第一帧不等待，0表示逐个发送
+SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", "4096"))  # 等待期间累计超过该字节数时立即发送
+SSE_GZIP = os.getenv("SSE_GZIP", "false").lower() in ("1", "true", "yes")  # 客户端支持时gzip压缩流式响应
+SSE_GZIP_LEVEL = int(os.getenv("SSE_GZIP_LEVEL", "6"))  # gzip压缩级别（1-9）
+
+# 旧对话清理配置（后台定时执行，不在创建对话的请求中进行）
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "true").lower() in ("1", "true", "yes")
+RETENTION_MAX_CONVERSATIONS = int(os.getenv("RETENTION_MAX_CONVERSATIONS", "500"))  # 每个用户默认保留的对话数，0表示不限制
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "300"))  # 清理间隔
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "100"))  # 每批删除的对话数
+
+# 标题生成队列配置（后台生成，不阻塞对话响应）
+TITLE_CONCURRENCY = int(os.getenv("TITLE_CONCURRENCY", "2"))  # 同时生成标题的任务数
+TITLE_QUEUE_SIZE = int(os.getenv("TITLE_QUEUE_SIZE", "1000"))  # 排队上限，超出时丢弃（下一轮对话会重新提交）
+TITLE_MAX_RETRIES = int(os.getenv("TITLE_MAX_RETRIES", "2"))  # 失败重试次数，仍失败时截取用户消息作为标题
+TITLE_RETRY_DELAY = float(os.getenv("TITLE_RETRY_DELAY", "2"))  # 首次重试的等待时间（秒），之后逐次翻倍
+TITLE_DEGRADE_QUEUE_DEPTH = int(os.getenv("TITLE_DEGRADE_QUEUE_DEPTH", "50"))  # 排队数达到该值时降级
+TITLE_FALLBACK_MODEL_TYPE = os.getenv("TITLE_FALLBACK_MODEL_TYPE", "")  # 降级时使用的预设模型，留空则直接截取用户消息
+
 # 数据库配置
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./conversation.db")
+# 异步数据库驱动地址，留空时根据 DATABASE_URL 自动推导（sqlite→aiosqlite，postgresql→asyncpg）
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", "")
+# 是否使用异步数据库引擎；关闭或未安装异步驱动时回退到线程池中执行的同步会话
+USE_ASYNC_DB = os.getenv("USE_ASYNC_DB", "true").lower() in ("1", "true", "yes")
 
 # 服务器配置
 HOST = os.getenv("HOST", "0.0.0.0")
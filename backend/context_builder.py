@@ -0,0 +1,132 @@
+"""
+上下文窗口构建：按token预算裁剪发送给大模型的历史消息
+"""
+import re
+from typing import List, Dict, Optional
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import Message
+from config import CONTEXT_HISTORY_LIMIT, CONTEXT_RESERVED_TOKENS
+
+# 中日韩字符（含全角标点），基本按一个字符一个token估算
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+# 每条消息的固定开销（角色标记、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(content: str) -> int:
+    """
+    快速估算文本的token数
+
+    不依赖分词器：中日韩字符按1个token计，其余字符按约4个字符1个token计，
+    再加上每条消息的固定开销。结果偏保守，用于预算裁剪足够。
+
+    Args:
+        content: 文本内容
+
+    Returns:
+        估算的token数
+    """
+    if not content:
+        return MESSAGE_OVERHEAD_TOKENS
+    cjk = count_cjk(content)
+    other = len(content) - cjk
+    return cjk + (other + 3) // 4 + MESSAGE_OVERHEAD_TOKENS
+
+
+def count_cjk(content: str) -> int:
+    """统计中日韩字符数（按片段累计后可以估算流式输出的token数，见 estimate_tokens）"""
+    return len(_CJK_RE.findall(content))
+
+
+def context_budget(context_window: int, max_tokens: int) -> int:
+    """
+    计算可用于输入（历史+当前消息）的token预算
+
+    Args:
+        context_window: 模型上下文长度
+        max_tokens: 本次生成预留的最大输出token数
+
+    Returns:
+        输入token预算
+    """
+    return max(0, context_window - max_tokens - CONTEXT_RESERVED_TOKENS)
+
+
+def recent_messages_query(conversation_id: int, limit: int = CONTEXT_HISTORY_LIMIT, after_id: int = 0):
+    """对话最新的 limit 条消息（按时间倒序），执行计划检查也使用这个语句（见 migrations.check_query_plans）"""
+    return (
+        select(Message.id, Message.role, Message.content, Message.token_count)
+        .where(Message.conversation_id == conversation_id, Message.id > after_id)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(limit)
+    )
+
+
+async def load_recent_messages(db: AsyncSession, conversation_id: int, limit: int = CONTEXT_HISTORY_LIMIT,
+                               after_id: int = 0) -> List[Dict]:
+    """
+    只读取对话最新的 limit 条消息（按时间正序返回）
+
+    没有缓存token数的旧消息会在这里计算并回写。
+
+    Args:
+        db: 数据库会话
+        conversation_id: 对话主键
+        limit: 最多读取的消息数
+        after_id: 只读取ID大于该值的消息（已被摘要覆盖的消息不再读取）
+
+    Returns:
+        消息列表，格式为 [{"id": 1, "role": "user", "content": "...", "token_count": 10}]
+    """
+    result = await db.execute(recent_messages_query(conversation_id, limit, after_id))
+    rows = [
+        {"id": msg_id, "role": role, "content": content, "token_count": token_count}
+        for msg_id, role, content, token_count in result.all()
+    ]
+    rows.reverse()
+
+    missing = [row for row in rows if row["token_count"] is None]
+    if missing:
+        for row in missing:
+            row["token_count"] = estimate_tokens(row["content"])
+            await db.execute(update(Message).where(Message.id == row["id"]).values(token_count=row["token_count"]))
+        await db.commit()
+
+    return rows
+
+
+def trim_to_budget(history: List[Dict], user_message: str, budget: int,
+                   system_messages: Optional[List[Dict[str, str]]] = None) -> List[Dict[str, str]]:
+    """
+    按token预算裁剪历史消息
+
+    系统提示和当前用户消息总是保留，历史消息从最新往最旧依次加入，直到超出预算。
+
+    Args:
+        history: 按时间正序的历史消息（含 token_count）
+        user_message: 当前用户消息
+        budget: 输入token预算
+        system_messages: 需要放在最前面的系统消息
+
+    Returns:
+        发送给大模型的消息列表，格式为 [{"role": "user", "content": "..."}]
+    """
+    system_messages = system_messages or []
+    used = estimate_tokens(user_message) + sum(estimate_tokens(msg["content"]) for msg in system_messages)
+
+    kept = []
+    for row in reversed(history):
+        tokens = row["token_count"] if row.get("token_count") is not None else estimate_tokens(row["content"])
+        if used + tokens > budget:
+            break
+        used += tokens
+        kept.append({"role": row["role"], "content": row["content"]})
+    kept.reverse()
+
+    # 避免上下文以助手回复开头（其对应的用户提问已被裁掉）
+    while kept and kept[0]["role"] == "assistant":
+        kept.pop(0)
+
+    return system_messages + kept + [{"role": "user", "content": user_message}]
@@ -1,18 +1,83 @@
 """
 对话管理服务
 """
+import asyncio
+import base64
+import json
 import uuid
-from typing import List, Dict, Optional, AsyncGenerator
-from sqlalchemy.orm import Session
+from datetime import datetime
+from typing import List, Dict, Optional, AsyncGenerator, Tuple
+from sqlalchemy import select, delete, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import Conversation, Message
 from llm_service import llm_service
+from response_cache import cache_scope
+from admission import Permit
+from model_registry import ModelTarget
+from context_builder import context_budget, load_recent_messages, trim_to_budget
+from summarizer import conversation_summarizer, summary_system_message
+from history_cache import history_cache, ConversationState
+import search_index
+from retention import retention_worker
+from stream_control import stream_stats
+from title_worker import title_worker
+from message_writer import message_writer, message_record
+from reply_checkpoint import ReplyCheckpoint
 
 
 class ConversationService:
     """对话管理服务类"""
 
     @staticmethod
-    def create_conversation(db: Session, user_id: int) -> str:
+    async def get_conversation(db: AsyncSession, session_id: str) -> Optional[Conversation]:
+        """
+        根据session_id获取对话会话
+
+        Args:
+            db: 数据库会话
+            session_id: 会话ID
+
+        Returns:
+            对话会话，不存在时返回None
+        """
+        result = await db.execute(select(Conversation).where(Conversation.session_id == session_id))
+        return result.scalars().first()
+
+    @staticmethod
+    async def get_conversation_state(db: AsyncSession, session_id: str) -> Optional[ConversationState]:
+        """
+        获取对话热数据（对话主键、标题、摘要和最近消息），优先读取进程内缓存
+
+        Args:
+            db: 数据库会话
+            session_id: 会话ID
+
+        Returns:
+            对话状态，对话不存在时返回None
+        """
+        state = history_cache.get(session_id)
+        if state is not None:
+            return state
+
+        # 加载期间有新的写入提交时不放入缓存（见 HistoryCache）
+        snapshot = history_cache.snapshot()
+        conversation = await ConversationService.get_conversation(db, session_id)
+        if not conversation:
+            return None
+        messages = await load_recent_messages(db, conversation.id, after_id=conversation.summary_until_id or 0)
+        state = ConversationState(
+            conversation_id=conversation.id,
+            user_id=conversation.user_id,
+            title=conversation.title,
+            summary=conversation.summary,
+            summary_until_id=conversation.summary_until_id,
+            messages=messages
+        )
+        history_cache.put(session_id, state, snapshot)
+        return state
+
+    @staticmethod
+    async def create_conversation(db: AsyncSession, user_id: int) -> str:
         """
         创建新的对话会话
 
@@ -26,16 +91,24 @@ class ConversationService:
         session_id = str(uuid.uuid4())
         conversation = Conversation(session_id=session_id, user_id=user_id)
         db.add(conversation)
-        db.commit()
-        db.refresh(conversation)
+        await db.commit()
 
-        # 每次创建新对话时检查并清理旧对话
-        ConversationService.cleanup_old_conversations(db, user_id)
+        # 超出保留数量的旧对话由后台任务清理
+        retention_worker.mark(user_id)
 
         return session_id
 
     @staticmethod
-    def get_conversation_history(db: Session, session_id: str) -> List[Dict[str, str]]:
+    def history_query(conversation_id: int):
+        """对话的全部消息（按时间正序），执行计划检查也使用这个语句（见 migrations.check_query_plans）"""
+        return (
+            select(Message.role, Message.content, Message.status)
+            .where(Message.conversation_id == conversation_id)
+            .order_by(Message.created_at, Message.id)
+        )
+
+    @staticmethod
+    async def get_conversation_history(db: AsyncSession, session_id: str) -> List[Dict[str, str]]:
         """
         获取对话历史记录
 
@@ -44,79 +117,99 @@ class ConversationService:
             session_id: 会话ID
 
         Returns:
-            消息列表，格式为 [{"role": "user", "content": "..."}]
+            消息列表，格式为 [{"role": "user", "content": "...", "status": "complete"}]
         """
-        conversation = db.query(Conversation).filter(Conversation.session_id == session_id).first()
+        conversation = await ConversationService.get_conversation(db, session_id)
         if not conversation:
             return []
 
-        messages = db.query(Message).filter(Message.conversation_id == conversation.id).order_by(Message.created_at).all()
-        return [{"role": msg.role, "content": msg.content} for msg in messages]
+        result = await db.execute(ConversationService.history_query(conversation.id))
+        return [{"role": role, "content": content, "status": status} for role, content, status in result.all()]
+
+    @staticmethod
+    async def build_context(db: AsyncSession, session_id: str, user_message: str, max_tokens: int = 2000,
+                            target: Optional[ModelTarget] = None) -> List[Dict[str, str]]:
+        """
+        构建发送给大模型的上下文
+
+        只读取摘要之后最新的若干条历史消息，并按模型上下文长度减去 max_tokens 的预算裁剪；
+        对话摘要（如有）作为系统消息放在最前面，摘要和当前用户消息总是保留。
+
+        Args:
+            db: 数据库会话
+            session_id: 会话ID
+            user_message: 当前用户消息
+            max_tokens: 本次生成的最大token数
+            target: 模型目标，为None时使用默认目标
+
+        Returns:
+            消息列表，格式为 [{"role": "user", "content": "..."}]
+        """
+        state = await ConversationService.get_conversation_state(db, session_id)
+        if state is None:
+            return [{"role": "user", "content": user_message}]
+        return ConversationService._context_from_state(state, user_message, max_tokens, target)
+
+    @staticmethod
+    def _context_from_state(state: ConversationState, user_message: str, max_tokens: int,
+                            target: Optional[ModelTarget]) -> List[Dict[str, str]]:
+        """按已读取的对话状态构建上下文（见 build_context）"""
+        system_messages = [summary_system_message(state.summary)] if state.summary else []
+        target = target or llm_service.default_target
+        return trim_to_budget(state.messages, user_message, context_budget(target.context_window, max_tokens), system_messages)
 
     @staticmethod
-    def save_message(db: Session, session_id: str, role: str, content: str):
+    async def save_message(db: AsyncSession, session_id: str, role: str, content: str, status: str = "complete"):
         """
-        保存消息到数据库
+        保存消息到数据库（经 message_writer 写入，等待提交完成）
 
         Args:
             db: 数据库会话
             session_id: 会话ID
             role: 角色（user 或 assistant）
             content: 消息内容
+            status: 消息状态（complete 或 truncated）
         """
-        conversation = db.query(Conversation).filter(Conversation.session_id == session_id).first()
-        if not conversation:
+        state = await ConversationService.get_conversation_state(db, session_id)
+        if state is None:
             raise ValueError(f"会话 {session_id} 不存在")
-
-        message = Message(conversation_id=conversation.id, role=role, content=content)
-        db.add(message)
-        db.commit()
+        await message_writer.write(state.conversation_id, session_id, [message_record(role, content, status)])
 
     @staticmethod
-    async def generate_title(db: Session, session_id: str) -> str:
+    async def generate_title(db: AsyncSession, session_id: str, target: Optional[ModelTarget] = None) -> str:
         """
-        根据对话内容生成标题
+        立即根据对话内容生成标题（对话流程中通过 title_worker 在后台生成）
 
         Args:
             db: 数据库会话
             session_id: 会话ID
+            target: 模型目标，为None时使用默认目标
 
         Returns:
             生成的标题
         """
-        conversation = db.query(Conversation).filter(Conversation.session_id == session_id).first()
-        if not conversation:
-            raise ValueError(f"会话 {session_id} 不存在")
+        return await title_worker.generate_title(db, session_id, target)
 
-        # 获取前几条消息用于生成标题
-        messages = db.query(Message).filter(Message.conversation_id == conversation.id).order_by(Message.created_at).limit(4).all()
-
-        if not messages:
-            return "新对话"
-
-        # 构建用于生成标题的提示
-        conversation_text = "\n".join([f"{msg.role}: {msg.content[:100]}" for msg in messages])
-
-        title_prompt = [
-            {"role": "system", "content": "你是一个助手，需要根据对话内容生成一个简洁的标题（不超过20个字）。只返回标题文本，不要有其他内容。"},
-            {"role": "user", "content": f"请为以下对话生成一个简洁的标题（不超过20个字）：\n\n{conversation_text}"}
-        ]
-
-        try:
-            title = await llm_service.chat_completion(title_prompt, temperature=0.5, max_tokens=50)
-            title = title.strip().strip('"').strip("'")[:50]  # 清理和限制长度
+    @staticmethod
+    async def _load_state(db: AsyncSession, session_id: str) -> ConversationState:
+        """读取对话状态，对话不存在时抛出 ValueError（在调用大模型之前检查）"""
+        state = await ConversationService.get_conversation_state(db, session_id)
+        if state is None:
+            raise ValueError(f"会话 {session_id} 不存在")
+        return state
 
-            # 更新对话标题
-            conversation.title = title
-            db.commit()
+    @staticmethod
+    def _after_turn(state: ConversationState, session_id: str, target: Optional[ModelTarget]):
+        # 历史较长时在后台把较早的轮次合并进摘要
+        conversation_summarizer.schedule(state.conversation_id, target)
 
-            return title
-        except Exception as e:
-            print(f"生成标题失败: {str(e)}")
-            return "新对话"
+        # 如果是第一轮对话，提交到标题队列在后台生成（不阻塞返回）
+        if state.title == "新对话":
+            title_worker.submit(session_id, target)
 
     @staticmethod
-    async def chat(db: Session, session_id: str, user_message: str, temperature: float = 0.7, max_tokens: int = 2000) -> str:
+    async def chat(db: AsyncSession, session_id: str, user_message: str, temperature: float = 0.7, max_tokens: int = 2000,
+                   target: Optional[ModelTarget] = None, user_id: Optional[int] = None) -> str:
         """
         进行多轮对话
 
@@ -126,34 +219,35 @@ class ConversationService:
             user_message: 用户消息
             temperature: 温度参数
             max_tokens: 最大生成token数
+            target: 模型目标，为None时使用默认目标
+            user_id: 用户ID，上游繁忙排队时按用户轮转
 
         Returns:
             助手的回复
         """
-        # 获取历史对话
-        history = ConversationService.get_conversation_history(db, session_id)
-
-        # 添加用户当前消息
-        history.append({"role": "user", "content": user_message})
+        # 按token预算构建上下文（历史消息 + 当前用户消息）
+        state = await ConversationService._load_state(db, session_id)
+        history = ConversationService._context_from_state(state, user_message, max_tokens, target)
+        user_record = message_record("user", user_message)
+        # 读完后释放读事务，避免在等待大模型期间占用连接
+        await db.commit()
 
         # 调用大模型API
-        assistant_reply = await llm_service.chat_completion(history, temperature, max_tokens)
-
-        # 保存用户消息和助手回复到数据库
-        ConversationService.save_message(db, session_id, "user", user_message)
-        ConversationService.save_message(db, session_id, "assistant", assistant_reply)
-
-        # 如果是第一轮对话，自动生成标题
-        conversation = db.query(Conversation).filter(Conversation.session_id == session_id).first()
-        if conversation and conversation.title == "新对话":
-            # 异步生成标题（不阻塞返回）
-            import asyncio
-            asyncio.create_task(ConversationService.generate_title(db, session_id))
-
+        assistant_reply = await llm_service.chat_completion(
+            history, temperature, max_tokens, target=target, user_id=user_id, scope=cache_scope(history, user_id)
+        )
+
+        # 用户消息和助手回复在同一个事务中保存
+        await message_writer.write(
+            state.conversation_id, session_id, [user_record, message_record("assistant", assistant_reply)]
+        )
+        ConversationService._after_turn(state, session_id, target)
         return assistant_reply
 
     @staticmethod
-    async def chat_stream(db: Session, session_id: str, user_message: str, temperature: float = 0.7, max_tokens: int = 2000) -> AsyncGenerator[str, None]:
+    async def chat_stream(db: AsyncSession, session_id: str, user_message: str, temperature: float = 0.7, max_tokens: int = 2000,
+                          target: Optional[ModelTarget] = None, user_id: Optional[int] = None,
+                          permit: Optional[Permit] = None) -> AsyncGenerator[str, None]:
         """
         进行流式多轮对话
 
@@ -163,38 +257,51 @@ class ConversationService:
             user_message: 用户消息
             temperature: 温度参数
             max_tokens: 最大生成token数
+            target: 模型目标，为None时使用默认目标
+            user_id: 用户ID，上游繁忙排队时按用户轮转
+            permit: 预先获取的上游准入许可（见 llm_service.admit）
 
         Yields:
             逐步生成的文本片段
         """
-        # 获取历史对话
-        history = ConversationService.get_conversation_history(db, session_id)
-
-        # 添加用户当前消息
-        history.append({"role": "user", "content": user_message})
-
-        # 保存用户消息
-        ConversationService.save_message(db, session_id, "user", user_message)
+        # 按token预算构建上下文（历史消息 + 当前用户消息）
+        state = await ConversationService._load_state(db, session_id)
+        history = ConversationService._context_from_state(state, user_message, max_tokens, target)
+        # 用户消息与回复一起保存（长回复在生成过程中保存检查点）；读完后释放读事务，流式生成期间不占用数据库连接
+        checkpoint = ReplyCheckpoint(state.conversation_id, session_id, message_record("user", user_message))
+        await db.commit()
 
         # 调用大模型API流式生成
-        full_response = ""
-        async for chunk in llm_service.chat_completion_stream(history, temperature, max_tokens):
-            full_response += chunk
-            yield chunk
-
-        # 保存完整的助手回复
-        ConversationService.save_message(db, session_id, "assistant", full_response)
-
-        # 如果是第一轮对话，自动生成标题（同步执行确保生成）
-        conversation = db.query(Conversation).filter(Conversation.session_id == session_id).first()
-        if conversation and conversation.title == "新对话":
-            try:
-                await ConversationService.generate_title(db, session_id)
-            except Exception as e:
-                print(f"生成标题失败: {str(e)}")
+        stream = llm_service.chat_completion_stream(
+            history, temperature, max_tokens, target=target, user_id=user_id, permit=permit,
+            scope=cache_scope(history, user_id)
+        )
+        stream_stats.started += 1
+        try:
+            async for chunk in stream:
+                checkpoint.append(chunk)
+                yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客户端断开：上游读取已被中断，保存用户消息和已生成的部分（标记为截断）
+            stream_stats.cancelled += 1
+            checkpoint.finish_in_background("truncated")
+            raise
+        except Exception:
+            # 生成失败时仍保存用户消息和已生成的部分
+            stream_stats.failed += 1
+            checkpoint.finish_in_background("truncated")
+            raise
+        finally:
+            # 提前结束时立即关闭上游连接，而不是等垃圾回收
+            await stream.aclose()
+        stream_stats.completed += 1
+
+        # 保存完整的助手回复（没有检查点时与用户消息在同一个事务中写入）
+        await checkpoint.finish("complete")
+        ConversationService._after_turn(state, session_id, target)
 
     @staticmethod
-    def delete_conversation(db: Session, session_id: str):
+    async def delete_conversation(db: AsyncSession, session_id: str):
         """
         删除对话会话
 
@@ -202,133 +309,111 @@ class ConversationService:
             db: 数据库会话
             session_id: 会话ID
         """
-        conversation = db.query(Conversation).filter(Conversation.session_id == session_id).first()
+        history_cache.invalidate(session_id)
+        conversation = await ConversationService.get_conversation(db, session_id)
         if conversation:
-            db.delete(conversation)
-            db.commit()
+            # 用批量DELETE代替ORM级联，避免在异步会话中加载全部消息
+            await db.execute(delete(Message).where(Message.conversation_id == conversation.id))
+            await db.execute(delete(Conversation).where(Conversation.id == conversation.id))
+            await db.commit()
 
     @staticmethod
-    def list_conversations(db: Session, user_id: int) -> List[Dict]:
+    async def list_conversations(db: AsyncSession, user_id: int, limit: int = 500,
+                                 cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
         """
-        获取用户的所有对话会话列表(只返回最近500条)
+        按更新时间倒序分页获取用户的对话会话列表
+
+        使用 (updated_at, id) 游标分页，翻页时不受新对话插入影响，也不需要 OFFSET 扫描。
 
         Args:
             db: 数据库会话
             user_id: 用户ID
+            limit: 每页条数（默认500，与旧接口一致）
+            cursor: 上一页返回的 next_cursor，为None时从最新的对话开始
 
         Returns:
-            会话列表(最多500条)
+            (会话列表, 下一页游标)，没有更多数据时游标为None
         """
-        # 只获取该用户最近更新的500条对话
-        conversations = db.query(Conversation).filter(
-            Conversation.user_id == user_id
-        ).order_by(Conversation.updated_at.desc()).limit(500).all()
-        return [
+        after = ConversationService._decode_cursor(cursor) if cursor else None
+        rows = (await db.execute(ConversationService.list_query(user_id, limit + 1, after))).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = ConversationService._encode_cursor(rows[-1].updated_at, rows[-1].id)
+
+        conversations = [
             {
-                "session_id": conv.session_id,
-                "title": conv.title,
-                "created_at": conv.created_at.isoformat(),
-                "updated_at": conv.updated_at.isoformat(),
-                "message_count": len(conv.messages)
+                "session_id": row.session_id,
+                "title": row.title,
+                "created_at": row.created_at.isoformat(),
+                "updated_at": row.updated_at.isoformat(),
+                "message_count": row.message_count,
+                "last_message_at": row.last_message_at.isoformat() if row.last_message_at else None
             }
-            for conv in conversations
+            for row in rows
         ]
+        return conversations, next_cursor
 
     @staticmethod
-    def cleanup_old_conversations(db: Session, user_id: int):
+    def list_query(user_id: int, limit: int, after: Optional[Tuple[datetime, int]] = None):
         """
-        清理用户超过500条的旧对话记录
+        用户的对话（按 updated_at、id 倒序），执行计划检查也使用这个语句
 
         Args:
-            db: 数据库会话
-            user_id: 用户ID
+            after: 上一页最后一条的 (updated_at, id)，为None时从最新的对话开始
         """
-        # 获取该用户的总对话数
-        total_count = db.query(Conversation).filter(Conversation.user_id == user_id).count()
+        stmt = (
+            select(Conversation.id, Conversation.session_id, Conversation.title, Conversation.created_at,
+                   Conversation.updated_at, Conversation.message_count, Conversation.last_message_at)
+            .where(Conversation.user_id == user_id)
+            .order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+            .limit(limit)
+        )
+        if after is not None:
+            updated_at, last_id = after
+            stmt = stmt.where(or_(
+                Conversation.updated_at < updated_at,
+                and_(Conversation.updated_at == updated_at, Conversation.id < last_id)
+            ))
+        return stmt
 
-        if total_count > 500:
-            # 获取第500条之后的所有对话ID
-            old_conversations = db.query(Conversation).filter(
-                Conversation.user_id == user_id
-            ).order_by(
-                Conversation.updated_at.desc()
-            ).offset(500).all()
-
-            # 删除旧对话
-            for conv in old_conversations:
-                db.delete(conv)
+    @staticmethod
+    def _encode_cursor(updated_at: datetime, conversation_id: int) -> str:
+        raw = json.dumps([updated_at.isoformat(), conversation_id])
+        return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
 
-            db.commit()
-            print(f"已清理用户 {user_id} 的 {len(old_conversations)} 条旧对话记录")
+    @staticmethod
+    def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+        """解析分页游标，格式不正确时抛出 ValueError"""
+        try:
+            updated_at, conversation_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            return datetime.fromisoformat(updated_at), int(conversation_id)
+        except Exception:
+            raise ValueError("无效的分页游标")
 
     @staticmethod
-    def search_conversations(db: Session, user_id: int, query: str) -> List[Dict]:
+    async def search_conversations(db: AsyncSession, user_id: int, query: str,
+                                   limit: int = 20, offset: int = 0) -> Tuple[List[Dict], int]:
         """
         在用户的对话中搜索包含关键词的对话
 
+        使用全文索引一次查出排序、片段和分页结果，按相关度排序。
+
         Args:
             db: 数据库会话
             user_id: 用户ID
             query: 搜索关键词
+            limit: 每页条数
+            offset: 偏移量
 
         Returns:
-            包含关键词的对话列表
+            (当前页的对话列表, 命中的对话总数)
         """
-        if not query or not query.strip():
-            return []
+        query = (query or "").strip()
+        if not query:
+            return [], 0
 
-        # 搜索标题或消息内容中包含关键词的对话
-        search_pattern = f"%{query}%"
-
-        # 查找标题匹配的对话（仅限该用户）
-        title_matches = db.query(Conversation).filter(
-            Conversation.user_id == user_id,
-            Conversation.title.like(search_pattern)
-        ).order_by(Conversation.updated_at.desc()).limit(100).all()
-
-        # 查找消息内容匹配的对话（仅限该用户）
-        message_matches = db.query(Conversation).join(Message).filter(
-            Conversation.user_id == user_id,
-            Message.content.like(search_pattern)
-        ).order_by(Conversation.updated_at.desc()).limit(100).all()
-
-        # 合并结果并去重
-        conversation_dict = {}
-        for conv in title_matches + message_matches:
-            if conv.session_id not in conversation_dict:
-                # 统计匹配的消息数
-                match_count = db.query(Message).filter(
-                    Message.conversation_id == conv.id,
-                    Message.content.like(search_pattern)
-                ).count()
-
-                # 获取第一条匹配的消息片段
-                first_match = db.query(Message).filter(
-                    Message.conversation_id == conv.id,
-                    Message.content.like(search_pattern)
-                ).first()
-
-                preview = ""
-                if first_match:
-                    content = first_match.content
-                    index = content.lower().find(query.lower())
-                    if index != -1:
-                        start = max(0, index - 50)
-                        end = min(len(content), index + len(query) + 50)
-                        preview = content[start:end]
-
-                conversation_dict[conv.session_id] = {
-                    "session_id": conv.session_id,
-                    "title": conv.title,
-                    "created_at": conv.created_at.isoformat(),
-                    "updated_at": conv.updated_at.isoformat(),
-                    "message_count": len(conv.messages),
-                    "match_count": match_count,
-                    "preview": preview
-                }
-
-        # 按更新时间排序
-        return sorted(conversation_dict.values(), key=lambda x: x["updated_at"], reverse=True)
+        return await search_index.search(db, user_id, query, limit, offset)
 
 
 # 创建全局对话服务实例
@@ -1,11 +1,12 @@
 """
 数据库模型和会话管理
 """
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Boolean
+from sqlalchemy import create_engine, event, Index, Column, Integer, String, Text, DateTime, ForeignKey, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime, timezone, timedelta
-from config import DATABASE_URL
+from config import DATABASE_URL, ASYNC_DATABASE_URL, USE_ASYNC_DB
 
 Base = declarative_base()
 
@@ -42,9 +43,16 @@ class Conversation(Base):
     session_id = Column(String(100), unique=True, index=True, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # 所属用户ID
     title = Column(String(200), default="新对话", nullable=False)  # 对话标题
+    summary = Column(Text, nullable=True)  # 较早对话轮次的滚动摘要
+    summary_until_id = Column(Integer, nullable=True)  # 摘要已覆盖到的最后一条消息ID
+    message_count = Column(Integer, default=0, nullable=False)  # 消息数（随消息写入在同一事务内维护）
+    last_message_at = Column(DateTime, nullable=True)  # 最后一条消息的时间
     created_at = Column(DateTime, default=get_beijing_time)
     updated_at = Column(DateTime, default=get_beijing_time, onupdate=get_beijing_time)
 
+    # 对话列表、游标分页和旧对话清理按 (user_id, updated_at) 查询
+    __table_args__ = (Index("ix_conversations_user_updated", "user_id", "updated_at"),)
+
     # 关联用户和消息
     user = relationship("User", back_populates="conversations")
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
@@ -58,8 +66,13 @@ class Message(Base):
     conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
     role = Column(String(20), nullable=False)  # user 或 assistant
     content = Column(Text, nullable=False)
+    token_count = Column(Integer, nullable=True)  # 估算的token数（写入时计算并缓存）
+    status = Column(String(20), default="complete", nullable=False)  # complete: 完整回复, truncated: 客户端断开时的部分回复, streaming: 生成中的检查点, interrupted: 生成中进程退出
     created_at = Column(DateTime, default=get_beijing_time)
 
+    # 历史记录、上下文加载和摘要都按 (conversation_id, created_at) 查询
+    __table_args__ = (Index("ix_messages_conversation_created", "conversation_id", "created_at"),)
+
     # 关联会话
     conversation = relationship("Conversation", back_populates="messages")
 
@@ -72,6 +85,7 @@ class UserConfig(Base):
     user_id = Column(Integer, ForeignKey("users.id"), unique=True, nullable=False)  # 用户ID
     current_model_type = Column(String(50), default="codegeex", nullable=False)  # 当前模型类型: codegeex/glm/custom
     max_tokens = Column(Integer, default=2000, nullable=False)  # 最大token数
+    max_conversations = Column(Integer, nullable=True)  # 保留的对话数上限，为空时使用全局配置
 
     # 自定义模型配置(JSON格式存储)
     custom_api_url = Column(String(500), default="")
@@ -92,9 +106,128 @@ engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} i
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """SQLite连接参数：WAL模式允许读写并发，busy_timeout避免写锁竞争时立即报错"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+if DATABASE_URL.startswith("sqlite"):
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+
+
+def _derive_async_url(url: str) -> str:
+    """根据同步数据库地址推导异步驱动地址"""
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgresql:") or url.startswith("postgresql+psycopg2:"):
+        return "postgresql+asyncpg:" + url.split(":", 1)[1]
+    if url.startswith("mysql:") or url.startswith("mysql+pymysql:"):
+        return "mysql+aiomysql:" + url.split(":", 1)[1]
+    return url
+
+
+class ThreadedSession:
+    """
+    同步Session的异步适配器
+
+    未启用或未安装异步数据库驱动时使用：接口与 AsyncSession 一致，
+    但每个数据库操作都放到线程池中执行，同样不会阻塞事件循环。
+    """
+
+    def __init__(self, session):
+        self._session = session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _execute_buffered(self, statement, *args, **kwargs):
+        # 在工作线程中取回全部结果，避免在事件循环线程上读取游标
+        result = self._session.execute(statement, *args, **kwargs)
+        # ORM查询结果没有 returns_rows 属性，只有 DML 的 CursorResult 才可能不返回行
+        return result.freeze()() if getattr(result, "returns_rows", True) else result
+
+    async def execute(self, statement, *args, **kwargs):
+        return await run_in_threadpool(self._execute_buffered, statement, *args, **kwargs)
+
+    async def scalar(self, statement, *args, **kwargs):
+        return await run_in_threadpool(self._session.scalar, statement, *args, **kwargs)
+
+    async def scalars(self, statement, *args, **kwargs):
+        result = await self.execute(statement, *args, **kwargs)
+        return result.scalars()
+
+    async def get(self, entity, ident, **kwargs):
+        return await run_in_threadpool(self._session.get, entity, ident, **kwargs)
+
+    def add(self, instance):
+        self._session.add(instance)
+
+    def add_all(self, instances):
+        self._session.add_all(instances)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self._session.delete, instance)
+
+    async def flush(self):
+        await run_in_threadpool(self._session.flush)
+
+    async def refresh(self, instance):
+        await run_in_threadpool(self._session.refresh, instance)
+
+    async def commit(self):
+        await run_in_threadpool(self._session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self._session.rollback)
+
+    async def close(self):
+        await run_in_threadpool(self._session.close)
+
+
+def _create_async_session_factory():
+    """创建异步会话工厂；异步驱动不可用时回退到线程池同步会话"""
+    if USE_ASYNC_DB:
+        try:
+            from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+            async_engine = create_async_engine(ASYNC_DATABASE_URL or _derive_async_url(DATABASE_URL))
+            if async_engine.dialect.name == "sqlite":
+                event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+            factory = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+            return async_engine, factory
+        except ImportError as e:
+            print(f"[DB] 异步数据库驱动不可用（{e}），回退到线程池同步会话")
+
+    fallback_sessionmaker = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+    return None, lambda: ThreadedSession(fallback_sessionmaker())
+
+
+# 异步引擎（回退模式下为None）和异步会话工厂
+async_engine, AsyncSessionLocal = _create_async_session_factory()
+
+
 def init_db():
-    """初始化数据库，创建所有表"""
-    Base.metadata.create_all(bind=engine)
+    """初始化数据库：创建所有表并执行尚未应用的迁移"""
+    # 延迟导入，避免循环依赖
+    import migrations
+    import search_index
+    migrations.upgrade(engine)
+    with engine.connect() as conn:
+        search_index.detect_search_index(conn)
+
+
+async def dispose_engines():
+    """关闭数据库连接池"""
+    if async_engine is not None:
+        await async_engine.dispose()
+    engine.dispose()
 
 
 def get_db():
@@ -104,3 +237,9 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    """获取异步数据库会话（FastAPI依赖）"""
+    async with AsyncSessionLocal() as db:
+        yield db
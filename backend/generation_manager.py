@@ -0,0 +1,269 @@
+"""
+生成任务管理：每轮流式对话作为独立的后台任务运行，生命周期与HTTP连接无关
+
+- 每次生成使用独立的数据库会话，事件写入可续传的事件缓冲（见 stream_buffer），
+  多个连接（多个标签页、重新连接）可以同时订阅同一次生成
+- 可以通过接口显式停止；没有连接超过 grace 秒时自动停止；已生成的部分按截断保存
+- 限制每个用户和整个进程同时进行的生成数，超出时在开始响应前拒绝
+- 记录每次生成已输出的片段数、估算的token数和耗时；生成结束后保留 ttl 秒供重新连接
+"""
+import asyncio
+import time
+import uuid
+from typing import AsyncGenerator, Dict, List, Optional
+from database import AsyncSessionLocal
+from conversation_service import conversation_service
+from context_builder import count_cjk
+from llm_service import llm_service
+from admission import Permit
+from model_registry import ModelTarget
+from stream_buffer import StreamBuffer
+from config import (
+    GENERATION_MAX_PER_USER, GENERATION_MAX_ACTIVE,
+    STREAM_BUFFER_MAX_BYTES, STREAM_BUFFER_TTL_SECONDS, STREAM_RESUME_GRACE_SECONDS,
+    STREAM_ATTACH_TIMEOUT_SECONDS
+)
+
+# 清理过期生成的最小间隔（秒）
+_PURGE_INTERVAL = 1.0
+
+
+class GenerationLimitError(Exception):
+    """同时进行的生成数已达上限"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Generation:
+    """
+    一次流式生成
+
+    status: running（进行中）、completed（完成）、failed（失败）、
+    cancelled（通过接口停止或服务关闭）、abandoned（没有连接超过 grace 秒）
+    """
+
+    def __init__(self, user_id: int, session_id: str, model: str, max_bytes: int, grace: float,
+                 attach_timeout: float):
+        self.generation_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.session_id = session_id
+        self.model = model
+        self.status = "running"
+        self.buffer = StreamBuffer(self.generation_id, user_id, max_bytes, grace, attach_timeout)
+        self.chunks = 0
+        self._cjk = 0
+        self._chars = 0
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+
+    def add(self, chunk: str):
+        self.chunks += 1
+        self._cjk += count_cjk(chunk)
+        self._chars += len(chunk)
+
+    @property
+    def tokens(self) -> int:
+        """已输出的估算token数（与 estimate_tokens 的估算方式相同，不含消息开销）"""
+        return self._cjk + (self._chars - self._cjk + 3) // 4
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def info(self) -> Dict:
+        return {
+            "generation_id": self.generation_id,
+            "session_id": self.session_id,
+            "model": self.model,
+            "status": self.status,
+            "chunks": self.chunks,
+            "tokens": self.tokens,
+            "elapsed": round(self.elapsed, 3),
+            "subscribers": self.buffer.subscribers,
+            "last_event_id": self.buffer.last_id
+        }
+
+
+class GenerationManager:
+    """进行中和刚结束的流式生成"""
+
+    def __init__(self, max_per_user: int = GENERATION_MAX_PER_USER, max_active: int = GENERATION_MAX_ACTIVE,
+                 max_bytes: int = STREAM_BUFFER_MAX_BYTES, ttl: float = STREAM_BUFFER_TTL_SECONDS,
+                 grace: float = STREAM_RESUME_GRACE_SECONDS, attach_timeout: float = STREAM_ATTACH_TIMEOUT_SECONDS):
+        self.max_per_user = max_per_user
+        self.max_active = max_active
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.grace = grace
+        self.attach_timeout = attach_timeout
+        # 进行中的生成（包括正在等待上游准入的）
+        self._active: Dict[str, Generation] = {}
+        self._per_user: Dict[int, int] = {}
+        # 已开始的生成（包括结束后仍在保留期内的）
+        self._generations: Dict[str, Generation] = {}
+        self._purged_at = 0.0
+
+        self.started = 0
+        # 按结束状态统计
+        self.outcomes = {"completed": 0, "failed": 0, "cancelled": 0, "abandoned": 0}
+        self.rejected = 0
+        self.resumed = 0
+        self.expired = 0
+
+    async def start(self, user_id: int, session_id: str, user_message: str, temperature: float,
+                    max_tokens: int, target: ModelTarget) -> Generation:
+        """
+        开始一次流式生成
+
+        先检查并发上限，再获取上游准入许可（上游繁忙时直接抛出异常，不会先返回200再在流中报错），
+        然后在后台任务中运行。
+
+        Raises:
+            GenerationLimitError: 用户（429）或进程（503）同时进行的生成数已达上限
+            LLMError: 上游繁忙或全部熔断
+        """
+        self._purge()
+        if len(self._active) >= self.max_active:
+            self.rejected += 1
+            raise GenerationLimitError(f"服务同时进行的生成已达上限（{self.max_active}），请稍后重试", 503)
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            self.rejected += 1
+            raise GenerationLimitError(
+                f"同时进行的生成已达上限（{self.max_per_user}），请等待之前的回复完成或停止生成", 429
+            )
+
+        generation = Generation(user_id, session_id, target.model, self.max_bytes, self.grace,
+                                self.attach_timeout)
+        # 等待准入期间也占用名额，避免同一用户并发请求超出上限
+        self._active[generation.generation_id] = generation
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        try:
+            permit = await llm_service.admit(target, user_id)
+        except BaseException:
+            self._release(generation)
+            raise
+
+        generation.buffer.start(
+            self._run(generation, user_message, temperature, max_tokens, target, permit),
+            cancelled_event={'cancelled': True}
+        )
+        # 生成结束（包括未开始就被停止）时归还许可（重复释放无影响）；
+        # 已转交给合并流上游读取任务的许可由该任务结束时归还（见 llm_service.chat_completion_stream）
+        generation.buffer.add_done_callback(lambda task: self._on_done(generation, task, permit))
+        self._generations[generation.generation_id] = generation
+        self.started += 1
+        return generation
+
+    @staticmethod
+    async def _run(generation: Generation, user_message: str, temperature: float, max_tokens: int,
+                   target: ModelTarget, permit: Permit) -> AsyncGenerator[Dict, None]:
+        """生成过程，输出事件（由 sse_writer 编码为JSON）"""
+        try:
+            # 只在开始时读取上下文，消息由 message_writer 写入
+            async with AsyncSessionLocal() as db:
+                stream = conversation_service.chat_stream(
+                    db=db,
+                    session_id=generation.session_id,
+                    user_message=user_message,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    target=target,
+                    user_id=generation.user_id,
+                    permit=permit
+                )
+                try:
+                    async for chunk in stream:
+                        generation.add(chunk)
+                        yield {'chunk': chunk}
+                finally:
+                    await stream.aclose()
+
+            print(f"[STREAM COMPLETE] Generated {generation.chunks} chunks")
+            generation.status = "completed"
+            # 发送完成信号
+            yield {'done': True}
+
+        except Exception as e:
+            print(f"[STREAM ERROR] {str(e)}")
+            generation.status = "failed"
+            # 发送错误信息
+            yield {'error': str(e)}
+
+    def _on_done(self, generation: Generation, task: asyncio.Task, permit: Permit):
+        permit.release()
+        generation.finished_at = time.monotonic()
+        if task.cancelled() or generation.status == "running":
+            generation.status = "abandoned" if generation.buffer.abandoned else "cancelled"
+        if generation.status == "abandoned":
+            print(f"[GENERATION] 生成 {generation.generation_id} 超过 {self.grace:g}s 没有客户端连接，已停止")
+        self.outcomes[generation.status] += 1
+        self._release(generation)
+
+    def _release(self, generation: Generation):
+        if self._active.pop(generation.generation_id, None) is None:
+            return
+        remaining = self._per_user[generation.user_id] - 1
+        if remaining:
+            self._per_user[generation.user_id] = remaining
+        else:
+            del self._per_user[generation.user_id]
+
+    def get(self, generation_id: str, user_id: int) -> Optional[Generation]:
+        """获取用户的一次生成，不存在、已过期或不属于该用户时返回None"""
+        self._purge()
+        generation = self._generations.get(generation_id)
+        if generation is None or generation.user_id != user_id:
+            return None
+        return generation
+
+    def list_active(self, user_id: int) -> List[Generation]:
+        """用户进行中的生成（按开始时间）"""
+        return sorted(
+            (generation for generation in self._active.values()
+             if generation.user_id == user_id and generation.generation_id in self._generations),
+            key=lambda generation: generation.started_at
+        )
+
+    @staticmethod
+    async def cancel(generation: Generation):
+        """停止生成并等待结束（已生成的部分按截断保存，订阅者收到 cancelled 事件）"""
+        await generation.buffer.cancel()
+
+    def _purge(self):
+        now = time.monotonic()
+        if now - self._purged_at < _PURGE_INTERVAL:
+            return
+        self._purged_at = now
+        expired = [
+            generation_id for generation_id, generation in self._generations.items()
+            if generation.finished_at is not None and now - generation.finished_at > self.ttl
+        ]
+        for generation_id in expired:
+            del self._generations[generation_id]
+        self.expired += len(expired)
+
+    async def shutdown(self):
+        """停止所有进行中的生成（已生成的部分按截断保存）"""
+        await asyncio.gather(*(generation.buffer.cancel() for generation in list(self._generations.values())))
+        self._generations.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "active": len(self._active),
+            "max_active": self.max_active,
+            "max_per_user": self.max_per_user,
+            "users": len(self._per_user),
+            "retained": sum(1 for generation in self._generations.values() if generation.finished_at is not None),
+            "bytes": sum(generation.buffer.nbytes for generation in self._generations.values()),
+            "started": self.started,
+            **self.outcomes,
+            "rejected": self.rejected,
+            "resumed": self.resumed,
+            "expired": self.expired
+        }
+
+
+# 创建全局生成任务管理实例
+generation_manager = GenerationManager()
@@ -0,0 +1,202 @@
+"""
+进程内对话状态LRU缓存：按session_id缓存对话主键、最近消息和token数
+"""
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from config import HISTORY_CACHE_ENABLED, HISTORY_CACHE_MAX_ENTRIES, HISTORY_CACHE_MAX_BYTES, CONTEXT_HISTORY_LIMIT
+
+# 每条缓存消息的固定内存开销估算（字典和字段本身）
+_MESSAGE_OVERHEAD_BYTES = 200
+# 最多记录多少个对话的最近写入序号（超出时丢弃最早的，按丢弃的序号保守判断）
+_WRITTEN_LIMIT = 10000
+
+
+def _message_size(message: Dict) -> int:
+    return len(message["content"].encode("utf-8")) + _MESSAGE_OVERHEAD_BYTES
+
+
+class ConversationState:
+    """
+    一个对话的热数据
+
+    messages 与 load_recent_messages 的结果一致：摘要指针之后最新的
+    CONTEXT_HISTORY_LIMIT 条消息，按时间正序排列。
+    """
+
+    def __init__(self, conversation_id: int, user_id: int, title: str,
+                 summary: Optional[str], summary_until_id: Optional[int], messages: List[Dict]):
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.title = title
+        self.summary = summary
+        self.summary_until_id = summary_until_id or 0
+        self.messages = messages
+        self.nbytes = sum(_message_size(msg) for msg in messages) + len((summary or "").encode("utf-8"))
+
+    def append(self, message: Dict) -> int:
+        """追加一条消息并保持窗口大小，返回占用字节的变化量"""
+        delta = _message_size(message)
+        self.messages.append(message)
+        while len(self.messages) > CONTEXT_HISTORY_LIMIT:
+            delta -= _message_size(self.messages.pop(0))
+        self.nbytes += delta
+        return delta
+
+    def update(self, message_id: int, content: str, token_count: int) -> int:
+        """替换一条消息的内容（不在窗口内时忽略），返回占用字节的变化量"""
+        for message in self.messages:
+            if message["id"] == message_id:
+                delta = len(content.encode("utf-8")) - len(message["content"].encode("utf-8"))
+                message["content"] = content
+                message["token_count"] = token_count
+                self.nbytes += delta
+                return delta
+        return 0
+
+    def apply_summary(self, summary: str, summary_until_id: int) -> int:
+        """摘要推进后丢弃已被覆盖的消息，返回占用字节的变化量"""
+        before = self.nbytes
+        self.summary = summary
+        self.summary_until_id = summary_until_id
+        self.messages = [msg for msg in self.messages if msg["id"] > summary_until_id]
+        self.nbytes = sum(_message_size(msg) for msg in self.messages) + len(summary.encode("utf-8"))
+        return self.nbytes - before
+
+
+class HistoryCache:
+    """
+    按条目数和字节数限制的LRU缓存，由 message_writer 写穿更新
+
+    写穿只更新已缓存的对话；未缓存的对话正在从数据库加载时，加载可能读到提交之前的数据，
+    之后再放入缓存就会覆盖掉这次写入。因此每次写入（提交后立即调用）记录一个递增的写入序号，
+    加载前用 snapshot 取当前序号，put 时该对话在此之后有过写入就不放入缓存（下次请求重新加载）。
+    """
+
+    def __init__(self, max_entries: int = HISTORY_CACHE_MAX_ENTRIES, max_bytes: int = HISTORY_CACHE_MAX_BYTES,
+                 enabled: bool = HISTORY_CACHE_ENABLED):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, ConversationState]" = OrderedDict()
+        self._session_by_conversation: Dict[int, str] = {}
+        self.nbytes = 0
+        # 写入序号：每个对话最近一次写入的序号，超出上限丢弃的记录按 _written_floor 计
+        self._seq = 0
+        self._written: "OrderedDict[str, int]" = OrderedDict()
+        self._written_floor = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_loads = 0
+
+    def get(self, session_id: str) -> Optional[ConversationState]:
+        """获取缓存的对话状态，命中时移到最近使用"""
+        if not self.enabled:
+            return None
+        state = self._entries.get(session_id)
+        if state is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(session_id)
+        self.hits += 1
+        return state
+
+    def snapshot(self) -> int:
+        """当前的写入序号，从数据库加载对话状态之前调用，加载完成后传给 put"""
+        return self._seq
+
+    def _mark_written(self, session_id: str):
+        self._seq += 1
+        self._written[session_id] = self._seq
+        self._written.move_to_end(session_id)
+        while len(self._written) > _WRITTEN_LIMIT:
+            _, self._written_floor = self._written.popitem(last=False)
+
+    def put(self, session_id: str, state: ConversationState, snapshot: Optional[int] = None):
+        """
+        放入对话状态，超出限制时淘汰最久未使用的条目
+
+        Args:
+            snapshot: 开始加载前的写入序号（见 snapshot）；该对话之后有过写入时不放入
+        """
+        if not self.enabled:
+            return
+        if snapshot is not None and self._written.get(session_id, self._written_floor) > snapshot:
+            self.stale_loads += 1
+            return
+        self._drop(session_id)
+        self._entries[session_id] = state
+        self._session_by_conversation[state.conversation_id] = session_id
+        self.nbytes += state.nbytes
+        self._evict()
+
+    def append_message(self, session_id: str, message: Dict):
+        """写穿：消息提交后（下一次 await 之前）追加到缓存（未缓存的对话忽略）"""
+        self._mark_written(session_id)
+        state = self._entries.get(session_id)
+        if state is None:
+            return
+        self.nbytes += state.append(message)
+        self._evict()
+
+    def update_message(self, session_id: str, message_id: int, content: str, token_count: int):
+        """写穿：消息内容更新（流式回复的检查点和最终内容）提交后同步缓存"""
+        self._mark_written(session_id)
+        state = self._entries.get(session_id)
+        if state is None:
+            return
+        self.nbytes += state.update(message_id, content, token_count)
+        self._evict()
+
+    def set_title(self, session_id: str, title: str):
+        self._mark_written(session_id)
+        state = self._entries.get(session_id)
+        if state is not None:
+            state.title = title
+
+    def apply_summary(self, conversation_id: int, summary: str, summary_until_id: int):
+        """摘要更新后同步缓存"""
+        session_id = self._session_by_conversation.get(conversation_id)
+        state = self._entries.get(session_id) if session_id else None
+        if state is not None:
+            self._mark_written(session_id)
+            self.nbytes += state.apply_summary(summary, summary_until_id)
+
+    def invalidate(self, session_id: str):
+        """删除对话或清理时使缓存失效"""
+        self._mark_written(session_id)
+        self._drop(session_id)
+
+    def _drop(self, session_id: str):
+        state = self._entries.pop(session_id, None)
+        if state is not None:
+            self.nbytes -= state.nbytes
+            self._session_by_conversation.pop(state.conversation_id, None)
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.nbytes > self.max_bytes):
+            _, state = self._entries.popitem(last=False)
+            self.nbytes -= state.nbytes
+            self._session_by_conversation.pop(state.conversation_id, None)
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        """命中率等统计信息"""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale_loads": self.stale_loads,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+# 创建全局对话状态缓存
+history_cache = HistoryCache()
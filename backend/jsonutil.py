@@ -0,0 +1,39 @@
+"""
+JSON编解码：安装了 orjson 时使用 orjson，否则回退到标准库 json
+"""
+import json
+
+# orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，调用方统一捕获这个异常即可
+JSONDecodeError = json.JSONDecodeError
+
+try:
+    import orjson
+
+    JSON_BACKEND = "orjson"
+
+    def loads(data):
+        """解析JSON（接受 str 或 UTF-8 bytes）"""
+        return orjson.loads(data)
+
+    def dumps(obj) -> str:
+        """序列化为JSON字符串（非ASCII字符不转义）"""
+        return orjson.dumps(obj).decode("utf-8")
+
+    def dumps_bytes(obj) -> bytes:
+        """序列化为UTF-8编码的JSON"""
+        return orjson.dumps(obj)
+
+except ImportError:
+    JSON_BACKEND = "json"
+
+    def loads(data):
+        """解析JSON（接受 str 或 UTF-8 bytes）"""
+        return json.loads(data)
+
+    def dumps(obj) -> str:
+        """序列化为JSON字符串（非ASCII字符不转义）"""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps_bytes(obj) -> bytes:
+        """序列化为UTF-8编码的JSON"""
+        return dumps(obj).encode("utf-8")
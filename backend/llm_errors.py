@@ -0,0 +1,136 @@
+"""
+大模型调用的异常类型：携带对外的HTTP状态码、是否可重试和建议的重试等待时间
+"""
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+import httpx
+
+
+class LLMError(Exception):
+    """
+    大模型调用失败的基类
+
+    Attributes:
+        status_code: 本服务返回给客户端的HTTP状态码
+        retryable: 在收到任何内容之前失败时是否可以重试
+        failover_only: 只适合换一个副本重试，不适合等待后重试同一个副本
+        retry_after: 建议的重试等待时间（秒），为None时未知
+        upstream_status: 上游返回的HTTP状态码
+    """
+
+    status_code = 502
+    retryable = False
+    failover_only = False
+
+    def __init__(self, message: str, retry_after: Optional[float] = None, upstream_status: Optional[int] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.upstream_status = upstream_status
+
+
+class LLMConfigError(LLMError):
+    """上游拒绝了请求（地址、密钥或参数错误），重试无意义"""
+    status_code = 502
+
+
+class LLMBadResponse(LLMError):
+    """上游返回了无法解析的内容"""
+    status_code = 502
+
+
+class LLMRateLimited(LLMError):
+    """上游限流（429）"""
+    status_code = 429
+    retryable = True
+
+
+class LLMUnavailable(LLMError):
+    """上游暂时不可用（连接失败、连接被断开、5xx）"""
+    status_code = 503
+    retryable = True
+
+
+class LLMTimeout(LLMError):
+    """等待上游响应超时；请求可能已在上游执行，不重试"""
+    status_code = 504
+
+
+class CircuitOpen(LLMUnavailable):
+    """上游连续失败，熔断期间直接拒绝请求"""
+    failover_only = True
+
+
+class UpstreamOverloaded(LLMError):
+    """上游繁忙，请求未被准入（排队已满或等待超时）"""
+    status_code = 503
+    retryable = True
+    failover_only = True
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message, retry_after=retry_after)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析 Retry-After 响应头（秒数或HTTP日期）
+
+    Returns:
+        等待秒数，无法解析时返回None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def from_httpx(error: Exception, include_body: bool = True) -> LLMError:
+    """
+    把 httpx 的异常转换为对应的 LLMError（已经是 LLMError 的原样返回）
+
+    Args:
+        error: 调用上游时抛出的异常
+        include_body: 错误信息中是否带上上游响应体（流式响应未读取响应体时为False）
+    """
+    if isinstance(error, LLMError):
+        return error
+    if isinstance(error, httpx.HTTPStatusError):
+        response = error.response
+        status_code = response.status_code
+        retry_after = parse_retry_after(response.headers.get("retry-after"))
+        if status_code == 404:
+            return LLMConfigError("模型服务不可用 (404)，请检查API地址配置", upstream_status=status_code)
+        elif status_code == 401:
+            return LLMConfigError("模型API密钥认证失败 (401)，请检查API Key配置", upstream_status=status_code)
+        elif status_code == 429:
+            return LLMRateLimited("请求过于频繁 (429)，请稍后重试", retry_after, status_code)
+        elif status_code == 500:
+            return LLMUnavailable("模型服务内部错误 (500)，请稍后重试", retry_after, status_code)
+        elif status_code == 503:
+            return LLMUnavailable("模型服务暂时不可用 (503)，请稍后重试", retry_after, status_code)
+        elif status_code >= 500:
+            return LLMUnavailable(f"模型API调用失败 ({status_code})", retry_after, status_code)
+        elif include_body:
+            return LLMConfigError(f"模型API调用失败 ({status_code}): {response.text[:200]}", upstream_status=status_code)
+        else:
+            return LLMConfigError(f"模型API调用失败 ({status_code})", upstream_status=status_code)
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return LLMUnavailable("无法连接到模型服务，请检查API地址和网络连接")
+    if isinstance(error, httpx.TimeoutException):
+        return LLMTimeout("模型响应超时，请检查网络连接或稍后重试")
+    if isinstance(error, httpx.TransportError):
+        # 连接被上游断开等，请求尚未得到响应
+        return LLMUnavailable(f"模型服务连接中断: {type(error).__name__}")
+    return LLMBadResponse(f"调用模型服务时出错: {str(error)}")
+
+
+def is_upstream_failure(error: Exception) -> bool:
+    """连接失败、超时、5xx说明副本本身有问题，计入熔断；429和4xx不计入"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
@@ -1,170 +1,542 @@
 """
 大模型API调用服务
 """
-import httpx
-import json
-from typing import List, Dict, AsyncGenerator
-from config import LLM_API_URL, LLM_MODEL, LLM_API_KEY
+import asyncio
+import time
+from typing import List, Dict, AsyncGenerator, Optional, Set
+from model_registry import ModelTarget, PRESET_MODELS, default_target, preset_target
+from upstream import Upstream, upstream_registry
+from load_balancer import Endpoint, EndpointGroup, load_balancer
+from admission import Permit
+from llm_errors import LLMError, LLMBadResponse, CircuitOpen, UpstreamOverloaded, from_httpx, is_upstream_failure
+from resilience import RetryPolicy
+from response_cache import response_cache, replay, reusable, shareable
+from singleflight import singleflight
+from similarity_cache import similarity_cache
+from sse_parser import aiter_sse
+import jsonutil
 
 
 class LLMService:
     """大模型服务类"""
 
     def __init__(self):
-        self.api_url = LLM_API_URL
-        self.model = LLM_MODEL
-        self.api_key = LLM_API_KEY
+        # 未指定模型目标时使用的默认目标（环境变量配置）
+        self.default_target = default_target()
+        # 每个上游地址独立的连接池、限额和指标
+        self.registry = upstream_registry
+        # 同一模型多个副本之间的负载均衡
+        self.balancer = load_balancer
+        # 收到内容之前失败时的重试策略
+        self.retry_policy = RetryPolicy()
+        # 确定性请求的回复缓存
+        self.response_cache = response_cache
+        # 同时进行的相同请求合并
+        self.singleflight = singleflight
+        # 近似重复提示缓存（回复缓存的第二层）
+        self.similarity_cache = similarity_cache
 
-    async def chat_completion(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 2000) -> str:
+    async def startup(self):
+        """应用启动时预先创建默认上游和预设模型上游的连接池，启动副本健康检查并打开回复缓存"""
+        self.balancer.group(self.default_target)
+        for model_type in PRESET_MODELS:
+            self.balancer.group(preset_target(model_type))
+        self.balancer.start()
+        await self.response_cache.startup()
+
+    async def shutdown(self):
+        """应用关闭时停止健康检查，关闭回复缓存并释放所有上游连接"""
+        await self.balancer.shutdown()
+        await self.response_cache.shutdown()
+        await self.registry.close_all()
+
+    def get_pool_stats(self) -> Dict[str, Dict]:
         """
-        调用大模型API进行对话（非流式）
+        获取各上游连接池的占用情况
+
+        Returns:
+            以上游地址为键的统计信息，包含连接数、空闲连接数和在途请求数
+        """
+        return self.registry.stats()
+
+    async def admit(self, target: Optional[ModelTarget] = None, user_id: Optional[int] = None) -> Permit:
+        """
+        为本次请求选择副本并获取准入许可
+
+        流式接口在开始发送响应前调用，上游繁忙或全部熔断时可以直接返回503，
+        拿到的许可传给 chat_completion_stream，流结束时释放。
 
         Args:
-            messages: 消息列表，格式为 [{"role": "user", "content": "..."}]
-            temperature: 温度参数，控制生成的随机性
-            max_tokens: 最大生成token数
+            target: 模型目标，为None时使用默认目标
+            user_id: 用户ID，用于排队时按用户轮转
 
-        Returns:
-            大模型生成的回复内容
+        Raises:
+            UpstreamOverloaded: 所有可用副本都排队已满或等待超时
+            CircuitOpen: 所有副本都已熔断
         """
+        target = target or self.default_target
+        group = self.balancer.group(target)
+        tried: Set[str] = set()
+        overloaded: Optional[UpstreamOverloaded] = None
+        while True:
+            endpoint = group.choose(tried)
+            if endpoint is None:
+                if overloaded is not None:
+                    raise overloaded
+                raise self._circuit_open(group)
+            tried.add(endpoint.url)
+            try:
+                return await endpoint.upstream.admission.acquire(user_id)
+            except UpstreamOverloaded as e:
+                overloaded = e
+
+    @staticmethod
+    def _build_request(target: ModelTarget, messages: List[Dict[str, str]], temperature: float, max_tokens: int, stream: bool):
+        """构建请求头和请求体"""
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
+            "Authorization": f"Bearer {target.api_key}"
         }
-
         payload = {
-            "model": self.model,
+            "model": target.model,
             "messages": messages,
             "temperature": temperature,
             "max_tokens": max_tokens,
-            "stream": False
+            "stream": stream
         }
+        return headers, payload
+
+    @staticmethod
+    def _parse_stream_event(raw: bytes) -> List[Optional[Dict]]:
+        """
+        解析一个SSE事件的data
+
+        Returns:
+            JSON对象列表，遇到结束标记 [DONE] 时以 None 结尾；无法解析的数据被忽略
+        """
+        if raw == b"[DONE]":
+            return [None]
+        try:
+            return [jsonutil.loads(raw)]
+        except jsonutil.JSONDecodeError:
+            if b"\n" not in raw:
+                return []
 
-        async with httpx.AsyncClient(timeout=60.0) as client:
+        # 个别上游的 data 行之间没有空行分隔，会被合并成一个多行事件，这里逐行解析
+        payloads = []
+        for line in raw.split(b"\n"):
+            if line == b"[DONE]":
+                payloads.append(None)
+                break
             try:
-                response = await client.post(self.api_url, json=payload, headers=headers)
-                response.raise_for_status()
+                payloads.append(jsonutil.loads(line))
+            except jsonutil.JSONDecodeError:
+                continue
+        return payloads
+
+    @staticmethod
+    def _delta_content(chunk_data) -> str:
+        """提取流式响应片段中的增量文本"""
+        if not isinstance(chunk_data, dict):
+            return ""
+        choices = chunk_data.get("choices")
+        if not choices:
+            return ""
+        delta = choices[0].get("delta") or {}
+        return delta.get("content") or ""
+
+    @staticmethod
+    def _circuit_open(group: EndpointGroup) -> CircuitOpen:
+        """所有副本都熔断：计入各副本的拒绝次数"""
+        for endpoint in group.endpoints:
+            endpoint.upstream.breaker.rejected += 1
+        return CircuitOpen("模型服务连续失败，已暂停请求，请稍后重试", retry_after=group.retry_after())
+
+    def _pick(self, group: EndpointGroup, tried: Set[str]) -> Endpoint:
+        """优先选择本次请求还没有尝试过的副本，都尝试过后再从可用副本中选择；全部熔断时抛出 CircuitOpen"""
+        endpoint = group.choose(tried) or group.choose()
+        if endpoint is None:
+            raise self._circuit_open(group)
+        return endpoint
+
+    @staticmethod
+    def _check_breaker(upstream: Upstream):
+        """熔断期间直接失败，不再等待连接或响应超时"""
+        if not upstream.breaker.allow():
+            raise CircuitOpen("模型服务连续失败，已暂停请求，请稍后重试", retry_after=upstream.breaker.retry_after())
+
+    async def _should_retry(self, group: EndpointGroup, tried: Set[str], retry: int, error: LLMError) -> bool:
+        """
+        按重试策略决定是否重试，需要时等待
+
+        Args:
+            group: 副本组
+            tried: 本次请求已尝试过的副本
+            retry: 即将进行的是第几次重试（从1开始）
+            error: 上一次尝试的错误
+
+        Returns:
+            是否继续重试
+        """
+        if not error.retryable:
+            return False
+        now = time.monotonic()
+        switching = any(
+            endpoint.url not in tried and endpoint.upstream.available(now) for endpoint in group.endpoints
+        )
+        delay = self.retry_policy.next_delay(retry, error, switching)
+        self.retry_policy.record(delay)
+        if delay is None:
+            return False
+        if switching:
+            group.failovers += 1
+            print(f"[LLM RETRY] 第{retry}次重试（{type(error).__name__}: {error}），切换到其他副本")
+        else:
+            print(f"[LLM RETRY] 第{retry}次重试（{type(error).__name__}: {error}），等待 {delay:.2f} 秒")
+        if delay:
+            await asyncio.sleep(delay)
+        return True
+
+    async def chat_completion(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 2000,
+                              target: Optional[ModelTarget] = None, user_id: Optional[int] = None,
+                              cache: Optional[bool] = None, scope: Optional[int] = None) -> str:
+        """
+        调用大模型API进行对话（非流式）
+
+        模型有多个副本时按负载选择副本；连接失败、429、5xx 等可重试的错误优先换一个副本重试，
+        没有其他副本时按退避时间（或上游的 Retry-After）等待后重试，总重试次数有上限。
+        模型开启对冲时，慢请求会在额度内向另一个副本重复发送（见 _complete_hedged）。
+        开启回复缓存时，确定性请求先查缓存（精确匹配，再按最后一条用户消息近似匹配），成功的回复写入缓存；
+        同时进行的相同确定性请求只向上游发送一次（见 singleflight）。
 
-                result = response.json()
-                # 提取生成的回复内容
-                if "choices" in result and len(result["choices"]) > 0:
-                    return result["choices"][0]["message"]["content"]
-                else:
-                    raise Exception("API返回格式异常")
-
-            except httpx.HTTPStatusError as e:
-                status_code = e.response.status_code
-                if status_code == 404:
-                    raise Exception(f"模型服务不可用 (404)，请检查API地址配置")
-                elif status_code == 401:
-                    raise Exception(f"模型API密钥认证失败 (401)，请检查API Key配置")
-                elif status_code == 429:
-                    raise Exception(f"请求过于频繁 (429)，请稍后重试")
-                elif status_code == 500:
-                    raise Exception(f"模型服务内部错误 (500)，请稍后重试")
-                elif status_code == 503:
-                    raise Exception(f"模型服务暂时不可用 (503)，请稍后重试")
-                else:
-                    raise Exception(f"模型API调用失败 ({status_code}): {e.response.text[:200]}")
-            except httpx.TimeoutException:
-                raise Exception(f"模型响应超时，请检查网络连接或稍后重试")
-            except httpx.ConnectError:
-                raise Exception(f"无法连接到模型服务，请检查API地址和网络连接")
+        Args:
+            messages: 消息列表，格式为 [{"role": "user", "content": "..."}]
+            temperature: 温度参数，控制生成的随机性
+            max_tokens: 最大生成token数
+            target: 模型目标，为None时使用默认目标
+            user_id: 用户ID，上游繁忙排队时按用户轮转，为None时归入后台任务
+            cache: 是否复用结果（缓存和合并），None 时只复用 temperature 为0的请求（见 response_cache.reusable）
+            scope: 复用的范围，None 为跨用户共享，否则为用户ID（见 response_cache.cache_scope）
+
+        Returns:
+            大模型生成的回复内容
+
+        Raises:
+            LLMError: 调用失败（子类对应不同的HTTP状态码，见 llm_errors）
+        """
+        target = target or self.default_target
+        key = self._reuse_key(target, messages, temperature, max_tokens, cache, scope)
+        if key is None:
+            return await self._complete_with_retries(target, messages, temperature, max_tokens, user_id)
+        context = self._similarity_context(target, messages, temperature, max_tokens, scope)
+        cached = await self._cached_reply(key, context, messages)
+        if cached is not None:
+            return cached
+
+        def complete():
+            return self._complete_and_store(key, context, target, messages, temperature, max_tokens, user_id)
+
+        if self.singleflight.enabled:
+            return await self.singleflight.do(key, complete)
+        return await complete()
+
+    def _reuse_key(self, target: ModelTarget, messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+                   cache: Optional[bool], scope: Optional[int]) -> Optional[str]:
+        """
+        可以复用结果（缓存或合并）的请求返回请求键，否则返回None
+
+        不信任调用方传入的范围：带有历史或系统提示的请求没有按用户隔离（scope 为None）时不复用，
+        避免一个用户的私有内容生成的回复返回给其他用户（见 response_cache.cache_scope）。
+        """
+        if not reusable(temperature, cache) or not (
+                self.response_cache.enabled or self.singleflight.enabled or self.similarity_cache.enabled):
+            return None
+        if scope is None and not shareable(messages):
+            return None
+        return self.response_cache.make_key(target, messages, temperature, max_tokens, scope)
+
+    def _similarity_context(self, target: ModelTarget, messages: List[Dict[str, str]], temperature: float,
+                            max_tokens: int, scope: Optional[int]) -> Optional[int]:
+        """
+        近似匹配的上下文哈希（最后一条用户消息之前的内容和生成参数），不适用时返回None
+
+        近似命中会把别人的回复返回给措辞不同的问题，不依赖调用方：没有按用户隔离（scope 为None）时
+        只允许只有当前这一条用户消息的请求（见 response_cache.cache_scope）。
+        """
+        if not self.similarity_cache.enabled or not messages or messages[-1]["role"] != "user":
+            return None
+        if scope is None and not shareable(messages):
+            return None
+        return self.similarity_cache.context_hash(
+            self.response_cache.make_key(target, messages[:-1], temperature, max_tokens, scope)
+        )
+
+    async def _cached_reply(self, key: str, context: Optional[int], messages: List[Dict[str, str]]) -> Optional[str]:
+        """依次查询精确匹配和近似匹配的缓存"""
+        if self.response_cache.enabled:
+            cached = await self.response_cache.get(key)
+            if cached is not None:
+                return cached
+        if context is not None:
+            return self.similarity_cache.get(context, messages[-1]["content"])
+        return None
+
+    async def _store_reply(self, key: str, context: Optional[int], messages: List[Dict[str, str]], reply: str):
+        """把上游的回复写入精确匹配和近似匹配的缓存"""
+        if self.response_cache.enabled:
+            await self.response_cache.put(key, reply)
+        if context is not None:
+            self.similarity_cache.put(context, messages[-1]["content"], reply)
+
+    async def _complete_and_store(self, key: str, context: Optional[int], target: ModelTarget,
+                                  messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+                                  user_id: Optional[int]) -> str:
+        """请求上游并把回复写入缓存"""
+        reply = await self._complete_with_retries(target, messages, temperature, max_tokens, user_id)
+        await self._store_reply(key, context, messages, reply)
+        return reply
+
+    async def _complete_with_retries(self, target: ModelTarget, messages: List[Dict[str, str]], temperature: float,
+                                     max_tokens: int, user_id: Optional[int]) -> str:
+        """选择副本发送非流式请求，可重试的失败按重试策略换副本或等待后重试"""
+        headers, payload = self._build_request(target, messages, temperature, max_tokens, stream=False)
+
+        group = self.balancer.group(target)
+        tried: Set[str] = set()
+        retry = 0
+        while True:
+            endpoint = self._pick(group, tried)
+            tried.add(endpoint.url)
+            try:
+                return await self._complete_hedged(group, endpoint, tried, headers, payload, user_id)
+            except LLMError as error:
+                retry += 1
+                if not await self._should_retry(group, tried, retry, error):
+                    raise
+
+    async def _complete_hedged(self, group: EndpointGroup, endpoint: Endpoint, tried: Set[str],
+                               headers: Dict, payload: Dict, user_id: Optional[int]) -> str:
+        """
+        发送一次非流式请求，开启对冲时超过近期延迟分位数仍未返回则向另一个副本再发送一次
+
+        先成功返回的结果胜出，另一个请求被取消；两个都失败时抛出后失败的错误，交给重试逻辑处理。
+        """
+        hedge = group.hedge
+        started = time.monotonic()
+        delay = hedge.begin() if len(group.endpoints) > 1 else None
+        if delay is None:
+            result = await self._complete_once(endpoint, headers, payload, user_id)
+            hedge.record_latency(time.monotonic() - started)
+            return result
+
+        primary = asyncio.create_task(self._complete_once(endpoint, headers, payload, user_id))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                backup = group.choose(tried)
+                if backup is not None and hedge.try_acquire():
+                    tried.add(backup.url)
+                    print(f"[LLM HEDGE] {delay * 1000:.0f}ms 内未返回，向 {backup.url} 发送对冲请求")
+                    pending.add(asyncio.create_task(self._complete_once(backup, headers, payload, user_id)))
+
+            error = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        hedge.record_latency(time.monotonic() - started)
+                        if task is not primary:
+                            hedge.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # 取消落后的请求（或调用方被取消时取消全部），归还其准入许可
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _complete_once(self, endpoint: Endpoint, headers: Dict, payload: Dict, user_id: Optional[int]) -> str:
+        """向一个副本发送一次非流式请求"""
+        upstream = endpoint.upstream
+        permit = await upstream.admission.acquire(user_id)
+        try:
+            self._check_breaker(upstream)
+            upstream.begin()
+            failed = False
+            latency = None
+            started = time.monotonic()
+            try:
+                response = await upstream.get_client().post(endpoint.url, json=payload, headers=headers, timeout=60.0)
+                latency = time.monotonic() - started
+                response.raise_for_status()
+                result = jsonutil.loads(response.content)
             except Exception as e:
-                raise Exception(f"调用模型服务时出错: {str(e)}")
+                # 只用成功请求的延迟做负载均衡，429等快速失败不能拉低延迟估计
+                failed, latency = is_upstream_failure(e), None
+                raise from_httpx(e) from e
+            finally:
+                upstream.end(error=failed, latency=latency)
+        finally:
+            permit.release()
 
-    async def chat_completion_stream(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 2000) -> AsyncGenerator[str, None]:
+        # 提取生成的回复内容
+        if "choices" in result and len(result["choices"]) > 0:
+            return result["choices"][0]["message"]["content"]
+        raise LLMBadResponse("调用模型服务时出错: API返回格式异常")
+
+    async def chat_completion_stream(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 2000,
+                                     target: Optional[ModelTarget] = None, user_id: Optional[int] = None,
+                                     permit: Optional[Permit] = None, cache: Optional[bool] = None,
+                                     scope: Optional[int] = None) -> AsyncGenerator[str, None]:
         """
         调用大模型API进行流式对话
 
+        在收到第一段内容之前失败时按与非流式相同的策略重试（换副本或退避等待），
+        已经输出内容后失败则直接报错，避免重复输出。
+        缓存命中时不请求上游，把缓存的回复切片回放；完整结束的流写入缓存。
+        相同的确定性流正在进行时加入它：先回放已收到的片段，再跟随实时片段。
+
         Args:
             messages: 消息列表，格式为 [{"role": "user", "content": "..."}]
             temperature: 温度参数，控制生成的随机性
             max_tokens: 最大生成token数
+            target: 模型目标，为None时使用默认目标
+            user_id: 用户ID，上游繁忙排队时按用户轮转，为None时归入后台任务
+            permit: 通过 admit 预先获取的准入许可（决定首个副本），为None时在此处选择副本；流结束时释放
+                （合并流的许可转交给上游读取任务，读取结束时释放）
+            cache: 是否复用结果（同 chat_completion）
+            scope: 复用的范围（同 chat_completion）
 
         Yields:
             逐步生成的文本片段
+
+        Raises:
+            LLMError: 调用失败（子类对应不同的HTTP状态码，见 llm_errors）
         """
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        target = target or self.default_target
+        key = self._reuse_key(target, messages, temperature, max_tokens, cache, scope)
+        context = None
+        if key is not None:
+            context = self._similarity_context(target, messages, temperature, max_tokens, scope)
+            cached = await self._cached_reply(key, context, messages)
+            if cached is not None:
+                # 不需要上游，立即归还预先获取的许可
+                if permit is not None:
+                    permit.release()
+                async for piece in replay(cached):
+                    yield piece
+                return
 
-        payload = {
-            "model": self.model,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "stream": True
-        }
+        if key is None:
+            stream = self._stream_with_retries(target, messages, temperature, max_tokens, user_id, permit)
+        elif self.singleflight.enabled:
+            # 上游读取在独立任务中运行，发起者结束后可能还在为其他订阅者读取：
+            # 许可转交给上游读取任务，读取结束时才归还，而不是随发起者一起释放
+            flight_permit = permit.transfer() if permit is not None else None
+            stream, joined = self.singleflight.stream(
+                key,
+                lambda: self._stream_and_store(key, context, target, messages, temperature, max_tokens, user_id, flight_permit),
+                on_done=flight_permit.release if flight_permit is not None else None
+            )
+            if joined and flight_permit is not None:
+                # 加入已有的流，不占用上游
+                flight_permit.release()
+        else:
+            stream = self._stream_and_store(key, context, target, messages, temperature, max_tokens, user_id, permit)
+        try:
+            async for piece in stream:
+                yield piece
+        finally:
+            await stream.aclose()
+
+    async def _stream_and_store(self, key: str, context: Optional[int], target: ModelTarget,
+                                messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+                                user_id: Optional[int], permit: Optional[Permit]) -> AsyncGenerator[str, None]:
+        """请求上游流式回复，完整结束后把回复写入缓存"""
+        stream = self._stream_with_retries(target, messages, temperature, max_tokens, user_id, permit)
+        parts = []
+        try:
+            async for piece in stream:
+                parts.append(piece)
+                yield piece
+        finally:
+            await stream.aclose()
+        await self._store_reply(key, context, messages, "".join(parts))
+
+    async def _stream_with_retries(self, target: ModelTarget, messages: List[Dict[str, str]], temperature: float,
+                                   max_tokens: int, user_id: Optional[int],
+                                   permit: Optional[Permit]) -> AsyncGenerator[str, None]:
+        """选择副本发送流式请求，收到内容之前的可重试失败按重试策略换副本或等待后重试"""
+        headers, payload = self._build_request(target, messages, temperature, max_tokens, stream=True)
 
-        print(f"[LLM REQUEST] URL: {self.api_url}")
-        print(f"[LLM REQUEST] Model: {self.model}")
+        print(f"[LLM REQUEST] URL: {target.api_url}")
+        print(f"[LLM REQUEST] Model: {target.model}")
         print(f"[LLM REQUEST] Messages count: {len(messages)}")
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
+        group = self.balancer.group(target)
+        endpoint = group.find(permit.key) if permit is not None else None
+        if endpoint is None and permit is not None:
+            permit.release()
+            permit = None
+        tried: Set[str] = set()
+        retry = 0
+        while True:
+            if endpoint is None:
+                endpoint = self._pick(group, tried)
+            tried.add(endpoint.url)
+            upstream = endpoint.upstream
+            yielded = False
+            error = None
             try:
-                async with client.stream("POST", self.api_url, json=payload, headers=headers) as response:
-                    if response.status_code != 200:
-                        error_text = await response.aread()
-                        print(f"[LLM ERROR] Status: {response.status_code}, Body: {error_text.decode()[:200]}")
-                    response.raise_for_status()
-
-                    buffer = ""
-                    async for chunk in response.aiter_bytes():
-                        buffer += chunk.decode('utf-8', errors='ignore')
-
-                        # 按行分割
-                        while '\n' in buffer:
-                            line, buffer = buffer.split('\n', 1)
-                            line = line.strip()
-
-                            if not line:
-                                continue
-
-                            # 处理SSE格式: data: {...}
-                            if line.startswith("data: "):
-                                data = line[6:].strip()
-
-                                # 检查是否是结束标记
-                                if data == "[DONE]":
+                if permit is None:
+                    permit = await upstream.admission.acquire(user_id)
+                self._check_breaker(upstream)
+                upstream.begin()
+                failed = False
+                latency = None
+                started = time.monotonic()
+                try:
+                    async with upstream.get_client().stream("POST", endpoint.url, json=payload, headers=headers, timeout=120.0) as response:
+                        latency = time.monotonic() - started
+                        if response.status_code != 200:
+                            error_text = await response.aread()
+                            print(f"[LLM ERROR] Status: {response.status_code}, Body: {error_text.decode()[:200]}")
+                        response.raise_for_status()
+
+                        # 字节级增量解析，行边界不会切断多字节字符
+                        async for event in aiter_sse(response.aiter_bytes()):
+                            for chunk_data in self._parse_stream_event(event.raw):
+                                # None 表示结束标记 [DONE]
+                                if chunk_data is None:
                                     return
+                                content = self._delta_content(chunk_data)
+                                if content:
+                                    yielded = True
+                                    yield content
+                    return
+                except Exception as e:
+                    failed, latency = is_upstream_failure(e), None
+                    raise from_httpx(e, include_body=False) from e
+                finally:
+                    upstream.end(error=failed, latency=latency)
+            except LLMError as e:
+                if yielded:
+                    raise
+                error = e
+            finally:
+                # 等待重试之前先归还许可
+                if permit is not None:
+                    permit.release()
+                    permit = None
 
-                                try:
-                                    chunk_data = json.loads(data)
-
-                                    # 提取内容
-                                    if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
-                                        delta = chunk_data["choices"][0].get("delta", {})
-                                        content = delta.get("content", "")
-
-                                        if content:
-                                            yield content
-
-                                except json.JSONDecodeError as e:
-                                    # 忽略JSON解析错误，继续处理下一行
-                                    continue
-
-            except httpx.HTTPStatusError as e:
-                status_code = e.response.status_code
-                if status_code == 404:
-                    raise Exception(f"模型服务不可用 (404)，请检查API地址配置")
-                elif status_code == 401:
-                    raise Exception(f"模型API密钥认证失败 (401)，请检查API Key配置")
-                elif status_code == 429:
-                    raise Exception(f"请求过于频繁 (429)，请稍后重试")
-                elif status_code == 500:
-                    raise Exception(f"模型服务内部错误 (500)，请稍后重试")
-                elif status_code == 503:
-                    raise Exception(f"模型服务暂时不可用 (503)，请稍后重试")
-                else:
-                    raise Exception(f"模型API调用失败 ({status_code})")
-            except httpx.TimeoutException:
-                raise Exception(f"模型响应超时，请检查网络连接或稍后重试")
-            except httpx.ConnectError:
-                raise Exception(f"无法连接到模型服务，请检查API地址和网络连接")
-            except Exception as e:
-                raise Exception(f"调用模型服务时出错: {str(e)}")
+            retry += 1
+            if not await self._should_retry(group, tried, retry, error):
+                raise error
+            endpoint = None
 
 
 # 创建全局LLM服务实例
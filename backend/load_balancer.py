@@ -0,0 +1,187 @@
+"""
+多副本负载均衡：按在途请求数和延迟选择副本，主动健康检查和被动熔断
+"""
+import asyncio
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+from model_registry import ModelTarget
+from upstream import Upstream, UpstreamRegistry, upstream_registry
+from resilience import HedgePolicy
+from config import LLM_HEALTH_CHECK_INTERVAL, LLM_HEALTH_CHECK_PATH, LLM_HEALTH_CHECK_TIMEOUT
+
+# 还没有延迟数据的副本按该值（秒）估算，让新副本也能分到请求
+_DEFAULT_LATENCY = 1.0
+
+
+class Endpoint:
+    """一个副本：完整的接口地址和对应的上游"""
+
+    __slots__ = ("url", "upstream")
+
+    def __init__(self, url: str, upstream: Upstream):
+        self.url = url
+        self.upstream = upstream
+
+    def score(self) -> float:
+        """越小越优先：(已准入和排队的请求数 + 1) × 首字节延迟EWMA"""
+        latency = self.upstream.latency_ewma if self.upstream.latency_ewma is not None else _DEFAULT_LATENCY
+        return (self.upstream.outstanding() + 1) * latency
+
+
+class EndpointGroup:
+    """同一模型的一组副本"""
+
+    def __init__(self, endpoints: List[Endpoint], hedge: Optional[HedgePolicy] = None):
+        self.endpoints = endpoints
+        self.hedge = hedge or HedgePolicy()
+        self.selections: Dict[str, int] = {endpoint.url: 0 for endpoint in endpoints}
+        self.failovers = 0
+
+    def choose(self, exclude: Iterable[str] = ()) -> Optional[Endpoint]:
+        """
+        选择一个副本
+
+        在熔断器未打开的副本中，优先选择在途请求未满的，再按得分选择最低的。
+
+        Args:
+            exclude: 本次请求已经尝试过的副本地址
+
+        Returns:
+            副本，没有可用副本（都已尝试过或都已熔断）时返回None
+        """
+        now = time.monotonic()
+        healthy = [
+            endpoint for endpoint in self.endpoints
+            if endpoint.url not in exclude and endpoint.upstream.available(now)
+        ]
+        if not healthy:
+            return None
+
+        idle = [endpoint for endpoint in healthy if not endpoint.upstream.admission.full]
+        chosen = min(idle or healthy, key=Endpoint.score)
+        self.selections[chosen.url] += 1
+        return chosen
+
+    def retry_after(self) -> float:
+        """所有副本都熔断时，最早恢复的剩余时间（秒）"""
+        return min(endpoint.upstream.breaker.retry_after() for endpoint in self.endpoints)
+
+    def find(self, key: str) -> Optional[Endpoint]:
+        """按上游标识（scheme://host:port）查找副本"""
+        return next((endpoint for endpoint in self.endpoints if endpoint.upstream.key == key), None)
+
+    def stats(self) -> Dict:
+        return {
+            "endpoints": [endpoint.url for endpoint in self.endpoints],
+            "selections": dict(self.selections),
+            "failovers": self.failovers,
+            "hedge": self.hedge.stats()
+        }
+
+
+def health_check_url(url: str) -> str:
+    """由接口地址推导健康检查地址（同一 scheme://host:port 下的 LLM_HEALTH_CHECK_PATH）"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}{LLM_HEALTH_CHECK_PATH}"
+
+
+class LoadBalancer:
+    """
+    按模型维护副本组并定期做主动健康检查
+
+    - 选择：在途请求数 × 延迟EWMA 最小的副本
+    - 被动熔断：连续失败达到 LLM_BREAKER_FAILURES 次后熔断一段时间（见 resilience.CircuitBreaker）
+    - 主动检查：定期请求有多个副本的模型的健康检查地址，失败则熔断，成功则恢复
+    - 对冲：每个副本组有独立的对冲策略（见 resilience.HedgePolicy），按模型目标的 hedge_* 设置创建
+    """
+
+    def __init__(self, registry: UpstreamRegistry = upstream_registry, interval: float = LLM_HEALTH_CHECK_INTERVAL):
+        self.registry = registry
+        self.interval = interval
+        self._groups: Dict[Tuple[str, ...], EndpointGroup] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        self.probes = 0
+        self.probe_failures = 0
+
+    def group(self, target: ModelTarget) -> EndpointGroup:
+        """获取（必要时创建）模型目标的副本组"""
+        urls = target.endpoints
+        group = self._groups.get(urls)
+        if group is None:
+            hedge = HedgePolicy()
+            if target.hedge_percentile is not None:
+                hedge.percentile = target.hedge_percentile
+            if target.hedge_budget is not None:
+                hedge.budget = target.hedge_budget
+            group = EndpointGroup([
+                Endpoint(url, self.registry.get(url, target.max_connections, target.max_in_flight))
+                for url in urls
+            ], hedge)
+            self._groups[urls] = group
+        return group
+
+    def start(self):
+        """启动主动健康检查（需在事件循环中调用）"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def shutdown(self):
+        """停止健康检查"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.probe_all()
+            except Exception as e:
+                print(f"[LLM POOL] 健康检查出错: {str(e)}")
+
+    async def probe_all(self):
+        """检查所有多副本模型的副本（同一上游只检查一次）"""
+        endpoints = {}
+        for group in self._groups.values():
+            if len(group.endpoints) > 1:
+                for endpoint in group.endpoints:
+                    endpoints.setdefault(endpoint.upstream.key, endpoint)
+        await asyncio.gather(*(self.probe(endpoint) for endpoint in endpoints.values()))
+
+    async def probe(self, endpoint: Endpoint) -> bool:
+        """
+        请求一次健康检查地址，返回非5xx即视为健康
+
+        Returns:
+            是否健康
+        """
+        self.probes += 1
+        upstream = endpoint.upstream
+        try:
+            response = await upstream.get_client().get(
+                health_check_url(endpoint.url), timeout=LLM_HEALTH_CHECK_TIMEOUT
+            )
+            healthy = response.status_code < 500
+        except Exception:
+            healthy = False
+
+        if healthy:
+            if upstream.breaker.state != upstream.breaker.CLOSED:
+                upstream.breaker.close()
+        else:
+            self.probe_failures += 1
+            if upstream.breaker.state == upstream.breaker.CLOSED:
+                # 主动检查失败时熔断到下一次检查为止
+                upstream.breaker.trip(self.interval)
+        return healthy
+
+    def stats(self) -> Dict[str, Dict]:
+        """以模型的首个副本地址为键的副本组统计"""
+        return {urls[0]: group.stats() for urls, group in self._groups.items() if len(urls) > 1}
+
+
+# 创建全局负载均衡实例
+load_balancer = LoadBalancer()
@@ -1,21 +1,35 @@
 """
 FastAPI主应用和路由
 """
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from typing import Optional, List, Dict
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
 import os
-import json
+import math
 
-from database import get_db, init_db, UserConfig, User
+from database import get_async_db, init_db, dispose_engines, UserConfig, User
 from conversation_service import conversation_service
-from config import HOST, PORT
+from llm_service import llm_service
+from llm_errors import LLMError
+from summarizer import conversation_summarizer
+from history_cache import history_cache
+from retention import retention_worker
+from title_worker import title_worker
+from message_writer import message_writer
+import reply_checkpoint
+from stream_control import DisconnectGuard, stream_stats
+from stream_buffer import StreamBuffer, StreamGapError
+from generation_manager import generation_manager, GenerationLimitError
+from sse_writer import SSEEncoder, accepts_gzip, sse_stats
+from model_registry import PRESET_MODELS, DEFAULT_MODEL_TYPE, resolve_model_target
+from config import HOST, PORT, SSE_FLUSH_INTERVAL_MS, SSE_FLUSH_BYTES, SSE_GZIP
 from auth import (
     get_password_hash,
     authenticate_user,
@@ -39,6 +53,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 前端读取生成ID以便断线后重新连接
+    expose_headers=["X-Generation-Id"],
 )
 
 
@@ -75,6 +91,7 @@ class ConfigResponse(BaseModel):
     preset_models: List[Dict[str, str]]  # 预设模型列表
     current_model_type: str  # 当前使用的模型类型：codegeex/glm/custom
     max_tokens: int  # 最大输出token数
+    max_conversations: Optional[int] = None  # 用户单独设置的对话保留数量
 
 
 class ConfigUpdateRequest(BaseModel):
@@ -84,6 +101,7 @@ class ConfigUpdateRequest(BaseModel):
     llm_model: Optional[str] = None  # 仅custom时需要
     llm_api_key: Optional[str] = None  # 仅custom时需要
     max_tokens: Optional[int] = None  # 最大输出token数
+    max_conversations: Optional[int] = None  # 保留的对话数上限，0表示恢复系统默认，不传则不修改
 
 
 # 认证相关模型
@@ -117,26 +135,33 @@ class UserResponse(BaseModel):
 async def startup_event():
     init_db()
     print("数据库初始化完成")
+    # 上次退出时仍在生成的回复保留已保存的部分，标记为中断
+    await message_writer.mark_interrupted()
+    await llm_service.startup()
+    print("LLM连接池初始化完成")
+    retention_worker.start()
+    title_worker.start()
+    message_writer.start()
+
+
+# 关闭事件：释放上游连接
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 先停止进行中的生成（已生成的部分按截断保存），等待这些部分回复进入写入队列
+    await generation_manager.shutdown()
+    await reply_checkpoint.drain()
+    await retention_worker.shutdown()
+    await title_worker.shutdown()
+    await conversation_summarizer.shutdown()
+    await llm_service.shutdown()
+    print("LLM连接池已关闭")
+    # 关闭数据库连接前提交队列中的消息
+    await message_writer.shutdown()
+    await dispose_engines()
 
 
-# 预设模型配置
-PRESET_MODELS = {
-    "codegeex": {
-        "name": "CodeGeex",
-        "url": "http://111.19.168.151:11551/v1/chat/completions",
-        "model": "codegeex4-all-9b",
-        "key": "codegeex"
-    },
-    "glm": {
-        "name": "GLM-4",
-        "url": "http://111.19.168.151:11553/v1/chat/completions",
-        "model": "glm4_32B_chat",
-        "key": "glm432b"
-    }
-}
-
 # 当前模型类型（默认使用codegeex）
-current_model_type = "codegeex"
+current_model_type = DEFAULT_MODEL_TYPE
 
 # 全局配置
 global_config = {
@@ -174,13 +199,34 @@ async def health():
     return {"status": "ok", "message": "大模型对话后端服务运行中", "version": "1.0.0"}
 
 
+@app.get("/api/metrics")
+async def metrics():
+    """运行指标接口（上游连接池占用等）"""
+    return {
+        "llm_pool": llm_service.get_pool_stats(),
+        "load_balancer": llm_service.balancer.stats(),
+        "llm_retries": llm_service.retry_policy.stats(),
+        "summarizer": conversation_summarizer.stats(),
+        "history_cache": history_cache.stats(),
+        "retention": retention_worker.stats(),
+        "streams": stream_stats.stats(),
+        "titles": title_worker.stats(),
+        "response_cache": llm_service.response_cache.stats(),
+        "singleflight": llm_service.singleflight.stats(),
+        "similarity_cache": llm_service.similarity_cache.stats(),
+        "message_writer": message_writer.stats(),
+        "generations": generation_manager.stats(),
+        "sse": sse_stats.stats()
+    }
+
+
 # ==================== 认证相关API ====================
 
 @app.post("/api/auth/register", response_model=Token)
-async def register(user_data: UserRegister, db: Session = Depends(get_db)):
+async def register(user_data: UserRegister, db: AsyncSession = Depends(get_async_db)):
     """用户注册"""
     # 检查用户名是否已存在
-    existing_user = db.query(User).filter(User.username == user_data.username).first()
+    existing_user = (await db.execute(select(User).where(User.username == user_data.username))).scalars().first()
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -189,7 +235,7 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
 
     # 检查邮箱是否已存在
     if user_data.email:
-        existing_email = db.query(User).filter(User.email == user_data.email).first()
+        existing_email = (await db.execute(select(User).where(User.email == user_data.email))).scalars().first()
         if existing_email:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -204,8 +250,8 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
         email=user_data.email
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
 
     # 为新用户创建默认配置
     user_config = UserConfig(
@@ -214,7 +260,7 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
         max_tokens=2000
     )
     db.add(user_config)
-    db.commit()
+    await db.commit()
 
     # 生成访问令牌
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -234,9 +280,9 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
 
 
 @app.post("/api/auth/login", response_model=Token)
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
     """用户登录"""
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -284,11 +330,11 @@ async def get_current_user_info(current_user: User = Depends(get_current_active_
 @app.post("/conversations", response_model=CreateConversationResponse)
 async def create_conversation(
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """创建新的对话会话"""
     try:
-        session_id = conversation_service.create_conversation(db, current_user.id)
+        session_id = await conversation_service.create_conversation(db, current_user.id)
         return CreateConversationResponse(
             session_id=session_id,
             message="对话会话创建成功"
@@ -300,8 +346,9 @@ async def create_conversation(
 @app.post("/chat")
 async def chat(
     request: ChatRequest,
+    http_request: Request,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     统一的对话接口
@@ -310,12 +357,10 @@ async def chat(
     - 非流式响应返回 JSON
     """
     try:
-        from llm_service import llm_service
-
         print(f"\n[CHAT REQUEST] user_id: {request.user_id}, session_id: {request.session_id}, stream: {request.stream}")
 
         # 获取用户配置
-        user_config = db.query(UserConfig).filter_by(user_id=current_user.id).first()
+        user_config = (await db.execute(select(UserConfig).where(UserConfig.user_id == current_user.id))).scalars().first()
         print(f"[USER CONFIG] Found: {user_config is not None}")
 
         # 确定使用的 max_tokens 和模型配置
@@ -326,71 +371,27 @@ async def chat(
         else:
             max_tokens = global_config["max_tokens"]
 
-        # 根据用户配置设置LLM服务
+        # 根据用户配置解析本次请求的模型目标（不修改全局llm_service）
         if user_config:
-            model_type = user_config.current_model_type
-            print(f"[DEBUG] 使用用户配置，模型类型: {model_type}, user_id: {request.user_id}")
-            if model_type == "codegeex":
-                llm_service.api_url = PRESET_MODELS["codegeex"]["url"]
-                llm_service.model = PRESET_MODELS["codegeex"]["model"]
-                llm_service.api_key = PRESET_MODELS["codegeex"]["key"]
-            elif model_type == "glm":
-                llm_service.api_url = PRESET_MODELS["glm"]["url"]
-                llm_service.model = PRESET_MODELS["glm"]["model"]
-                llm_service.api_key = PRESET_MODELS["glm"]["key"]
-            elif model_type == "custom":
-                llm_service.api_url = user_config.custom_api_url
-                llm_service.model = user_config.custom_model
-                llm_service.api_key = user_config.custom_api_key
+            print(f"[DEBUG] 使用用户配置，模型类型: {user_config.current_model_type}, user_id: {request.user_id}")
         else:
-            # 没有用户配置时，使用全局当前模型类型
             print(f"[DEBUG] 没有用户配置，使用全局默认: {current_model_type}, user_id: {request.user_id}")
-            if current_model_type == "codegeex":
-                llm_service.api_url = PRESET_MODELS["codegeex"]["url"]
-                llm_service.model = PRESET_MODELS["codegeex"]["model"]
-                llm_service.api_key = PRESET_MODELS["codegeex"]["key"]
-            elif current_model_type == "glm":
-                llm_service.api_url = PRESET_MODELS["glm"]["url"]
-                llm_service.model = PRESET_MODELS["glm"]["model"]
-                llm_service.api_key = PRESET_MODELS["glm"]["key"]
+        target = resolve_model_target(user_config, current_model_type)
 
-        print(f"[MODEL CONFIG] API: {llm_service.api_url}, Model: {llm_service.model}")
+        print(f"[MODEL CONFIG] API: {target.api_url}, Model: {target.model}")
 
         # 如果请求流式响应
         if request.stream:
-            async def event_generator():
-                """生成SSE事件流"""
-                try:
-                    chunk_count = 0
-                    async for chunk in conversation_service.chat_stream(
-                        db=db,
-                        session_id=request.session_id,
-                        user_message=request.message,
-                        temperature=request.temperature,
-                        max_tokens=max_tokens
-                    ):
-                        chunk_count += 1
-                        # 发送SSE格式的数据
-                        yield f"data: {json.dumps({'chunk': chunk}, ensure_ascii=False)}\n\n"
-
-                    print(f"[STREAM COMPLETE] Sent {chunk_count} chunks")
-                    # 发送完成信号
-                    yield f"data: {json.dumps({'done': True}, ensure_ascii=False)}\n\n"
-
-                except Exception as e:
-                    print(f"[STREAM ERROR] {str(e)}")
-                    # 发送错误信息
-                    yield f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
-
-            return StreamingResponse(
-                event_generator(),
-                media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "X-Accel-Buffering": "no"
-                }
+            # 生成在后台任务中运行；开始响应前检查并发上限并获取上游准入许可，繁忙时直接返回429/503而不是在流中报错
+            generation = await generation_manager.start(
+                user_id=current_user.id,
+                session_id=request.session_id,
+                user_message=request.message,
+                temperature=request.temperature,
+                max_tokens=max_tokens,
+                target=target
             )
+            return sse_response(generation.buffer, 0, http_request)
 
         # 非流式响应
         else:
@@ -399,7 +400,9 @@ async def chat(
                 session_id=request.session_id,
                 user_message=request.message,
                 temperature=request.temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                target=target,
+                user_id=current_user.id
             )
             return ChatResponse(
                 session_id=request.session_id,
@@ -407,22 +410,134 @@ async def chat(
                 assistant_reply=assistant_reply
             )
 
+    except GenerationLimitError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except LLMError as e:
+        # 上游错误按类型映射状态码：429限流、503不可用/繁忙/熔断、504超时、502上游拒绝或返回异常
+        headers = {"Retry-After": str(math.ceil(e.retry_after))} if e.retry_after is not None else None
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=headers)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"对话失败: {str(e)}")
 
 
+def sse_response(buffer: StreamBuffer, last_event_id: int, http_request: Request) -> StreamingResponse:
+    """
+    从事件缓冲输出SSE流（事件ID即缓冲中的序号），响应头 X-Generation-Id 用于重新连接
+
+    连续的片段合并成帧发送（第一帧立即发送），客户端支持时gzip压缩，见 sse_writer。
+    """
+    encoder = SSEEncoder(compress=SSE_GZIP and accepts_gzip(http_request.headers.get("accept-encoding", "")))
+
+    async def event_generator():
+        """生成SSE事件流"""
+        event_count = 0
+        # 客户端断开时立即停止发送；生成本身在后台继续，等待重新连接
+        async with DisconnectGuard(http_request) as guard:
+            batches = buffer.subscribe(last_event_id, SSE_FLUSH_INTERVAL_MS / 1000, SSE_FLUSH_BYTES)
+            try:
+                async for batch in batches:
+                    event_count += len(batch)
+                    guard.sending = True
+                    yield encoder.encode(batch)
+                    guard.sending = False
+                    if guard.disconnected:
+                        break
+            except StreamGapError as e:
+                yield encoder.error(str(e))
+            finally:
+                await batches.aclose()
+
+        if guard.disconnected:
+            print(f"[STREAM DETACHED] 客户端已断开，已发送 {event_count} 个事件，生成 {buffer.generation_id} 等待重新连接")
+        elif encoder.compressed:
+            yield encoder.close()
+
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+        "X-Generation-Id": buffer.generation_id
+    }
+    if encoder.compressed:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return StreamingResponse(event_generator(), media_type="text/event-stream", headers=headers)
+
+
+@app.get("/chat/stream/{generation_id}")
+async def resume_chat_stream(
+    generation_id: str,
+    http_request: Request,
+    last_event_id: Optional[int] = Query(None, ge=0, description="最后收到的事件ID，也可以通过 Last-Event-ID 请求头传递"),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    重新连接流式对话
+    - 先补发 Last-Event-ID 之后的事件，再跟随实时事件，不会再次请求上游
+    - 生成结束后在 STREAM_BUFFER_TTL_SECONDS 内仍可连接
+    """
+    generation = generation_manager.get(generation_id, current_user.id)
+    if generation is None:
+        raise HTTPException(status_code=404, detail=f"生成 {generation_id} 不存在或已过期")
+    buffer = generation.buffer
+
+    header = http_request.headers.get("last-event-id")
+    if header is not None:
+        try:
+            last_event_id = int(header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="无效的 Last-Event-ID")
+    last_event_id = last_event_id or 0
+    if not buffer.can_resume(last_event_id):
+        raise HTTPException(
+            status_code=410,
+            detail=f"无法从事件 {last_event_id} 之后继续（缓冲中保留的事件为 {buffer.first_id} 到 {buffer.last_id}）"
+        )
+
+    generation_manager.resumed += 1
+    return sse_response(buffer, last_event_id, http_request)
+
+
+@app.get("/chat/generations")
+async def list_generations(current_user: User = Depends(get_current_active_user)):
+    """
+    当前用户进行中的流式生成（可用 generation_id 连接或停止）
+
+    Returns:
+        每次生成的会话ID、模型、已输出的片段数和估算token数、已用时间（秒）、当前连接数
+    """
+    generations = generation_manager.list_active(current_user.id)
+    return {"generations": [generation.info() for generation in generations], "count": len(generations)}
+
+
+@app.post("/chat/generations/{generation_id}/cancel")
+async def cancel_generation(generation_id: str, current_user: User = Depends(get_current_active_user)):
+    """
+    停止一次流式生成
+    - 已生成的部分以 truncated 状态保存，所有连接收到 {"cancelled": true} 后结束
+    - 生成已经结束时返回409
+    """
+    generation = generation_manager.get(generation_id, current_user.id)
+    if generation is None:
+        raise HTTPException(status_code=404, detail=f"生成 {generation_id} 不存在或已过期")
+    if generation.status != "running":
+        raise HTTPException(status_code=409, detail=f"生成 {generation_id} 已结束（{generation.status}）")
+    await generation_manager.cancel(generation)
+    return generation.info()
+
+
 @app.get("/conversations/{session_id}/history", response_model=ConversationHistoryResponse)
 async def get_conversation_history(
     session_id: str,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """获取对话历史"""
     try:
-        messages = conversation_service.get_conversation_history(db, session_id)
-        if not messages and not db.query(conversation_service.Conversation).filter_by(session_id=session_id).first():
+        messages = await conversation_service.get_conversation_history(db, session_id)
+        if not messages and not await conversation_service.get_conversation(db, session_id):
             raise HTTPException(status_code=404, detail=f"会话 {session_id} 不存在")
 
         return ConversationHistoryResponse(
@@ -439,11 +554,11 @@ async def get_conversation_history(
 async def delete_conversation(
     session_id: str,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """删除对话会话"""
     try:
-        conversation_service.delete_conversation(db, session_id)
+        await conversation_service.delete_conversation(db, session_id)
         return {"message": f"会话 {session_id} 已删除"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除会话失败: {str(e)}")
@@ -451,13 +566,25 @@ async def delete_conversation(
 
 @app.get("/conversations")
 async def list_conversations(
+    limit: int = Query(500, ge=1, le=500),
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """获取用户的所有对话会话列表"""
+    """
+    获取用户的对话会话列表（按更新时间倒序，游标分页）
+
+    Args:
+        limit: 每页条数
+        cursor: 上一页返回的 next_cursor
+    """
     try:
-        conversations = conversation_service.list_conversations(db, current_user.id)
-        return {"conversations": conversations}
+        conversations, next_cursor = await conversation_service.list_conversations(
+            db, current_user.id, limit, cursor
+        )
+        return {"conversations": conversations, "next_cursor": next_cursor}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取会话列表失败: {str(e)}")
 
@@ -465,23 +592,35 @@ async def list_conversations(
 @app.get("/conversations/search")
 async def search_conversations(
     q: str,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     搜索用户的对话
 
     Args:
         q: 搜索关键词
+        limit: 每页条数
+        offset: 偏移量
         current_user: 当前登录用户
         db: 数据库会话
 
     Returns:
-        包含关键词的对话列表
+        当前页的对话列表（按相关度排序）及分页信息
     """
     try:
-        results = conversation_service.search_conversations(db, current_user.id, q)
-        return {"results": results, "query": q, "count": len(results)}
+        results, total = await conversation_service.search_conversations(db, current_user.id, q, limit, offset)
+        return {
+            "results": results,
+            "query": q,
+            "count": len(results),
+            "total": total,
+            "limit": limit,
+            "offset": offset,
+            "has_more": offset + len(results) < total
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"搜索失败: {str(e)}")
 
@@ -489,11 +628,9 @@ async def search_conversations(
 @app.get("/api/config")
 async def get_config(
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """获取用户LLM配置"""
-    from llm_service import llm_service
-
     # 构建预设模型列表
     preset_models = [
         {
@@ -513,32 +650,21 @@ async def get_config(
     ]
 
     # 从数据库获取用户配置
-    user_config = db.query(UserConfig).filter_by(user_id=current_user.id).first()
+    user_config = (await db.execute(select(UserConfig).where(UserConfig.user_id == current_user.id))).scalars().first()
 
     if user_config:
         # 返回数据库中的配置
         model_type = user_config.current_model_type
         max_tokens = user_config.max_tokens
-
-        if model_type == "codegeex":
-            api_url = PRESET_MODELS["codegeex"]["url"]
-            model = PRESET_MODELS["codegeex"]["model"]
-            api_key = PRESET_MODELS["codegeex"]["key"]
-        elif model_type == "glm":
-            api_url = PRESET_MODELS["glm"]["url"]
-            model = PRESET_MODELS["glm"]["model"]
-            api_key = PRESET_MODELS["glm"]["key"]
-        else:  # custom
-            api_url = user_config.custom_api_url
-            model = user_config.custom_model
-            api_key = user_config.custom_api_key
     else:
         # 返回默认配置
         model_type = current_model_type
         max_tokens = global_config["max_tokens"]
-        api_url = llm_service.api_url
-        model = llm_service.model
-        api_key = llm_service.api_key
+
+    target = resolve_model_target(user_config, current_model_type)
+    api_url = target.api_url
+    model = target.model
+    api_key = target.api_key
 
     return ConfigResponse(
         llm_api_url=api_url,
@@ -546,7 +672,8 @@ async def get_config(
         llm_api_key=api_key,
         preset_models=preset_models,
         current_model_type=model_type,
-        max_tokens=max_tokens
+        max_tokens=max_tokens,
+        max_conversations=user_config.max_conversations if user_config else None
     )
 
 
@@ -554,7 +681,7 @@ async def get_config(
 async def update_config(
     config: ConfigUpdateRequest,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """更新用户LLM配置"""
     try:
@@ -570,8 +697,12 @@ async def update_config(
             if not config.llm_api_url or not config.llm_model:
                 raise HTTPException(status_code=400, detail="自定义模型需要提供URL和Model")
 
+        # 验证 max_conversations
+        if config.max_conversations is not None and not 0 <= config.max_conversations <= 100000:
+            raise HTTPException(status_code=400, detail="max_conversations 必须在 0 到 100000 之间")
+
         # 查找或创建用户配置
-        user_config = db.query(UserConfig).filter_by(user_id=current_user.id).first()
+        user_config = (await db.execute(select(UserConfig).where(UserConfig.user_id == current_user.id))).scalars().first()
 
         if user_config:
             # 更新现有配置
@@ -599,8 +730,13 @@ async def update_config(
             )
             db.add(user_config)
 
-        db.commit()
-        db.refresh(user_config)
+        if config.max_conversations is not None:
+            # 0 表示恢复使用系统默认的保留数量
+            user_config.max_conversations = config.max_conversations or None
+            retention_worker.mark(current_user.id)
+
+        await db.commit()
+        await db.refresh(user_config)
 
         # 返回配置信息
         if model_type == "codegeex":
@@ -619,14 +755,15 @@ async def update_config(
                 "model_type": model_type,
                 "api_url": api_url,
                 "model": model,
-                "max_tokens": max_tokens
+                "max_tokens": max_tokens,
+                "max_conversations": user_config.max_conversations
             }
         }
 
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"更新配置失败: {str(e)}")
 
 
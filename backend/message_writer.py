@@ -0,0 +1,306 @@
+"""
+消息写入队列：一轮对话的用户消息和助手回复在同一个事务中写入，并在后台合并多个请求的写入一起提交
+
+- 每轮对话一次写入（而不是每条消息一次提交），同时维护对话的消息数、最后消息时间和 updated_at
+- 后台写入协程每次取出队列中已有的全部写入（不超过 batch_size 轮），一个事务提交（group commit）
+- 有界队列：积压达到上限时写入方等待，而不是无限占用内存
+- 调用方等待自己的写入提交完成后才返回；关闭时先把队列中的写入全部提交
+- 也可以更新已写入消息的内容和状态（流式回复的检查点），同一批中对同一条消息的多次更新只执行最后一次
+"""
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+from sqlalchemy import bindparam, insert, select, update
+from database import AsyncSessionLocal, Conversation, Message, get_beijing_time
+from context_builder import estimate_tokens
+from history_cache import history_cache
+from config import MESSAGE_WRITER_QUEUE_SIZE, MESSAGE_WRITER_BATCH_SIZE
+
+
+def message_record(role: str, content: str, status: str = "complete",
+                   created_at: Optional[datetime] = None) -> Dict:
+    """
+    构造一条待写入的消息
+
+    Args:
+        role: 角色（user 或 assistant）
+        content: 消息内容
+        status: 消息状态（complete 或 truncated）
+        created_at: 消息时间，默认为当前时间（用户消息应传入请求到达的时间）
+    """
+    return {"role": role, "content": content, "status": status, "created_at": created_at or get_beijing_time()}
+
+
+def _consume_exception(future: asyncio.Future):
+    """调用方已离开时写入失败的异常也要取出，避免 "Future exception was never retrieved" 警告"""
+    if not future.cancelled():
+        future.exception()
+
+
+class _Turn:
+    """一次写入：同一对话的若干条消息；message_id 不为空时是对该消息的更新（messages 只有一条）"""
+
+    __slots__ = ("conversation_id", "session_id", "messages", "message_id", "future")
+
+    def __init__(self, conversation_id: int, session_id: str, messages: List[Dict], message_id: Optional[int] = None):
+        self.conversation_id = conversation_id
+        self.session_id = session_id
+        self.messages = messages
+        self.message_id = message_id
+        self.future = asyncio.get_running_loop().create_future()
+        self.future.add_done_callback(_consume_exception)
+
+
+class MessageWriter:
+    """后台合并提交的消息写入队列"""
+
+    def __init__(self, max_queue: int = MESSAGE_WRITER_QUEUE_SIZE, batch_size: int = MESSAGE_WRITER_BATCH_SIZE):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self.turns = 0
+        self.messages = 0
+        self.updates = 0
+        self.coalesced_updates = 0
+        self.commits = 0
+        self.batched = 0
+        self.max_batch = 0
+        self.failed = 0
+        self.inline_writes = 0
+
+    def start(self):
+        """启动后台写入协程（需在事件循环中调用）"""
+        if self._task is not None:
+            return
+        self._closing = False
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    @staticmethod
+    async def mark_interrupted() -> int:
+        """
+        启动时把仍为 streaming 状态的回复标记为 interrupted（上次进程在生成过程中退出）
+
+        只适用于单进程部署；多进程共享数据库时其他进程正在生成的回复也会被标记。
+
+        Returns:
+            标记的回复数
+        """
+        messages = Message.__table__
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(messages).where(messages.c.status == "streaming").values(status="interrupted")
+            )
+            await db.commit()
+        if result.rowcount:
+            print(f"[MESSAGE WRITER] 已将 {result.rowcount} 条未完成的回复标记为 interrupted")
+        return result.rowcount
+
+    async def shutdown(self):
+        """停止接收新的排队写入，等待队列中的写入全部提交后停止"""
+        if self._task is None:
+            return
+        self._closing = True
+        await self._queue.join()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        print(f"[MESSAGE WRITER] 已停止，共提交 {self.turns} 轮 {self.messages} 条消息")
+
+    async def write(self, conversation_id: int, session_id: str, messages: List[Dict]) -> List[int]:
+        """
+        写入同一对话的若干条消息（一个事务），等待提交完成
+
+        未启动或正在关闭时直接在当前任务中写入。调用方被取消不影响已排队的写入。
+
+        Args:
+            conversation_id: 对话主键
+            session_id: 会话ID（写入后更新对话状态缓存）
+            messages: message_record 构造的消息，按时间顺序
+
+        Returns:
+            消息ID列表
+
+        Raises:
+            ValueError: 对话已不存在
+        """
+        return await self._submit(_Turn(conversation_id, session_id, messages))
+
+    async def update(self, conversation_id: int, session_id: str, message_id: int, content: str, status: str) -> List[int]:
+        """
+        更新已写入消息的内容和状态，等待提交完成（消息已被删除时不报错）
+
+        Args:
+            conversation_id: 对话主键
+            session_id: 会话ID（更新后同步对话状态缓存）
+            message_id: 消息ID
+            content: 新的消息内容
+            status: 新的消息状态
+
+        Returns:
+            [message_id]
+        """
+        return await self._submit(_Turn(conversation_id, session_id, [message_record("assistant", content, status)], message_id))
+
+    async def _submit(self, turn: _Turn) -> List[int]:
+        if self._task is None or self._closing:
+            self.inline_writes += 1
+            await self._write_batch([turn])
+        else:
+            await self._queue.put(turn)
+        return await asyncio.shield(turn.future)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # 提交期间到达的写入在队列中积累，下一次一起提交
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write_batch(self, batch: List[_Turn]):
+        inserts = [turn for turn in batch if turn.message_id is None]
+        # 同一条消息的多次更新只保留最后一次（按入队顺序）
+        updates = {turn.message_id: turn for turn in batch if turn.message_id is not None}
+        try:
+            async with AsyncSessionLocal() as db:
+                existing = await self._bump_conversations(db, inserts) if inserts else set()
+                written = [turn for turn in inserts if turn.conversation_id in existing]
+                rows = [
+                    {
+                        "conversation_id": turn.conversation_id, "role": message["role"], "content": message["content"],
+                        "token_count": estimate_tokens(message["content"]), "status": message["status"],
+                        "created_at": message["created_at"]
+                    }
+                    for turn in written for message in turn.messages
+                ]
+                ids = []
+                if rows:
+                    # 一条多行INSERT写入整批消息，按参数顺序返回ID
+                    result = await db.execute(insert(Message).returning(Message.id, sort_by_parameter_order=True), rows)
+                    ids = [row[0] for row in result.all()]
+                if updates:
+                    await self._update_messages(db, updates)
+                await db.commit()
+                # 提交后立即同步缓存，中间不能有 await：否则并发的加载可能先把提交前的数据放入缓存
+                self._write_through(batch, updates, written, ids, rows)
+        except Exception as e:
+            if len(batch) > 1:
+                # 逐轮重试，一轮的错误不影响同一批的其他写入
+                for turn in batch:
+                    await self._write_batch([turn])
+                return
+            self.failed += 1
+            print(f"[MESSAGE WRITER] 写入消息失败: {str(e)}")
+            if not batch[0].future.done():
+                batch[0].future.set_exception(e)
+            return
+
+        self.commits += 1
+        self.batched += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        for turn in inserts:
+            if turn.conversation_id not in existing and not turn.future.done():
+                turn.future.set_exception(ValueError(f"会话 {turn.session_id} 不存在"))
+        self.updates += len(updates)
+        self.coalesced_updates += len(batch) - len(inserts) - len(updates)
+        for turn in batch:
+            if turn.message_id is not None and not turn.future.done():
+                turn.future.set_result([turn.message_id])
+        offset = 0
+        for turn in written:
+            turn_ids = ids[offset:offset + len(turn.messages)]
+            offset += len(turn.messages)
+            self.turns += 1
+            self.messages += len(turn_ids)
+            if not turn.future.done():
+                turn.future.set_result(turn_ids)
+
+    @staticmethod
+    def _write_through(batch: List[_Turn], updates: Dict[int, _Turn], written: List[_Turn], ids: List[int],
+                       rows: List[Dict]):
+        """写穿更新缓存（提交后、确认写入方之前调用）"""
+        for turn in batch:
+            if turn.message_id is not None and updates[turn.message_id] is turn:
+                message = turn.messages[0]
+                history_cache.update_message(turn.session_id, turn.message_id, message["content"], message["token_count"])
+        for message_id, row, turn in zip(ids, rows, (turn for turn in written for _ in turn.messages)):
+            history_cache.append_message(turn.session_id, {
+                "id": message_id, "role": row["role"], "content": row["content"], "token_count": row["token_count"]
+            })
+
+    @staticmethod
+    async def _update_messages(db, updates: Dict[int, _Turn]):
+        messages = Message.__table__
+        params = []
+        for message_id, turn in updates.items():
+            message = turn.messages[0]
+            message["token_count"] = estimate_tokens(message["content"])
+            params.append({
+                "message_id": message_id, "new_content": message["content"],
+                "new_token_count": message["token_count"], "new_status": message["status"]
+            })
+        await db.execute(
+            update(messages)
+            .where(messages.c.id == bindparam("message_id"))
+            .values(content=bindparam("new_content"), token_count=bindparam("new_token_count"),
+                    status=bindparam("new_status")),
+            params
+        )
+
+    @staticmethod
+    async def _bump_conversations(db, batch: List[_Turn]) -> Set[int]:
+        """
+        在同一事务内更新每个对话的消息数和最后消息时间（同时刷新 updated_at），返回仍存在的对话
+
+        先执行UPDATE再查询：SQLite 中读事务升级为写事务时若有其他提交会立即失败，先写则按 busy_timeout 等待写锁。
+        """
+        counts: Dict[int, int] = {}
+        last_at: Dict[int, datetime] = {}
+        for turn in batch:
+            conversation_id = turn.conversation_id
+            counts[conversation_id] = counts.get(conversation_id, 0) + len(turn.messages)
+            latest = max(message["created_at"] for message in turn.messages)
+            if conversation_id not in last_at or latest > last_at[conversation_id]:
+                last_at[conversation_id] = latest
+
+        conversations = Conversation.__table__
+        await db.execute(
+            update(conversations)
+            .where(conversations.c.id == bindparam("conversation_id"))
+            .values(message_count=conversations.c.message_count + bindparam("added"),
+                    last_message_at=bindparam("last_at")),
+            [
+                {"conversation_id": conversation_id, "added": count, "last_at": last_at[conversation_id]}
+                for conversation_id, count in counts.items()
+            ]
+        )
+        result = await db.execute(select(Conversation.id).where(Conversation.id.in_(list(counts))))
+        return {row[0] for row in result.all()}
+
+    def stats(self) -> Dict:
+        """写入队列统计"""
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "turns": self.turns,
+            "messages": self.messages,
+            "updates": self.updates,
+            "coalesced_updates": self.coalesced_updates,
+            "commits": self.commits,
+            "max_batch": self.max_batch,
+            "avg_batch": round(self.batched / self.commits, 2) if self.commits else 0.0,
+            "failed": self.failed,
+            "inline_writes": self.inline_writes
+        }
+
+
+# 创建全局消息写入实例
+message_writer = MessageWriter()
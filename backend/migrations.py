@@ -0,0 +1,237 @@
+"""
+数据库结构版本迁移
+
+启动时由 init_db 自动执行，也可以在 backend 目录下手动运行：
+
+    python migrations.py upgrade   # 执行尚未应用的迁移
+    python migrations.py status    # 查看已应用和待执行的迁移
+    python migrations.py check     # 检查热点查询的执行计划是否使用了索引
+"""
+import re
+import sys
+from typing import Callable, List, Tuple
+from sqlalchemy import inspect, text
+from database import engine, Base, get_beijing_time
+import search_index
+
+
+# ========== 迁移步骤 ==========
+
+def _add_column_if_missing(conn, table: str, column: str, ddl: str, backfill: str = None):
+    existing = {col["name"] for col in inspect(conn).get_columns(table)}
+    if column in existing:
+        return
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    print(f"[DB] 已为表 {table} 添加列 {column}")
+    if backfill:
+        conn.execute(text(backfill))
+        print(f"[DB] 已回填 {table}.{column}")
+
+
+def _m001_added_columns(conn):
+    """补充 token 缓存、滚动摘要和消息计数等后加的列"""
+    _add_column_if_missing(conn, "messages", "token_count", "INTEGER")
+    _add_column_if_missing(conn, "conversations", "summary", "TEXT")
+    _add_column_if_missing(conn, "conversations", "summary_until_id", "INTEGER")
+    _add_column_if_missing(
+        conn, "conversations", "message_count", "INTEGER NOT NULL DEFAULT 0",
+        "UPDATE conversations SET message_count = "
+        "(SELECT COUNT(*) FROM messages WHERE messages.conversation_id = conversations.id)"
+    )
+    _add_column_if_missing(
+        conn, "conversations", "last_message_at", "DATETIME",
+        "UPDATE conversations SET last_message_at = "
+        "(SELECT MAX(created_at) FROM messages WHERE messages.conversation_id = conversations.id)"
+    )
+
+
+def _m002_hot_path_indexes(conn):
+    """热点查询的复合索引（与模型 __table_args__ 中的声明保持一致）"""
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_messages_conversation_created ON messages (conversation_id, created_at)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_conversations_user_updated ON conversations (user_id, updated_at)"
+    ))
+
+
+def _m003_search_index(conn):
+    """对话全文检索表和同步触发器（数据库不支持时返回 False，下次启动重试）"""
+    return search_index.create_search_index(conn)
+
+
+def _m004_user_retention_limit(conn):
+    """用户级别的对话保留数量"""
+    _add_column_if_missing(conn, "user_configs", "max_conversations", "INTEGER")
+
+
+def _m005_message_status(conn):
+    """消息状态（区分完整回复和中断后保存的部分回复）"""
+    _add_column_if_missing(conn, "messages", "status", "VARCHAR(20) NOT NULL DEFAULT 'complete'")
+
+
+# (版本号, 名称, 迁移函数)，只能在末尾追加，已发布的迁移不要修改
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "added_columns", _m001_added_columns),
+    (2, "hot_path_indexes", _m002_hot_path_indexes),
+    (3, "search_index", _m003_search_index),
+    (4, "user_retention_limit", _m004_user_retention_limit),
+    (5, "message_status", _m005_message_status),
+]
+
+
+# ========== 版本管理 ==========
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, applied_at DATETIME NOT NULL)"
+    ))
+
+
+def applied_versions(conn) -> List[int]:
+    """已应用的迁移版本号"""
+    _ensure_version_table(conn)
+    return [row[0] for row in conn.execute(text("SELECT version FROM schema_version ORDER BY version"))]
+
+
+def upgrade(bind=engine) -> int:
+    """
+    按版本号依次执行尚未应用的迁移，每个迁移在独立事务中执行并记录版本
+
+    迁移函数返回 False 表示当前数据库无法应用（例如 SQLite 未编译 FTS5），不记录版本，下次启动时重试。
+
+    Args:
+        bind: 数据库引擎
+
+    Returns:
+        本次执行的迁移数量
+    """
+    Base.metadata.create_all(bind=bind)
+    with bind.begin() as conn:
+        done = set(applied_versions(conn))
+
+    count = 0
+    for version, name, migrate in MIGRATIONS:
+        if version in done:
+            continue
+        with bind.begin() as conn:
+            if migrate(conn) is False:
+                print(f"[DB] 迁移 {version:03d}_{name} 暂不可用，下次启动时重试")
+                continue
+            conn.execute(
+                text("INSERT INTO schema_version (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+                {"version": version, "name": name, "applied_at": get_beijing_time()}
+            )
+        print(f"[DB] 已应用迁移 {version:03d}_{name}")
+        count += 1
+    return count
+
+
+def status(bind=engine) -> List[Tuple[int, str, bool]]:
+    """返回每个迁移的 (版本号, 名称, 是否已应用)"""
+    with bind.begin() as conn:
+        done = set(applied_versions(conn))
+    return [(version, name, version in done) for version, name, _ in MIGRATIONS]
+
+
+# ========== 执行计划检查 ==========
+
+def _hot_queries(fts: bool):
+    """
+    热点查询: (名称, 语句, 参数, 期望使用的索引, 是否要求按索引排序)
+
+    语句由各服务自己的查询构造函数生成，服务中的查询改动后这里检查的就是改动后的语句。
+    参数为None时使用语句中绑定的参数。
+    """
+    # 延迟导入：database.init_db 会导入本模块，服务模块又依赖 database
+    from context_builder import recent_messages_query
+    from conversation_service import ConversationService
+    from retention import RetentionWorker
+    from summarizer import pending_messages_query, aged_messages_query
+
+    now = get_beijing_time()
+    queries = [
+        ("get_conversation_history", ConversationService.history_query(1), None,
+         "ix_messages_conversation_created", True),
+        ("load_recent_messages", recent_messages_query(1, 50, 0), None, "ix_messages_conversation_created", True),
+        ("summarizer_pending", pending_messages_query(1, 0), None, "ix_messages_conversation_created", True),
+        ("summarizer_aged", aged_messages_query(1, 0, 50), None, "ix_messages_conversation_created", True),
+        ("list_conversations", ConversationService.list_query(1, 51), None, "ix_conversations_user_updated", True),
+        ("list_conversations_cursor", ConversationService.list_query(1, 51, (now, 100)), None,
+         "ix_conversations_user_updated", True),
+        ("retention_excess", RetentionWorker.excess_query(1, 500, 100), None, "ix_conversations_user_updated", True),
+        # 检索结果按相关度或聚合后的更新时间排序，不要求按索引排序
+        ("search_like_fallback", *search_index.search_statement(1, "x", 20, 0, use_fts=False),
+         "ix_messages_conversation_created", False),
+    ]
+    if fts:
+        queries.append(
+            ("search_fts", *search_index.search_statement(1, "排序算法", 20, 0, use_fts=True),
+             "VIRTUAL TABLE INDEX", False)
+        )
+    return queries
+
+
+# 全表扫描：SCAN 之后是表名或检索语句中的表别名（CTE 和子查询的 SCAN 不算）
+_TABLE_SCAN = re.compile(r"SCAN (?:messages|conversations|users|user_configs|m|c)\b")
+
+
+def check_query_plans(bind=engine) -> List[str]:
+    """
+    用 EXPLAIN QUERY PLAN 检查热点查询是否使用了预期的索引（仅 SQLite）
+
+    Returns:
+        问题列表，为空表示全部通过
+    """
+    if bind.dialect.name != "sqlite":
+        return []
+
+    problems = []
+    with bind.connect() as conn:
+        for name, stmt, params, index_name, ordered in _hot_queries(search_index.detect_search_index(conn)):
+            if params is None:
+                compiled = stmt.compile(dialect=bind.dialect)
+                rows = conn.exec_driver_sql(
+                    f"EXPLAIN QUERY PLAN {compiled.string}",
+                    tuple(compiled.params[key] for key in compiled.positiontup)
+                )
+            else:
+                rows = conn.execute(text(f"EXPLAIN QUERY PLAN {stmt.text}"), params)
+            plan = [row[3] for row in rows]
+            detail = " | ".join(plan)
+            if index_name not in detail:
+                problems.append(f"{name}: 未使用索引 {index_name}（{detail}）")
+            elif any(_TABLE_SCAN.match(step) for step in plan):
+                problems.append(f"{name}: 存在全表扫描（{detail}）")
+            elif ordered and "USE TEMP B-TREE FOR ORDER BY" in detail:
+                problems.append(f"{name}: 排序未走索引（{detail}）")
+            else:
+                print(f"[CHECK] {name}: {detail}")
+    return problems
+
+
+def main(argv: List[str]) -> int:
+    command = argv[1] if len(argv) > 1 else "upgrade"
+    if command == "upgrade":
+        count = upgrade()
+        print(f"迁移完成，本次应用 {count} 个迁移")
+    elif command == "status":
+        for version, name, applied in status():
+            print(f"{version:03d}_{name}: {'已应用' if applied else '待执行'}")
+    elif command == "check":
+        upgrade()
+        problems = check_query_plans()
+        for problem in problems:
+            print(f"[CHECK] 失败 - {problem}")
+        if problems:
+            return 1
+        print("执行计划检查通过")
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,102 @@
+"""
+模型路由：预设模型配置和请求级模型目标解析
+"""
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from config import LLM_API_URL, LLM_API_URLS, LLM_MODEL, LLM_API_KEY, CONTEXT_WINDOW_TOKENS
+
+# 预设模型配置（同一模型部署了多个副本时，在 urls 中列出所有副本地址，url 为第一个；
+# 多副本模型可用 hedge_percentile/hedge_budget 单独设置非流式请求的对冲）
+PRESET_MODELS = {
+    "codegeex": {
+        "name": "CodeGeex",
+        "url": "http://111.19.168.151:11551/v1/chat/completions",
+        "model": "codegeex4-all-9b",
+        "key": "codegeex",
+        "context_window": 131072
+    },
+    "glm": {
+        "name": "GLM-4",
+        "url": "http://111.19.168.151:11553/v1/chat/completions",
+        "model": "glm4_32B_chat",
+        "key": "glm432b",
+        "context_window": 32768
+    }
+}
+
+# 默认模型类型（没有用户配置时使用）
+DEFAULT_MODEL_TYPE = "codegeex"
+
+
+@dataclass(frozen=True)
+class ModelTarget:
+    """
+    单次请求使用的模型目标（不可变）
+
+    每个请求解析出自己的 ModelTarget 并一路传递给 LLMService，
+    不再修改全局 llm_service 的属性，避免并发请求互相串台。
+    """
+    model_type: str  # codegeex/glm/custom
+    api_url: str
+    model: str
+    api_key: str
+    max_connections: Optional[int] = None  # 该上游的连接数上限，为None时使用全局配置
+    max_in_flight: Optional[int] = None  # 该上游的在途请求上限，为None时使用全局配置
+    context_window: int = CONTEXT_WINDOW_TOKENS  # 模型上下文长度（token）
+    api_urls: Tuple[str, ...] = ()  # 同一模型的多个副本地址，为空时只用 api_url
+    hedge_percentile: Optional[float] = None  # 非流式请求的对冲分位数，为None时使用全局配置，0表示关闭
+    hedge_budget: Optional[float] = None  # 对冲请求占比上限，为None时使用全局配置
+
+    @property
+    def endpoints(self) -> Tuple[str, ...]:
+        """所有副本地址"""
+        return self.api_urls or (self.api_url,)
+
+
+def preset_target(model_type: str) -> ModelTarget:
+    """根据预设模型类型构建模型目标"""
+    preset = PRESET_MODELS[model_type]
+    urls = tuple(preset.get("urls") or (preset["url"],))
+    return ModelTarget(
+        model_type=model_type,
+        api_url=urls[0],
+        api_urls=urls,
+        model=preset["model"],
+        api_key=preset["key"],
+        max_connections=preset.get("max_connections"),
+        max_in_flight=preset.get("max_in_flight"),
+        hedge_percentile=preset.get("hedge_percentile"),
+        hedge_budget=preset.get("hedge_budget"),
+        context_window=preset.get("context_window", CONTEXT_WINDOW_TOKENS)
+    )
+
+
+def default_target() -> ModelTarget:
+    """环境变量配置的默认模型目标"""
+    urls = tuple(LLM_API_URLS) or (LLM_API_URL,)
+    return ModelTarget(model_type="default", api_url=urls[0], api_urls=urls, model=LLM_MODEL, api_key=LLM_API_KEY)
+
+
+def resolve_model_target(user_config=None, fallback_model_type: str = DEFAULT_MODEL_TYPE) -> ModelTarget:
+    """
+    根据用户配置解析本次请求的模型目标
+
+    Args:
+        user_config: 用户配置（UserConfig），为None时使用 fallback_model_type
+        fallback_model_type: 没有用户配置时使用的模型类型
+
+    Returns:
+        模型目标
+    """
+    model_type = user_config.current_model_type if user_config else fallback_model_type
+
+    if model_type in PRESET_MODELS:
+        return preset_target(model_type)
+    if model_type == "custom" and user_config:
+        return ModelTarget(
+            model_type="custom",
+            api_url=user_config.custom_api_url,
+            model=user_config.custom_model,
+            api_key=user_config.custom_api_key
+        )
+    return default_target()
@@ -0,0 +1,114 @@
+"""
+流式回复检查点：长回复在生成过程中定期保存，进程崩溃或重启后已生成的部分不会丢失
+
+- 回复超过时间或字节阈值后，第一个检查点把用户消息和状态为 streaming 的回复一起写入
+- 之后的检查点只更新这一行；检查点在后台写入，上一个还没提交时不发起新的（下一个包含全部内容）
+- 流结束时把这一行更新为最终内容和状态；短回复不产生检查点，结束时一次写入
+- 启动时仍为 streaming 的回复标记为 interrupted（见 MessageWriter.mark_interrupted），客户端可以据此继续生成
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional, Set
+from message_writer import message_writer, message_record
+from stream_control import stream_stats
+from config import STREAM_CHECKPOINT_ENABLED, STREAM_CHECKPOINT_INTERVAL, STREAM_CHECKPOINT_BYTES
+
+# 后台任务的引用，防止任务在完成前被垃圾回收
+_background_tasks: Set[asyncio.Task] = set()
+
+
+class ReplyCheckpoint:
+    """一轮流式对话的回复累积和检查点"""
+
+    def __init__(self, conversation_id: int, session_id: str, user_record: Dict,
+                 enabled: bool = STREAM_CHECKPOINT_ENABLED, interval: float = STREAM_CHECKPOINT_INTERVAL,
+                 min_bytes: int = STREAM_CHECKPOINT_BYTES):
+        self.conversation_id = conversation_id
+        self.session_id = session_id
+        self.user_record = user_record
+        self.enabled = enabled
+        self.interval = interval
+        self.min_bytes = min_bytes
+        self.parts: List[str] = []
+        # 检查点写入的回复行ID（写入第一个检查点之前为None）
+        self.message_id: Optional[int] = None
+        self._unsaved_bytes = 0
+        self._saved_at = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+    def append(self, chunk: str):
+        """追加一个片段，达到阈值且没有进行中的检查点时在后台保存"""
+        self.parts.append(chunk)
+        if not self.enabled:
+            return
+        self._unsaved_bytes += len(chunk.encode("utf-8"))
+        if self._task is not None:
+            return
+        if self._unsaved_bytes >= self.min_bytes or time.monotonic() - self._saved_at >= self.interval:
+            self._unsaved_bytes = 0
+            self._saved_at = time.monotonic()
+            self._task = asyncio.create_task(self._save(self.content))
+
+    async def _save(self, content: str):
+        try:
+            if self.message_id is None:
+                ids = await message_writer.write(
+                    self.conversation_id, self.session_id,
+                    [self.user_record, message_record("assistant", content, "streaming")]
+                )
+                self.message_id = ids[-1]
+            else:
+                await message_writer.update(self.conversation_id, self.session_id, self.message_id, content, "streaming")
+            stream_stats.checkpoints += 1
+        except Exception as e:
+            print(f"[STREAM] 保存检查点失败: {str(e)}")
+        finally:
+            self._task = None
+
+    async def finish(self, status: str = "complete"):
+        """
+        保存最终的回复
+
+        Args:
+            status: complete（正常结束）或 truncated（客户端断开或生成失败，没有内容时只保存用户消息）
+        """
+        if self._task is not None:
+            await asyncio.shield(self._task)
+        content = self.content
+        if self.message_id is not None:
+            await message_writer.update(self.conversation_id, self.session_id, self.message_id, content, status)
+        elif content or status == "complete":
+            await message_writer.write(
+                self.conversation_id, self.session_id, [self.user_record, message_record("assistant", content, status)]
+            )
+        else:
+            await message_writer.write(self.conversation_id, self.session_id, [self.user_record])
+        if status == "truncated" and content:
+            stream_stats.truncated_saved += 1
+
+    def finish_in_background(self, status: str = "truncated"):
+        """
+        在后台保存最终的回复
+
+        取消发生时不能在当前任务中等待，因此放到独立任务中完成。
+        """
+
+        async def save():
+            try:
+                await self.finish(status)
+            except Exception as e:
+                print(f"[STREAM] 保存部分回复失败: {str(e)}")
+
+        task = asyncio.create_task(save())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+async def drain():
+    """等待后台保存的部分回复全部写入队列（服务关闭时在 message_writer 提交之前调用）"""
+    while _background_tasks:
+        await asyncio.gather(*list(_background_tasks), return_exceptions=True)
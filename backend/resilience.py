@@ -0,0 +1,257 @@
+"""
+上游调用的容错策略：熔断器、带抖动的指数退避重试和请求对冲
+"""
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+from llm_errors import LLMError
+from config import (
+    LLM_BREAKER_FAILURES, LLM_BREAKER_OPEN_SECONDS, LLM_BREAKER_MAX_OPEN_SECONDS,
+    LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY, LLM_HEDGE_PERCENTILE, LLM_HEDGE_BUDGET
+)
+
+# 对冲延迟按最近多少次成功请求的延迟计算
+_HEDGE_SAMPLES = 500
+# 样本少于该数量时不对冲
+_HEDGE_MIN_SAMPLES = 20
+# 对冲额度最多累积多少次（限制突发）
+_HEDGE_MAX_TOKENS = 10.0
+
+
+class CircuitBreaker:
+    """
+    单个上游的熔断器
+
+    - 关闭：正常放行，连续失败达到 failure_threshold 次后打开
+    - 打开：直接拒绝，open_seconds 后进入半开；连续打开时时长翻倍，最长 max_open_seconds
+    - 半开：只放行一个试探请求，成功则关闭，失败则重新打开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, key: str, failure_threshold: int = LLM_BREAKER_FAILURES,
+                 open_seconds: float = LLM_BREAKER_OPEN_SECONDS, max_open_seconds: float = LLM_BREAKER_MAX_OPEN_SECONDS):
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self._consecutive_opens = 0
+        self._trial_in_flight = False
+
+        self.opens = 0
+        self.rejected = 0
+
+    def available(self, now: Optional[float] = None) -> bool:
+        """是否可以放行请求（只查看，不占用半开状态的试探名额）"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return (now if now is not None else time.monotonic()) >= self.opened_until
+        return not self._trial_in_flight
+
+    def allow(self) -> bool:
+        """
+        请求发送前调用，判断是否放行
+
+        Returns:
+            是否放行；半开状态下放行的请求即为试探请求
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() >= self.opened_until:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def retry_after(self) -> float:
+        """熔断剩余时间（秒）"""
+        return max(self.opened_until - time.monotonic(), 0.0)
+
+    def record_success(self):
+        """请求成功：清零连续失败，半开或打开状态下恢复"""
+        self.consecutive_failures = 0
+        self._trial_in_flight = False
+        if self.state != self.CLOSED:
+            self.close()
+
+    def record_failure(self):
+        """上游故障（连接失败、超时、5xx）：半开时重新打开，关闭时连续失败达到阈值后打开"""
+        self.consecutive_failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+            self.trip()
+
+    def record_neutral(self):
+        """请求结束但不能说明上游健康与否（被取消、4xx等），归还试探名额"""
+        self._trial_in_flight = False
+
+    def trip(self, seconds: Optional[float] = None):
+        """
+        打开熔断
+
+        Args:
+            seconds: 打开时长，为None时按 open_seconds 计算（连续打开时翻倍）
+        """
+        if seconds is None:
+            seconds = min(self.open_seconds * (2 ** self._consecutive_opens), self.max_open_seconds)
+        self._consecutive_opens += 1
+        self.opens += 1
+        self.consecutive_failures = 0
+        self._trial_in_flight = False
+        self.state = self.OPEN
+        self.opened_until = time.monotonic() + seconds
+        print(f"[LLM BREAKER] 上游 {self.key} 熔断 {seconds:.0f} 秒")
+
+    def close(self):
+        """关闭熔断（请求成功或主动健康检查成功）"""
+        if self.state != self.CLOSED:
+            print(f"[LLM BREAKER] 上游 {self.key} 已恢复")
+        self.state = self.CLOSED
+        self.opened_until = 0.0
+        self.consecutive_failures = 0
+        self._consecutive_opens = 0
+        self._trial_in_flight = False
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.state if self.state != self.OPEN or self.retry_after() > 0 else self.HALF_OPEN,
+            "consecutive_failures": self.consecutive_failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+            "retry_after": round(self.retry_after(), 1)
+        }
+
+
+class RetryPolicy:
+    """
+    有限次数的重试，等待时间为带全抖动的指数退避
+
+    - 只重试在收到任何内容之前发生、且错误类型可重试的失败
+    - 上游给出 Retry-After 时按其等待；超过 max_delay 则不重试，直接把等待时间交给客户端
+    - 换到另一个副本重试时不等待（Retry-After 只针对原副本）
+    """
+
+    def __init__(self, max_retries: int = LLM_MAX_RETRIES, base_delay: float = LLM_RETRY_BASE_DELAY,
+                 max_delay: float = LLM_RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.retries = 0
+        self.retry_sleep_seconds = 0.0
+        self.gave_up = 0
+
+    def next_delay(self, retry: int, error: LLMError, switching: bool) -> Optional[float]:
+        """
+        计算第 retry 次重试前的等待时间
+
+        Args:
+            retry: 即将进行的是第几次重试（从1开始）
+            error: 上一次尝试的错误
+            switching: 是否会换到另一个尚未尝试过的副本
+
+        Returns:
+            等待秒数，不应重试时返回None
+        """
+        if not error.retryable or retry > self.max_retries:
+            return None
+        if switching:
+            return 0.0
+        if error.failover_only:
+            return None
+        if error.retry_after is not None:
+            if error.retry_after > self.max_delay:
+                return None
+            return error.retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (retry - 1))))
+
+    def record(self, delay: Optional[float]):
+        """记录一次重试决定"""
+        if delay is None:
+            self.gave_up += 1
+        else:
+            self.retries += 1
+            self.retry_sleep_seconds += delay
+
+    def stats(self) -> Dict:
+        return {
+            "retries": self.retries,
+            "retry_sleep_seconds": round(self.retry_sleep_seconds, 3),
+            "gave_up": self.gave_up,
+            "max_retries": self.max_retries
+        }
+
+
+class HedgePolicy:
+    """
+    一个模型（副本组）的非流式请求对冲策略
+
+    请求超过近期延迟的 percentile 分位数仍未返回时，向另一个副本再发送一次，先返回者胜出。
+    对冲额度按令牌桶计算：每个请求存入 budget 个令牌，每次对冲消耗一个，
+    因此对冲请求数不超过请求总数的 budget 比例。
+    """
+
+    def __init__(self, percentile: float = LLM_HEDGE_PERCENTILE, budget: float = LLM_HEDGE_BUDGET):
+        self.percentile = percentile
+        self.budget = budget
+        self._latencies: Deque[float] = deque(maxlen=_HEDGE_SAMPLES)
+        self._tokens = 0.0
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.percentile > 0 and self.budget > 0
+
+    def record_latency(self, seconds: float):
+        """记录一次成功请求的延迟"""
+        self._latencies.append(seconds)
+
+    def begin(self) -> Optional[float]:
+        """
+        开始一个请求：存入对冲额度，并计算等待多久后对冲
+
+        Returns:
+            等待秒数，未开启或样本不足时返回None
+        """
+        if not self.enabled:
+            return None
+        self.requests += 1
+        self._tokens = min(self._tokens + self.budget, _HEDGE_MAX_TOKENS)
+        if len(self._latencies) < _HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+        return ordered[index]
+
+    def try_acquire(self) -> bool:
+        """消耗一次对冲额度，额度不足时返回False"""
+        if self._tokens < 1:
+            self.budget_exhausted += 1
+            return False
+        self._tokens -= 1
+        self.hedged += 1
+        return True
+
+    def stats(self) -> Dict:
+        return {
+            "percentile": self.percentile,
+            "budget": self.budget,
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget_exhausted": self.budget_exhausted
+        }
@@ -0,0 +1,251 @@
+"""
+大模型回复的精确匹配缓存：相同模型、消息和生成参数的确定性请求直接返回上次的回复
+
+- 内存层：按条目数和字节数限制的LRU，条目有过期时间
+- 磁盘层（可选）：独立的SQLite文件，重启后仍可命中；内存未命中时查询并回填内存
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+from model_registry import ModelTarget
+import jsonutil
+from config import (
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_SECONDS,
+    RESPONSE_CACHE_DB_PATH, RESPONSE_CACHE_DB_MAX_ENTRIES
+)
+
+# 每个缓存条目的固定内存开销估算（键和元组本身）
+_ENTRY_OVERHEAD_BYTES = 200
+# 回放缓存回复时每个片段的字符数
+_REPLAY_CHUNK_CHARS = 16
+# 磁盘层每写入多少次清理一次过期和超量的条目
+_DISK_PRUNE_EVERY = 500
+# 磁盘层的内存映射大小（字节），读取命中时不必经过read系统调用
+_DISK_MMAP_BYTES = 256 * 1024 * 1024
+
+
+def shareable(messages: List[Dict[str, str]]) -> bool:
+    """请求是否只有当前这一条用户消息（没有历史、摘要和系统提示），不含用户的私有内容"""
+    return len(messages) == 1 and messages[0]["role"] == "user"
+
+
+def cache_scope(messages: List[Dict[str, str]], user_id: Optional[int]) -> Optional[int]:
+    """
+    缓存的共享范围
+
+    只有当前这一条用户消息（没有历史和摘要）时，请求中没有该用户的私有内容，可以跨用户共享；
+    否则按用户隔离，其他用户不能命中（也就无法推测出别人的对话内容）。
+
+    Returns:
+        None 表示跨用户共享，否则为用户ID
+    """
+    if shareable(messages):
+        return None
+    return user_id
+
+
+def reusable(temperature: float, cache: Optional[bool] = None) -> bool:
+    """
+    请求的结果是否可以复用（缓存或合并）
+
+    Args:
+        temperature: 温度参数
+        cache: 调用方的选择；None 时只有 temperature 为0的确定性请求可以复用，
+            True 表示调用方接受复用结果（例如标题），False 表示不复用
+    """
+    if cache is not None:
+        return cache
+    return temperature == 0
+
+
+def replay(text: str, chunk_chars: int = _REPLAY_CHUNK_CHARS) -> AsyncGenerator[str, None]:
+    """把缓存的完整回复按固定长度切片，作为流式片段依次输出"""
+
+    async def generate():
+        for start in range(0, len(text), chunk_chars):
+            yield text[start:start + chunk_chars]
+            # 让出事件循环，长回复回放时不阻塞其他请求
+            await asyncio.sleep(0)
+
+    return generate()
+
+
+class ResponseCache:
+    """内存LRU + 可选SQLite磁盘层的回复缓存"""
+
+    def __init__(self, enabled: bool = RESPONSE_CACHE_ENABLED, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES, ttl: float = RESPONSE_CACHE_TTL_SECONDS,
+                 db_path: str = RESPONSE_CACHE_DB_PATH, db_max_entries: int = RESPONSE_CACHE_DB_MAX_ENTRIES):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self.db_max_entries = db_max_entries
+        # key -> (过期时间, 回复, 占用字节)
+        self._entries: "OrderedDict[str, Tuple[float, str, int]]" = OrderedDict()
+        self.nbytes = 0
+        self._db = None
+        self._disk_writes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expired = 0
+
+    @staticmethod
+    def make_key(target: ModelTarget, messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+                 scope: Optional[int] = None) -> str:
+        """
+        规范化请求并计算SHA-256作为缓存键
+
+        包含模型地址和API密钥的哈希，不同上游或不同账号（自定义模型）上同名的模型不会互相命中；
+        scope 为用户ID时只在该用户内命中。
+        """
+        canonical = jsonutil.dumps_bytes([
+            list(target.endpoints), target.model, hashlib.sha256((target.api_key or "").encode("utf-8")).hexdigest(),
+            [[message["role"], message["content"]] for message in messages],
+            float(temperature), max_tokens, scope
+        ])
+        return hashlib.sha256(canonical).hexdigest()
+
+    def cacheable(self, temperature: float, cache: Optional[bool] = None) -> bool:
+        """本次请求是否使用缓存（见 reusable）"""
+        return self.enabled and reusable(temperature, cache)
+
+    async def startup(self):
+        """打开磁盘层（配置了 RESPONSE_CACHE_DB_PATH 时）"""
+        if not self.enabled or not self.db_path or self._db is not None:
+            return
+        import aiosqlite
+
+        try:
+            self._db = await aiosqlite.connect(self.db_path)
+            await self._db.execute("PRAGMA journal_mode=WAL")
+            await self._db.execute("PRAGMA synchronous=NORMAL")
+            await self._db.execute(f"PRAGMA mmap_size={_DISK_MMAP_BYTES}")
+            await self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, created_at REAL NOT NULL)"
+            )
+            await self._db.execute(
+                "CREATE INDEX IF NOT EXISTS ix_response_cache_created_at ON response_cache (created_at)"
+            )
+            await self._db.commit()
+            await self._prune_disk()
+            print(f"[RESPONSE CACHE] 磁盘缓存: {self.db_path}")
+        except Exception as e:
+            print(f"[RESPONSE CACHE] 打开磁盘缓存失败，只使用内存缓存: {str(e)}")
+            await self.shutdown()
+
+    async def shutdown(self):
+        """关闭磁盘层"""
+        if self._db is not None:
+            db, self._db = self._db, None
+            try:
+                await db.close()
+            except Exception:
+                pass
+
+    async def get(self, key: str) -> Optional[str]:
+        """查询缓存，内存未命中时查询磁盘层并回填内存"""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._remove(key)
+            self.expired += 1
+
+        if self._db is not None:
+            try:
+                async with self._db.execute(
+                    "SELECT value, expires_at FROM response_cache WHERE key = ? AND expires_at > ?", (key, now)
+                ) as cursor:
+                    row = await cursor.fetchone()
+            except Exception as e:
+                print(f"[RESPONSE CACHE] 读取磁盘缓存失败: {str(e)}")
+                row = None
+            if row is not None:
+                self._store_memory(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: str):
+        """写入缓存（空回复不缓存）"""
+        if not value:
+            return
+        now = time.time()
+        expires_at = now + self.ttl
+        self._store_memory(key, value, expires_at)
+        self.stores += 1
+
+        if self._db is not None:
+            try:
+                await self._db.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, expires_at, created_at) VALUES (?, ?, ?, ?)",
+                    (key, value, expires_at, now)
+                )
+                await self._db.commit()
+                self._disk_writes += 1
+                if self._disk_writes % _DISK_PRUNE_EVERY == 0:
+                    await self._prune_disk()
+            except Exception as e:
+                print(f"[RESPONSE CACHE] 写入磁盘缓存失败: {str(e)}")
+
+    def _store_memory(self, key: str, value: str, expires_at: float):
+        nbytes = len(value.encode("utf-8")) + _ENTRY_OVERHEAD_BYTES
+        if nbytes > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (expires_at, value, nbytes)
+        self.nbytes += nbytes
+        while self._entries and (len(self._entries) > self.max_entries or self.nbytes > self.max_bytes):
+            _, (_, _, evicted_bytes) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_bytes
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    async def _prune_disk(self):
+        """删除磁盘层中过期的条目，并把条目数限制在 db_max_entries 以内（先删最早写入的）"""
+        await self._db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+        await self._db.execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            "SELECT key FROM response_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.db_max_entries,)
+        )
+        await self._db.commit()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "disk": self._db is not None,
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expired": self.expired
+        }
+
+
+# 创建全局回复缓存实例
+response_cache = ResponseCache()
@@ -0,0 +1,191 @@
+"""
+旧对话清理：后台定时按用户保留数量批量删除最旧的对话
+"""
+import asyncio
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, Conversation, Message, UserConfig
+from history_cache import history_cache
+from config import RETENTION_ENABLED, RETENTION_MAX_CONVERSATIONS, RETENTION_INTERVAL_SECONDS, RETENTION_BATCH_SIZE
+
+
+class RetentionWorker:
+    """
+    旧对话清理任务
+
+    启动后先全量检查一次所有用户，之后每轮只检查期间新建过对话或修改过保留数量的用户。
+    超出保留数量的对话按 (updated_at, id) 从旧到新分批删除，每批一个事务，
+    使用集合式 DELETE 同时删除消息和对话，不经过 ORM 级联。
+    """
+
+    def __init__(self, max_conversations: int = RETENTION_MAX_CONVERSATIONS,
+                 interval: float = RETENTION_INTERVAL_SECONDS, batch_size: int = RETENTION_BATCH_SIZE,
+                 enabled: bool = RETENTION_ENABLED):
+        self.enabled = enabled
+        self.max_conversations = max_conversations
+        self.interval = interval
+        self.batch_size = batch_size
+        self._dirty_users: Set[int] = set()
+        self._task: Optional[asyncio.Task] = None
+
+        self.runs = 0
+        self.failures = 0
+        self.users_trimmed = 0
+        self.conversations_deleted = 0
+        self.messages_deleted = 0
+        self.seconds_total = 0.0
+        self.last_run_seconds = 0.0
+
+    def mark(self, user_id: int):
+        """标记用户需要在下一轮检查（新建对话或修改保留数量时调用）"""
+        self._dirty_users.add(user_id)
+
+    def start(self):
+        """启动后台清理循环"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def shutdown(self):
+        """停止后台清理循环（进行中的批次会回滚）"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        full_sweep = True
+        while True:
+            try:
+                await self.run_once(full_sweep=full_sweep)
+                full_sweep = False
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                print(f"[RETENTION] 清理旧对话失败: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self, full_sweep: bool = False) -> Tuple[int, int]:
+        """
+        执行一轮清理
+
+        Args:
+            full_sweep: 是否检查所有用户，否则只检查被标记的用户
+
+        Returns:
+            (删除的对话数, 删除的消息数)
+        """
+        started = time.perf_counter()
+        deleted_conversations = deleted_messages = 0
+
+        async with AsyncSessionLocal() as db:
+            if full_sweep:
+                result = await db.execute(select(Conversation.user_id).group_by(Conversation.user_id))
+                user_ids = [user_id for (user_id,) in result.all()]
+                self._dirty_users.clear()
+            else:
+                user_ids = list(self._dirty_users)
+                self._dirty_users.clear()
+
+            limits = await self._user_limits(db, user_ids)
+            for user_id in user_ids:
+                limit = limits.get(user_id, self.max_conversations)
+                if limit <= 0:
+                    continue
+                conversations, messages = await self.trim_user(db, user_id, limit)
+                if conversations:
+                    self.users_trimmed += 1
+                    deleted_conversations += conversations
+                    deleted_messages += messages
+                    print(f"[RETENTION] 已清理用户 {user_id} 的 {conversations} 条旧对话（{messages} 条消息）")
+
+        elapsed = time.perf_counter() - started
+        self.runs += 1
+        self.conversations_deleted += deleted_conversations
+        self.messages_deleted += deleted_messages
+        self.seconds_total += elapsed
+        self.last_run_seconds = elapsed
+        return deleted_conversations, deleted_messages
+
+    @staticmethod
+    def excess_query(user_id: int, limit: int, batch_size: int):
+        """跳过最新的 limit 条，取下一批最旧的对话（执行计划检查也使用这个语句）"""
+        return (
+            select(Conversation.id, Conversation.session_id)
+            .where(Conversation.user_id == user_id)
+            .order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+            .limit(batch_size)
+            .offset(limit)
+        )
+
+    async def _user_limits(self, db: AsyncSession, user_ids: Iterable[int]) -> Dict[int, int]:
+        """读取用户单独设置的保留数量（未设置的用户不在结果中）"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        result = await db.execute(
+            select(UserConfig.user_id, UserConfig.max_conversations)
+            .where(UserConfig.user_id.in_(user_ids), UserConfig.max_conversations.isnot(None))
+        )
+        return dict(result.all())
+
+    async def trim_user(self, db: AsyncSession, user_id: int, limit: int) -> Tuple[int, int]:
+        """
+        删除用户超出保留数量的旧对话
+
+        Args:
+            db: 数据库会话
+            user_id: 用户ID
+            limit: 保留的对话数
+
+        Returns:
+            (删除的对话数, 删除的消息数)
+        """
+        deleted_conversations = deleted_messages = 0
+        while True:
+            # 跳过最新的 limit 条，取下一批最旧的对话（走 (user_id, updated_at) 索引）
+            result = await db.execute(self.excess_query(user_id, limit, self.batch_size))
+            rows = result.all()
+            if not rows:
+                break
+
+            ids = [conversation_id for conversation_id, _ in rows]
+            messages = await db.execute(
+                delete(Message).where(Message.conversation_id.in_(ids)).execution_options(synchronize_session=False)
+            )
+            conversations = await db.execute(
+                delete(Conversation).where(Conversation.id.in_(ids)).execution_options(synchronize_session=False)
+            )
+            await db.commit()
+
+            for _, session_id in rows:
+                history_cache.invalidate(session_id)
+            deleted_messages += messages.rowcount
+            deleted_conversations += conversations.rowcount
+
+            if len(rows) < self.batch_size:
+                break
+            # 批次之间让出事件循环和数据库写锁
+            await asyncio.sleep(0)
+
+        return deleted_conversations, deleted_messages
+
+    def stats(self) -> Dict:
+        """清理统计信息"""
+        return {
+            "enabled": self.enabled,
+            "runs": self.runs,
+            "failures": self.failures,
+            "pending_users": len(self._dirty_users),
+            "users_trimmed": self.users_trimmed,
+            "conversations_deleted": self.conversations_deleted,
+            "messages_deleted": self.messages_deleted,
+            "seconds_total": round(self.seconds_total, 3),
+            "last_run_seconds": round(self.last_run_seconds, 3)
+        }
+
+
+# 创建全局清理任务实例
+retention_worker = RetentionWorker()
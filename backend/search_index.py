@@ -0,0 +1,224 @@
+"""
+对话全文检索：基于 SQLite FTS5（trigram 分词，支持中日韩文本）的搜索索引
+"""
+from typing import Dict, List, Tuple
+from sqlalchemy import text
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# trigram 分词按3个字符切分，更短的关键词无法命中索引
+FTS_MIN_QUERY_LENGTH = 3
+
+# 片段最多包含的token数（trigram下约等于字符数）
+SNIPPET_TOKENS = 32
+
+# 标题命中时的排序加权（bm25 分数越小越相关）
+TITLE_WEIGHT = 2.0
+
+# FTS 表和同步触发器：外部内容表，不重复存储正文
+_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+        title, content='conversations', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS conversations_fts_ai AFTER INSERT ON conversations BEGIN
+        INSERT INTO conversations_fts(rowid, title) VALUES (new.id, new.title);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS conversations_fts_ad AFTER DELETE ON conversations BEGIN
+        INSERT INTO conversations_fts(conversations_fts, rowid, title) VALUES ('delete', old.id, old.title);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS conversations_fts_au AFTER UPDATE OF title ON conversations BEGIN
+        INSERT INTO conversations_fts(conversations_fts, rowid, title) VALUES ('delete', old.id, old.title);
+        INSERT INTO conversations_fts(rowid, title) VALUES (new.id, new.title);
+    END""",
+]
+
+# 一条SQL完成检索、排序、片段和分页：每个对话取最相关的一条消息命中作为预览
+_FTS_SEARCH_SQL = text(f"""
+WITH hits AS (
+    SELECT m.conversation_id AS cid,
+           bm25(messages_fts) AS score,
+           snippet(messages_fts, 0, '', '', '…', {SNIPPET_TOKENS}) AS preview,
+           1 AS is_message
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    JOIN conversations c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH :match AND c.user_id = :user_id
+    UNION ALL
+    SELECT c.id AS cid,
+           bm25(conversations_fts) * {TITLE_WEIGHT} AS score,
+           '' AS preview,
+           0 AS is_message
+    FROM conversations_fts
+    JOIN conversations c ON c.id = conversations_fts.rowid
+    WHERE conversations_fts MATCH :match AND c.user_id = :user_id
+),
+ranked AS (
+    -- 排序用含标题加权的最佳分数；预览只从消息命中中选（标题命中没有预览），没有消息命中时为空
+    SELECT cid,
+           MIN(score) OVER (PARTITION BY cid) AS best,
+           SUM(is_message) OVER (PARTITION BY cid) AS match_count,
+           preview,
+           ROW_NUMBER() OVER (PARTITION BY cid ORDER BY is_message DESC, score) AS rn
+    FROM hits
+)
+SELECT c.session_id, c.title, c.created_at, c.updated_at,
+       r.match_count, r.preview, COUNT(*) OVER () AS total, c.message_count
+FROM ranked r
+JOIN conversations c ON c.id = r.cid
+WHERE r.rn = 1
+ORDER BY r.best, c.updated_at DESC
+LIMIT :limit OFFSET :offset
+""")
+
+# 短关键词或非 SQLite 数据库时的退化方案：仍限定在该用户的对话内，一次聚合完成计数和分页
+_LIKE_SEARCH_SQL = text("""
+WITH hits AS (
+    SELECT m.conversation_id AS cid, COUNT(*) AS match_count, MIN(m.id) AS first_id
+    FROM messages m
+    JOIN conversations c ON c.id = m.conversation_id
+    WHERE c.user_id = :user_id AND m.content LIKE :pattern ESCAPE '\\'
+    GROUP BY m.conversation_id
+    UNION ALL
+    SELECT c.id AS cid, 0 AS match_count, NULL AS first_id
+    FROM conversations c
+    WHERE c.user_id = :user_id AND c.title LIKE :pattern ESCAPE '\\'
+),
+ranked AS (
+    SELECT cid, SUM(match_count) AS match_count, MIN(first_id) AS first_id
+    FROM hits
+    GROUP BY cid
+)
+SELECT c.session_id, c.title, c.created_at, c.updated_at,
+       r.match_count, m.content, COUNT(*) OVER () AS total, c.message_count
+FROM ranked r
+JOIN conversations c ON c.id = r.cid
+LEFT JOIN messages m ON m.id = r.first_id
+ORDER BY c.updated_at DESC
+LIMIT :limit OFFSET :offset
+""")
+
+# init_db 检测到全文索引存在后置为 True
+FTS_ENABLED = False
+
+
+def create_search_index(conn) -> bool:
+    """
+    创建全文检索表和同步触发器并回填已有数据（由迁移调用）
+
+    Args:
+        conn: 同步数据库连接（在 engine.begin() 事务内）
+
+    Returns:
+        是否创建成功，非 SQLite 或 SQLite 不支持 FTS5 trigram 时返回 False
+    """
+    if conn.dialect.name != "sqlite":
+        return False
+    try:
+        for ddl in _FTS_DDL:
+            conn.execute(text(ddl))
+    except Exception as e:
+        # SQLite 未编译 FTS5 或版本过旧不支持 trigram 分词
+        print(f"[SEARCH] 全文索引不可用，搜索将退化为LIKE扫描: {str(e)}")
+        return False
+
+    conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+    conn.execute(text("INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')"))
+    print("[SEARCH] 已创建全文索引并回填历史数据")
+    return True
+
+
+def detect_search_index(conn) -> bool:
+    """
+    检查全文索引是否存在，并据此决定搜索是否走 FTS
+
+    Args:
+        conn: 同步数据库连接
+
+    Returns:
+        FTS 索引是否可用
+    """
+    global FTS_ENABLED
+    FTS_ENABLED = conn.dialect.name == "sqlite" and conn.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+    ).first() is not None
+    return FTS_ENABLED
+
+
+def _fts_phrase(query: str) -> str:
+    """把用户输入转成 FTS5 短语查询（整体子串匹配，与原 LIKE 语义一致）"""
+    return '"' + query.replace('"', '""') + '"'
+
+
+def _like_pattern(query: str) -> str:
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _like_preview(content: str, query: str) -> str:
+    """LIKE 退化路径下在命中位置前后各截取50个字符作为预览"""
+    if not content:
+        return ""
+    index = content.lower().find(query.lower())
+    if index == -1:
+        return ""
+    start = max(0, index - 50)
+    end = min(len(content), index + len(query) + 50)
+    return content[start:end]
+
+
+def _isoformat(value) -> str:
+    # 原生SQL返回的时间在 SQLite 下是字符串
+    return value.isoformat() if hasattr(value, "isoformat") else str(value).replace(" ", "T")
+
+
+def search_statement(user_id: int, query: str, limit: int, offset: int, use_fts: bool) -> Tuple[TextClause, Dict]:
+    """检索使用的语句和参数（执行计划检查也使用这个语句，见 migrations.check_query_plans）"""
+    if use_fts:
+        return _FTS_SEARCH_SQL, {"match": _fts_phrase(query), "user_id": user_id, "limit": limit, "offset": offset}
+    return _LIKE_SEARCH_SQL, {"pattern": _like_pattern(query), "user_id": user_id, "limit": limit, "offset": offset}
+
+
+async def search(db: AsyncSession, user_id: int, query: str, limit: int, offset: int) -> Tuple[List[Dict], int]:
+    """
+    在用户的对话标题和消息中检索关键词
+
+    Args:
+        db: 数据库会话
+        user_id: 用户ID
+        query: 搜索关键词
+        limit: 每页条数
+        offset: 偏移量
+
+    Returns:
+        (当前页结果, 命中的对话总数)
+    """
+    use_fts = FTS_ENABLED and len(query) >= FTS_MIN_QUERY_LENGTH
+    result = await db.execute(*search_statement(user_id, query, limit, offset, use_fts))
+
+    rows = result.all()
+    total = rows[0][6] if rows else 0
+    items = []
+    for session_id, title, created_at, updated_at, match_count, preview, _, message_count in rows:
+        items.append({
+            "session_id": session_id,
+            "title": title,
+            "created_at": _isoformat(created_at),
+            "updated_at": _isoformat(updated_at),
+            "message_count": message_count,
+            "match_count": match_count,
+            "preview": (preview or "") if use_fts else _like_preview(preview, query)
+        })
+    return items, total
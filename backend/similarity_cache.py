@@ -0,0 +1,203 @@
+"""
+近似重复提示缓存：用 SimHash 指纹和 LSH 分段索引匹配只有空白、标点或个别字词不同的问题
+
+- 指纹：最后一条用户消息规范化（NFKC、小写、去掉空白和标点）后按字符3-gram计算64位 SimHash
+- 上下文：之前的消息、模型和生成参数必须完全相同（按 ResponseCache.make_key 计算的哈希分组）
+- 索引：64位指纹分成4段，任意一段相同即为候选；汉明距离不超过3（相似度≥0.95）时必定有一段相同
+- 全部在进程内计算，不依赖向量模型
+"""
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Union
+from config import SIMILARITY_CACHE_ENABLED, SIMILARITY_CACHE_MAX_ENTRIES, SIMILARITY_CACHE_THRESHOLD, RESPONSE_CACHE_TTL_SECONDS
+
+_BITS = 64
+_MASK = (1 << _BITS) - 1
+_SHINGLE = 3
+# 参与计算的最长文本（字符），保证每位的计数不超过16位
+_MAX_TEXT_CHARS = 4096
+# 规范化后短于该长度的文本不参与近似匹配（太短时一两个字的差异就是不同的问题）
+_MIN_TEXT_CHARS = 8
+_BANDS = 4
+_BAND_BITS = _BITS // _BANDS
+_BAND_MASK = (1 << _BAND_BITS) - 1
+# 每位计数占16位：把64位哈希按字节展开到 64×16 位的大整数中，8次查表相加即可累计全部64位
+_LANE_BITS = 16
+_LANE_MASK = (1 << _LANE_BITS) - 1
+
+
+def _build_spread_tables() -> List[List[int]]:
+    tables = []
+    for byte_index in range(_BITS // 8):
+        table = []
+        for value in range(256):
+            spread = 0
+            for bit in range(8):
+                if value >> bit & 1:
+                    spread |= 1 << ((byte_index * 8 + bit) * _LANE_BITS)
+            table.append(spread)
+        tables.append(table)
+    return tables
+
+
+_SPREAD = _build_spread_tables()
+
+
+def normalize(text: str) -> str:
+    """NFKC规范化（全角转半角）、小写，去掉空白、标点和控制字符（保留 + # 等符号，C++ 和 C 是不同的问题）"""
+    text = unicodedata.normalize("NFKC", text[:_MAX_TEXT_CHARS]).lower()
+    return "".join(char for char in text if unicodedata.category(char)[0] not in "PZC")
+
+
+def simhash(text: str) -> int:
+    """
+    规范化文本的64位 SimHash（字符3-gram，同一进程内稳定）
+
+    Returns:
+        指纹；文本太短时返回 -1
+    """
+    if len(text) < _MIN_TEXT_CHARS:
+        return -1
+    shingles = {text[index:index + _SHINGLE] for index in range(len(text) - _SHINGLE + 1)}
+    t0, t1, t2, t3, t4, t5, t6, t7 = _SPREAD
+    counts = 0
+    for shingle in shingles:
+        value = hash(shingle) & _MASK
+        counts += (t0[value & 255] + t1[value >> 8 & 255] + t2[value >> 16 & 255] + t3[value >> 24 & 255]
+                   + t4[value >> 32 & 255] + t5[value >> 40 & 255] + t6[value >> 48 & 255] + t7[value >> 56])
+    half = len(shingles) / 2
+    fingerprint = 0
+    for bit in range(_BITS):
+        if (counts >> (bit * _LANE_BITS) & _LANE_MASK) > half:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def similarity(a: int, b: int) -> float:
+    """两个指纹的相似度（1 - 汉明距离/64）"""
+    return 1 - (a ^ b).bit_count() / _BITS
+
+
+class SimilarityCache:
+    """
+    按条目数限制的近似匹配缓存（LRU，条目有过期时间）
+
+    每个条目在4个分段桶中登记；桶的值只有一个条目时直接存条目编号，多个时存列表，节省内存。
+    """
+
+    def __init__(self, enabled: bool = SIMILARITY_CACHE_ENABLED, max_entries: int = SIMILARITY_CACHE_MAX_ENTRIES,
+                 threshold: float = SIMILARITY_CACHE_THRESHOLD, ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        # 条目编号 -> (上下文哈希, 指纹, 过期时间, 回复)
+        self._entries: "OrderedDict[int, Tuple[int, int, float, str]]" = OrderedDict()
+        self._buckets: Dict[int, Union[int, List[int]]] = {}
+        self._next_id = 0
+
+        self.lookups = 0
+        self.hits = 0
+        self.candidates = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _bucket_keys(context: int, fingerprint: int) -> List[int]:
+        # 上下文哈希、段号和段值拼成一个整数键
+        return [
+            (context << 20) | (band << _BAND_BITS) | (fingerprint >> (band * _BAND_BITS) & _BAND_MASK)
+            for band in range(_BANDS)
+        ]
+
+    @staticmethod
+    def context_hash(key: str) -> int:
+        """由上下文的SHA-256（十六进制）取44位作为分组"""
+        return int(key[:11], 16)
+
+    def get(self, context: int, text: str) -> Optional[str]:
+        """
+        查找与 text 足够相似、上下文相同的缓存回复
+
+        Args:
+            context: 上下文哈希（见 context_hash）
+            text: 最后一条用户消息
+        """
+        fingerprint = simhash(normalize(text))
+        if fingerprint < 0:
+            return None
+        self.lookups += 1
+        now = time.time()
+        best_id, best_similarity = None, self.threshold
+        seen = set()
+        for bucket_key in self._bucket_keys(context, fingerprint):
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                continue
+            for entry_id in (bucket,) if isinstance(bucket, int) else bucket:
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+                entry_context, entry_fingerprint, expires_at, _ = self._entries[entry_id]
+                if entry_context != context or expires_at <= now:
+                    continue
+                score = similarity(fingerprint, entry_fingerprint)
+                if score >= best_similarity:
+                    best_id, best_similarity = entry_id, score
+        self.candidates += len(seen)
+        if best_id is None:
+            return None
+        self._entries.move_to_end(best_id)
+        self.hits += 1
+        return self._entries[best_id][3]
+
+    def put(self, context: int, text: str, value: str):
+        """登记一条回复（文本太短或回复为空时忽略）"""
+        fingerprint = simhash(normalize(text))
+        if fingerprint < 0 or not value:
+            return
+        self.put_fingerprint(context, fingerprint, value)
+
+    def put_fingerprint(self, context: int, fingerprint: int, value: str):
+        """按已计算的指纹登记一条回复"""
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (context, fingerprint, time.time() + self.ttl, value)
+        for bucket_key in self._bucket_keys(context, fingerprint):
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                self._buckets[bucket_key] = entry_id
+            elif isinstance(bucket, int):
+                self._buckets[bucket_key] = [bucket, entry_id]
+            else:
+                bucket.append(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        entry_id, (context, fingerprint, _, _) = self._entries.popitem(last=False)
+        self.evictions += 1
+        for bucket_key in self._bucket_keys(context, fingerprint):
+            bucket = self._buckets.get(bucket_key)
+            if isinstance(bucket, int):
+                del self._buckets[bucket_key]
+            elif bucket is not None:
+                bucket.remove(entry_id)
+                if len(bucket) == 1:
+                    self._buckets[bucket_key] = bucket[0]
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "threshold": self.threshold,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_ratio": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "candidates": self.candidates,
+            "evictions": self.evictions
+        }
+
+
+# 创建全局近似匹配缓存实例
+similarity_cache = SimilarityCache()
@@ -0,0 +1,181 @@
+"""
+相同请求合并（single-flight）：同一时刻完全相同的大模型请求只向上游发送一次
+
+- 非流式：后到的请求等待同一个上游调用的结果
+- 流式：后到的请求先回放已经收到的片段，再跟随实时片段
+- 上游调用在独立任务中运行，发起者断开不影响其他等待者；所有等待者都离开后才取消
+"""
+import asyncio
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Tuple
+from config import SINGLEFLIGHT_ENABLED
+
+
+def _consume_exception(task: asyncio.Task):
+    """没有等待者时任务的异常也要取出，避免 "Task exception was never retrieved" 警告"""
+    if not task.cancelled():
+        task.exception()
+
+
+class _Call:
+    """一个进行中的非流式调用"""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class StreamFlight:
+    """
+    一个进行中的流式调用：后台任务读取上游片段并缓存，订阅者从头回放后跟随
+    """
+
+    def __init__(self, source: AsyncGenerator[str, None]):
+        self.chunks: List[str] = []
+        self.done = False
+        # 所有订阅者都已离开、上游读取正在取消，不能再加入
+        self.abandoned = False
+        self.error: Optional[Exception] = None
+        self.subscribers = 0
+        self._changed = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._produce(source))
+        self._task.add_done_callback(_consume_exception)
+
+    async def _produce(self, source: AsyncGenerator[str, None]):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            await source.aclose()
+
+    def add_done_callback(self, callback: Callable[[asyncio.Task], None]):
+        """上游读取结束（完成、失败或取消）时调用"""
+        self._task.add_done_callback(callback)
+
+    @property
+    def joinable(self) -> bool:
+        return not self.done and not self.abandoned
+
+    def _notify(self):
+        if not self._changed.done():
+            self._changed.set_result(None)
+        self._changed = asyncio.get_running_loop().create_future()
+
+    async def subscribe(self) -> AsyncGenerator[str, None]:
+        """从第一个片段开始输出；最后一个订阅者离开时取消上游读取"""
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                    index += 1
+                    yield chunk
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await asyncio.shield(self._changed)
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.abandoned = True
+                self._task.cancel()
+
+
+class SingleFlight:
+    """按请求键合并进行中的相同请求"""
+
+    def __init__(self, enabled: bool = SINGLEFLIGHT_ENABLED):
+        self.enabled = enabled
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, StreamFlight] = {}
+
+        self.calls = 0
+        self.coalesced = 0
+        self.streams = 0
+        self.stream_joined = 0
+        self.replayed_chunks = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[str]]) -> str:
+        """
+        执行请求；相同键的请求进行中时等待它的结果
+
+        Args:
+            key: 请求键（见 ResponseCache.make_key，带有用户私有内容的请求按用户隔离）
+            factory: 发起上游调用的函数，只在没有进行中的相同请求时调用
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(factory()))
+            call.task.add_done_callback(_consume_exception)
+            call.task.add_done_callback(lambda _: self._forget(self._calls, key, call))
+            self._calls[key] = call
+            self.calls += 1
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            # 所有等待者都已离开（被取消）时不再需要结果；立即移除，之后的相同请求重新发起
+            if call.waiters == 0 and not call.task.done():
+                self._forget(self._calls, key, call)
+                call.task.cancel()
+
+    def stream(self, key: str, factory: Callable[[], AsyncGenerator[str, None]],
+               on_done: Optional[Callable[[], None]] = None) -> Tuple[AsyncGenerator[str, None], bool]:
+        """
+        订阅流式请求；相同键的流进行中时加入它
+
+        Args:
+            key: 请求键
+            factory: 创建上游流的函数，只在没有进行中的相同流时调用
+            on_done: 新建的流上游读取结束（完成、失败或取消，包括开始前就被取消）时调用；加入已有的流时不调用
+
+        Returns:
+            (片段生成器, 是否加入了已有的流)
+        """
+        flight = self._streams.get(key)
+        joined = flight is not None and flight.joinable
+        if joined:
+            self.stream_joined += 1
+            self.replayed_chunks += len(flight.chunks)
+        else:
+            flight = StreamFlight(factory())
+            flight.add_done_callback(lambda _: self._forget(self._streams, key, flight))
+            if on_done is not None:
+                flight.add_done_callback(lambda _: on_done())
+            self._streams[key] = flight
+            self.streams += 1
+        return flight.subscribe(), joined
+
+    @staticmethod
+    def _forget(table: Dict, key: str, value):
+        if table.get(key) is value:
+            del table[key]
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._calls),
+            "streams_in_flight": len(self._streams),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "streams": self.streams,
+            "stream_joined": self.stream_joined,
+            "replayed_chunks": self.replayed_chunks
+        }
+
+
+# 创建全局请求合并实例
+singleflight = SingleFlight()
@@ -0,0 +1,199 @@
+"""
+增量SSE解析：在字节层面切分行和事件，适用于上游大模型的流式响应
+"""
+import re
+from typing import AsyncIterable, AsyncIterator, List, Optional
+
+# SSE 允许 CRLF、LF、CR 三种换行；这些字节不会出现在UTF-8多字节字符内部，
+# 因此按字节切出的每一行都是完整的UTF-8序列，汉字被TCP分包拆开也不会丢字
+_EOL_RE = re.compile(rb"\r\n|\r|\n")
+
+
+class SSEEvent:
+    """一个SSE事件，data 保留原始字节，可直接交给JSON解析"""
+
+    __slots__ = ("event", "raw", "id", "retry")
+
+    def __init__(self, raw: bytes, event: str = "message", id: Optional[str] = None, retry: Optional[int] = None):
+        self.raw = raw
+        self.event = event
+        self.id = id
+        self.retry = retry
+
+    @property
+    def data(self) -> str:
+        return self.raw.decode("utf-8", errors="replace")
+
+    def __repr__(self):
+        return f"SSEEvent(event={self.event!r}, data={self.data!r}, id={self.id!r})"
+
+
+class SSEDecoder:
+    """
+    增量SSE解码器
+
+    每次 feed 只扫描新到达的字节，所有完整行处理完后才一次性丢弃已消费的前缀，
+    不会像字符串拼接+split那样反复复制缓冲区。多行 data 按规范以换行拼接。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data: List[bytes] = []
+        self._event = ""
+        self._id: Optional[str] = None
+        self._retry: Optional[int] = None
+        self.last_event_id: Optional[str] = None
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """
+        输入一段字节，返回其中已完整的事件
+
+        Args:
+            chunk: 上游返回的原始字节（可以在任意位置被截断）
+
+        Returns:
+            已完整的事件列表
+        """
+        buffer = self._buffer
+        # 绝大多数上游只用 LF 换行，走 bytes.find 快速路径；出现 CR 时才用正则处理三种换行
+        if 0x0D in chunk or (buffer and buffer[-1] == 0x0D):
+            return self._feed_any_eol(chunk)
+
+        newline = chunk.find(b"\n")
+        if newline == -1:
+            buffer += chunk
+            return []
+
+        events = []
+        start = 0
+        if buffer:
+            # 只有跨块的第一行需要与缓冲区拼接，其余行直接在本次的 bytes 上切片
+            buffer += chunk[:newline]
+            line = bytes(buffer)
+            buffer.clear()
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+            start = newline + 1
+            newline = chunk.find(b"\n", start)
+
+        while newline != -1:
+            event = self._process_line(chunk[start:newline])
+            if event is not None:
+                events.append(event)
+            start = newline + 1
+            newline = chunk.find(b"\n", start)
+
+        if start < len(chunk):
+            buffer += chunk[start:]
+        return events
+
+    def _feed_any_eol(self, chunk: bytes) -> List[SSEEvent]:
+        """支持 CRLF、LF、CR 三种换行的通用路径"""
+        buffer = self._buffer
+        scan_from = len(buffer)
+        buffer.extend(chunk)
+        # 上一次末尾的 \r 可能与本次开头的 \n 组成 CRLF，需要从该位置重新匹配
+        if scan_from and buffer[scan_from - 1] == 0x0D:
+            scan_from -= 1
+
+        events = []
+        start = 0
+        end = len(buffer)
+        # 已消费的前缀在上次 feed 末尾删除，剩余部分不含完整的换行，只需从新数据开始查找
+        pos = scan_from
+        while True:
+            match = _EOL_RE.search(buffer, pos)
+            if match is None:
+                break
+            # 末尾孤立的 \r 要等下一块数据才能确定是否是 CRLF
+            if match.end() == end and match.end() - match.start() == 1 and buffer[match.start()] == 0x0D:
+                break
+            event = self._process_line(bytes(buffer[start:match.start()]))
+            if event is not None:
+                events.append(event)
+            start = pos = match.end()
+
+        if start:
+            del buffer[:start]
+        return events
+
+    def flush(self) -> List[SSEEvent]:
+        """
+        流结束时处理剩余的不完整行，并派发未以空行结尾的最后一个事件
+
+        Returns:
+            剩余的事件列表
+        """
+        events = []
+        if self._buffer:
+            line = bytes(self._buffer).rstrip(b"\r")
+            self._buffer.clear()
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line: bytes) -> Optional[SSEEvent]:
+        if not line:
+            return self._dispatch()
+        if line.startswith(b"data: "):
+            self._data.append(line[6:])
+            return None
+        if line[0] == 0x3A:  # ":" 开头是注释（常用作心跳）
+            return None
+
+        colon = line.find(b":")
+        if colon == -1:
+            field, value = line, b""
+        else:
+            field = line[:colon]
+            value = line[colon + 1:]
+            if value[:1] == b" ":
+                value = value[1:]
+
+        if field == b"data":
+            self._data.append(value)
+        elif field == b"event":
+            self._event = value.decode("utf-8", errors="replace")
+        elif field == b"id":
+            if b"\x00" not in value:
+                self._id = value.decode("utf-8", errors="replace")
+        elif field == b"retry":
+            if value.isdigit():
+                self._retry = int(value)
+        return None
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        if self._id is not None:
+            self.last_event_id = self._id
+        if not self._data:
+            self._event = ""
+            return None
+        raw = self._data[0] if len(self._data) == 1 else b"\n".join(self._data)
+        event = SSEEvent(raw, self._event or "message", self.last_event_id, self._retry)
+        self._data = []
+        self._event = ""
+        self._retry = None
+        return event
+
+
+async def aiter_sse(chunks: AsyncIterable[bytes]) -> AsyncIterator[SSEEvent]:
+    """
+    把字节流解析为SSE事件流
+
+    Args:
+        chunks: 字节块的异步迭代器（如 httpx 的 response.aiter_bytes()）
+
+    Yields:
+        SSE事件
+    """
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.flush():
+        yield event
@@ -0,0 +1,118 @@
+"""
+SSE帧编码：合并流式片段、编码JSON，客户端支持时gzip压缩
+
+- 上游的每个增量通常只有一两个字符，逐个发送时每个片段都要编码一次JSON、写一次socket、占一个TCP报文；
+  这里把一批事件中连续的 chunk 事件拼接成一个事件（事件ID取最后一个，续传不受影响），整批一次写出
+- 第一批立即发送，不影响首字延迟；之后新片段最多等待 SSE_FLUSH_INTERVAL_MS 毫秒，
+  或累计 SSE_FLUSH_BYTES 字节时提前发送（分批见 StreamBuffer.subscribe）
+- 请求带 Accept-Encoding: gzip 时（SSE_GZIP 开启），整个响应使用一个gzip压缩流，
+  每批写出后 Z_SYNC_FLUSH，客户端可以立即解压已收到的部分，后续帧可以引用前面的内容
+"""
+import zlib
+from typing import Dict, List, Tuple
+from jsonutil import dumps_bytes
+from config import SSE_GZIP_LEVEL
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Accept-Encoding 请求头是否接受gzip（q=0 表示拒绝，未列出gzip时按 * 处理）"""
+    qualities: Dict[str, float] = {}
+    for item in accept_encoding.lower().split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+def _frame(event_id: int, event: Dict) -> bytes:
+    return b"id: %d\ndata: %s\n\n" % (event_id, dumps_bytes(event))
+
+
+class SSEStats:
+    """SSE输出的计数"""
+
+    def __init__(self):
+        self.events = 0
+        self.frames = 0
+        self.writes = 0
+        self.bytes = 0
+        self.wire_bytes = 0
+        self.compressed_streams = 0
+
+    def stats(self) -> Dict:
+        return {
+            "events": self.events,
+            "frames": self.frames,
+            "writes": self.writes,
+            "events_per_frame": round(self.events / self.frames, 2) if self.frames else 0.0,
+            "bytes": self.bytes,
+            "wire_bytes": self.wire_bytes,
+            "compressed_streams": self.compressed_streams
+        }
+
+
+class SSEEncoder:
+    """一个SSE响应的帧编码器（压缩时保存该响应的gzip压缩状态）"""
+
+    def __init__(self, compress: bool = False, level: int = SSE_GZIP_LEVEL):
+        # wbits=31 输出带gzip头和校验的格式
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31) if compress else None
+        if compress:
+            sse_stats.compressed_streams += 1
+
+    @property
+    def compressed(self) -> bool:
+        return self._compressor is not None
+
+    def encode(self, batch: List[Tuple[int, Dict]]) -> bytes:
+        """把一批 (事件ID, 事件) 编码为一次写出的数据，连续的 chunk 事件合并为一帧"""
+        frames = []
+        text: List[str] = []
+        text_id = 0
+        for event_id, event in batch:
+            chunk = event.get("chunk")
+            if chunk is not None and len(event) == 1:
+                text.append(chunk)
+                text_id = event_id
+                continue
+            if text:
+                frames.append(_frame(text_id, {"chunk": "".join(text)}))
+                text = []
+            frames.append(_frame(event_id, event))
+        if text:
+            frames.append(_frame(text_id, {"chunk": "".join(text)}))
+        sse_stats.events += len(batch)
+        sse_stats.frames += len(frames)
+        return self._write(b"".join(frames))
+
+    def error(self, message: str) -> bytes:
+        """不带事件ID的错误帧（重新连接也无法继续时发送）"""
+        sse_stats.frames += 1
+        return self._write(b"data: %s\n\n" % dumps_bytes({"error": message}))
+
+    def close(self) -> bytes:
+        """响应正常结束时的剩余数据（gzip尾部），不压缩时为空"""
+        if self._compressor is None:
+            return b""
+        data = self._compressor.flush()
+        sse_stats.wire_bytes += len(data)
+        return data
+
+    def _write(self, data: bytes) -> bytes:
+        sse_stats.writes += 1
+        sse_stats.bytes += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        sse_stats.wire_bytes += len(data)
+        return data
+
+
+# 创建全局SSE输出统计实例
+sse_stats = SSEStats()
@@ -0,0 +1,186 @@
+"""
+可续传的流式事件缓冲：每次流式生成的事件带递增ID，保留在内存环形缓冲中
+
+- 生成在独立任务中运行，连接断开不会中断生成；客户端带 Last-Event-ID 重新连接后，
+  先补发错过的事件，再跟随实时事件，不会再次请求上游；多个连接可以同时订阅
+- 每次生成的缓冲按字节上限丢弃最早的事件（生成的创建、保留和清理见 generation_manager）
+- 订阅者按批读取事件：第一批立即输出，之后可以等待片刻把陆续到达的事件合并成一批（见 sse_writer）
+- 最后一个连接断开后超过 grace 秒没有重新连接时停止生成（已生成的部分按截断保存，与客户端主动停止相同）；
+  grace 为0时最后一个连接断开即停止。开始后第一个连接还没有订阅时按 attach_timeout 计时，不受 grace 影响
+"""
+import asyncio
+import time
+from collections import deque
+from itertools import islice
+from typing import AsyncGenerator, Callable, Deque, Dict, List, Optional, Tuple
+
+# 每个事件在字节计数中的固定开销（事件ID、字段名等）
+_EVENT_OVERHEAD_BYTES = 16
+
+
+def _event_size(event: Dict) -> int:
+    """事件占用的字节数（按字符串字段的UTF-8长度估算，不编码JSON）"""
+    return _EVENT_OVERHEAD_BYTES + sum(len(value.encode("utf-8")) for value in event.values() if isinstance(value, str))
+
+
+class StreamGapError(Exception):
+    """请求的位置之后的部分事件已被丢弃，无法完整续传"""
+
+
+class StreamBuffer:
+    """一次流式生成的事件缓冲，事件ID从1开始递增"""
+
+    def __init__(self, generation_id: str, user_id: int, max_bytes: int, grace: float, attach_timeout: float):
+        self.generation_id = generation_id
+        self.user_id = user_id
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self.attach_timeout = attach_timeout
+        # (事件ID, 事件, 字节数)
+        self.events: Deque[Tuple[int, Dict, int]] = deque()
+        self.nbytes = 0
+        self.last_id = 0
+        self.done = False
+        self.abandoned = False
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self._changed = asyncio.get_running_loop().create_future()
+        self._task: Optional[asyncio.Task] = None
+        self._grace_handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self, source: AsyncGenerator[Dict, None], cancelled_event: Optional[Dict] = None):
+        """
+        在后台任务中读取 source 输出的事件（可以编码为JSON的字典）
+
+        Args:
+            source: 事件的异步生成器
+            cancelled_event: 生成被停止时追加的最后一个事件，让订阅者知道生成已停止
+        """
+        self._task = asyncio.create_task(self._produce(source, cancelled_event))
+        # 任务在开始运行前就被取消时 _produce 的 finally 不会执行
+        self._task.add_done_callback(lambda _: self._finish())
+        # 响应开始前客户端就断开（一直没有订阅）时在 attach_timeout 秒后停止；
+        # 不能用 grace：grace 为0时生成会在响应订阅之前就被停止
+        self._schedule_abandon(self.attach_timeout)
+
+    def add_done_callback(self, callback: Callable[[asyncio.Task], None]):
+        """生成结束（完成、失败或取消）时调用"""
+        self._task.add_done_callback(callback)
+
+    async def _produce(self, source: AsyncGenerator[Dict, None], cancelled_event: Optional[Dict]):
+        try:
+            async for event in source:
+                self._append(event)
+        except asyncio.CancelledError:
+            if cancelled_event is not None:
+                self._append(cancelled_event)
+            raise
+        except Exception as e:
+            print(f"[STREAM BUFFER] 生成 {self.generation_id} 异常结束: {str(e)}")
+        finally:
+            self._finish()
+            await source.aclose()
+
+    def _finish(self):
+        if self.done:
+            return
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._cancel_grace()
+        self._notify()
+
+    def _append(self, event: Dict):
+        self.last_id += 1
+        size = _event_size(event)
+        self.events.append((self.last_id, event, size))
+        self.nbytes += size
+        # 超出字节上限时丢弃最早的事件（至少保留最新的一个）
+        while self.nbytes > self.max_bytes and len(self.events) > 1:
+            self.nbytes -= self.events.popleft()[2]
+        self._notify()
+
+    def _notify(self):
+        if not self._changed.done():
+            self._changed.set_result(None)
+        self._changed = asyncio.get_running_loop().create_future()
+
+    @property
+    def first_id(self) -> int:
+        """缓冲中最早的事件ID（缓冲为空时为下一个事件的ID）"""
+        return self.events[0][0] if self.events else self.last_id + 1
+
+    def can_resume(self, last_event_id: int) -> bool:
+        """last_event_id 之后的事件是否都还在缓冲中"""
+        return self.first_id - 1 <= last_event_id <= self.last_id
+
+    def _pending(self, next_id: int):
+        """从 next_id 开始的缓冲中的事件"""
+        first_id = self.first_id
+        if next_id < first_id:
+            raise StreamGapError(f"事件 {next_id} 到 {first_id - 1} 已从缓冲中丢弃")
+        return islice(self.events, next_id - first_id, None)
+
+    async def subscribe(self, last_event_id: int = 0, max_delay: float = 0.0,
+                        max_bytes: int = 0) -> AsyncGenerator[List[Tuple[int, Dict]], None]:
+        """
+        输出 last_event_id 之后的事件，再跟随实时事件直到生成结束，每次输出一批 (事件ID, 事件)
+
+        第一批（包括补发的事件）立即输出；之后有新事件时最多再等待 max_delay 秒，
+        期间到达的事件累计达到 max_bytes 字节或生成结束时提前输出。max_delay 为0时不等待。
+
+        Raises:
+            StreamGapError: 读取太慢，尚未发送的事件已被丢弃
+        """
+        self.subscribers += 1
+        self._cancel_grace()
+        next_id = last_event_id + 1
+        first = True
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if next_id > self.last_id:
+                    if self.done:
+                        return
+                    await asyncio.shield(self._changed)
+                    continue
+                if not first and max_delay > 0:
+                    deadline = loop.time() + max_delay
+                    while not self.done and sum(event[2] for event in self._pending(next_id)) < max_bytes:
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            await asyncio.wait_for(asyncio.shield(self._changed), remaining)
+                        except asyncio.TimeoutError:
+                            break
+                batch = [(event_id, event) for event_id, event, _ in self._pending(next_id)]
+                next_id = batch[-1][0] + 1
+                first = False
+                yield batch
+        finally:
+            self.subscribers -= 1
+            # 最后一个连接断开时开始计时
+            if self.subscribers == 0 and not self.done:
+                self._schedule_abandon(self.grace)
+
+    def _schedule_abandon(self, delay: float):
+        self._cancel_grace()
+        self._grace_handle = asyncio.get_running_loop().call_later(delay, self._abandon)
+
+    def _cancel_grace(self):
+        if self._grace_handle is not None:
+            self._grace_handle.cancel()
+            self._grace_handle = None
+
+    def _abandon(self):
+        self._grace_handle = None
+        if self.subscribers == 0 and not self.done:
+            self.abandoned = True
+            self._task.cancel()
+
+    async def cancel(self):
+        """停止生成并等待结束"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
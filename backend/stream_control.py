@@ -0,0 +1,86 @@
+"""
+流式响应控制：客户端断开检测和流式生成统计
+"""
+import asyncio
+from typing import Dict, Optional
+from starlette.requests import Request
+from config import DISCONNECT_POLL_INTERVAL
+
+
+class StreamStats:
+    """流式生成的计数"""
+
+    def __init__(self):
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.truncated_saved = 0
+        self.checkpoints = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "started": self.started,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "failed": self.failed,
+            "truncated_saved": self.truncated_saved,
+            "checkpoints": self.checkpoints,
+            "active": self.started - self.completed - self.cancelled - self.failed
+        }
+
+
+class DisconnectGuard:
+    """
+    监听客户端断开并结束SSE响应
+
+    Starlette 的 StreamingResponse 收到 http.disconnect 时会取消响应任务；这里再用
+    request.is_disconnected() 定时检查，覆盖不发送断开事件的服务器实现和长时间没有新事件的情况。
+    检测到断开时，如果生成器正在等待新事件，就取消当前任务，让响应立即结束；
+    如果正在把数据交给框架发送，只做标记，由生成器在发送返回后自行结束。
+    结束的只是这一个连接的订阅，生成本身在后台继续（没有连接超过 grace 秒才停止，见 stream_buffer）。
+
+    用法:
+        async with DisconnectGuard(request) as guard:
+            async for chunk in stream:
+                guard.sending = True
+                yield chunk
+                guard.sending = False
+                if guard.disconnected:
+                    break
+    """
+
+    def __init__(self, request: Request, interval: float = DISCONNECT_POLL_INTERVAL):
+        self.request = request
+        self.interval = interval
+        self.disconnected = False
+        self.sending = False
+        self._task: Optional[asyncio.Task] = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._cancelled = False
+
+    async def __aenter__(self) -> "DisconnectGuard":
+        self._task = asyncio.current_task()
+        self._watcher = asyncio.create_task(self._watch())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        self._watcher.cancel()
+        if self._cancelled and exc_type is asyncio.CancelledError:
+            # 由本对象发起的取消到此为止，响应正常结束
+            if hasattr(self._task, "uncancel"):
+                self._task.uncancel()
+            return True
+        return False
+
+    async def _watch(self):
+        while not await self.request.is_disconnected():
+            await asyncio.sleep(self.interval)
+        self.disconnected = True
+        if not self.sending:
+            self._cancelled = True
+            self._task.cancel()
+
+
+# 创建全局流式统计实例
+stream_stats = StreamStats()
@@ -0,0 +1,153 @@
+"""
+对话滚动摘要：把较早的对话轮次增量压缩为摘要
+"""
+import asyncio
+from typing import Dict, Optional, Set
+from sqlalchemy import select, func, update
+from database import AsyncSessionLocal, Conversation, Message
+from llm_service import llm_service
+from model_registry import ModelTarget
+from history_cache import history_cache
+from config import (
+    SUMMARY_ENABLED, SUMMARY_TRIGGER_MESSAGES, SUMMARY_KEEP_RECENT,
+    SUMMARY_BATCH_LIMIT, SUMMARY_MAX_TOKENS
+)
+
+SUMMARY_SYSTEM_PROMPT = (
+    "你是一个对话摘要助手。请把已有摘要和新增的对话内容合并成一份新的摘要，"
+    "保留用户的目标、关键事实、结论、代码要点和尚未解决的问题，省略寒暄。"
+    "只返回摘要正文，不要有其他内容。"
+)
+
+
+def summary_system_message(summary: str) -> Dict[str, str]:
+    """把摘要包装成放在上下文最前面的系统消息"""
+    return {"role": "system", "content": f"以下是本次对话较早部分的摘要，请结合它继续对话：\n{summary}"}
+
+
+def pending_messages_query(conversation_id: int, until_id: int):
+    """尚未被摘要覆盖的消息数（执行计划检查也使用这个语句）"""
+    return select(func.count(Message.id)).where(Message.conversation_id == conversation_id, Message.id > until_id)
+
+
+def aged_messages_query(conversation_id: int, until_id: int, limit: int):
+    """尚未被摘要覆盖的最早的 limit 条消息（执行计划检查也使用这个语句）"""
+    return (
+        select(Message.id, Message.role, Message.content)
+        .where(Message.conversation_id == conversation_id, Message.id > until_id)
+        .order_by(Message.created_at, Message.id)
+        .limit(limit)
+    )
+
+
+class ConversationSummarizer:
+    """
+    对话摘要服务
+
+    当对话中尚未被摘要覆盖的消息超过阈值时，在后台把最早的一批消息与已有摘要合并，
+    并推进 summary_until_id。每次只处理新老化的消息，不会从头重算。
+    """
+
+    def __init__(self):
+        self._in_flight: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.runs = 0
+        self.failures = 0
+
+    def schedule(self, conversation_id: int, target: Optional[ModelTarget] = None):
+        """
+        为对话安排一次后台摘要检查（同一对话同时最多一个任务）
+
+        Args:
+            conversation_id: 对话主键
+            target: 生成摘要使用的模型目标
+        """
+        if not SUMMARY_ENABLED or conversation_id in self._in_flight:
+            return
+        self._in_flight.add(conversation_id)
+        task = asyncio.create_task(self._run(conversation_id, target))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, conversation_id: int, target: Optional[ModelTarget]):
+        try:
+            await self.summarize(conversation_id, target)
+        except Exception as e:
+            self.failures += 1
+            print(f"[SUMMARY] 对话 {conversation_id} 摘要失败: {str(e)}")
+        finally:
+            self._in_flight.discard(conversation_id)
+
+    async def summarize(self, conversation_id: int, target: Optional[ModelTarget] = None) -> bool:
+        """
+        如有必要，把较早的消息合并进对话摘要
+
+        Args:
+            conversation_id: 对话主键
+            target: 生成摘要使用的模型目标
+
+        Returns:
+            是否更新了摘要
+        """
+        async with AsyncSessionLocal() as db:
+            row = (await db.execute(
+                select(Conversation.summary, Conversation.summary_until_id).where(Conversation.id == conversation_id)
+            )).first()
+            if row is None:
+                return False
+            summary, until_id = row
+            until_id = until_id or 0
+
+            pending = await db.scalar(pending_messages_query(conversation_id, until_id))
+            if pending <= SUMMARY_TRIGGER_MESSAGES:
+                return False
+
+            # 只取新老化的消息：保留最近 SUMMARY_KEEP_RECENT 条原文，单次最多处理 SUMMARY_BATCH_LIMIT 条
+            result = await db.execute(
+                aged_messages_query(conversation_id, until_id, min(pending - SUMMARY_KEEP_RECENT, SUMMARY_BATCH_LIMIT))
+            )
+            aged = result.all()
+            if not aged:
+                return False
+            # 释放读事务，避免在等待大模型期间占用连接
+            await db.commit()
+
+            dialogue = "\n".join(f"{role}: {content}" for _, role, content in aged)
+            prompt = [
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": f"已有摘要：\n{summary or '（无）'}\n\n新增对话：\n{dialogue}"}
+            ]
+            new_summary = (await llm_service.chat_completion(
+                prompt, temperature=0.3, max_tokens=SUMMARY_MAX_TOKENS, target=target
+            )).strip()
+            if not new_summary:
+                return False
+
+            # 仅当摘要指针未被其他任务推进时才写入
+            updated = await db.execute(
+                update(Conversation)
+                .where(Conversation.id == conversation_id, func.coalesce(Conversation.summary_until_id, 0) == until_id)
+                # 摘要不是用户可见的更新，保持 updated_at 不变以免影响对话列表排序
+                .values(summary=new_summary, summary_until_id=aged[-1][0], updated_at=Conversation.updated_at)
+            )
+            await db.commit()
+            if updated.rowcount > 0:
+                history_cache.apply_summary(conversation_id, new_summary, aged[-1][0])
+            self.runs += 1
+            print(f"[SUMMARY] 对话 {conversation_id} 摘要已更新，新增覆盖 {len(aged)} 条消息")
+            return updated.rowcount > 0
+
+    async def shutdown(self):
+        """取消尚未完成的摘要任务"""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        """摘要任务统计"""
+        return {"runs": self.runs, "failures": self.failures, "in_flight": len(self._in_flight)}
+
+
+# 创建全局摘要服务实例
+conversation_summarizer = ConversationSummarizer()
@@ -0,0 +1,9 @@
+"""
+测试配置：把 backend 目录加入导入路径，并让 database 模块使用临时数据库（必须在导入 database 之前设置）
+"""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='llm_chat_test_'), 'test.db')}")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
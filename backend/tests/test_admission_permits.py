@@ -0,0 +1,90 @@
+"""
+准入许可的占用时长：合并流（single-flight）的许可随上游读取任务结束才归还，而不是随发起者结束
+
+运行（在 backend 目录下）:
+    python -m pytest tests
+"""
+import asyncio
+
+import pytest
+
+from admission import AdmissionController
+from llm_service import llm_service
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """用队列代替上游：放入的片段依次输出，放入None时结束；与真实实现一样在读取结束时释放许可"""
+    pieces: asyncio.Queue = None
+
+    async def fake_stream(target, messages, temperature, max_tokens, user_id, permit):
+        try:
+            while True:
+                piece = await pieces.get()
+                if piece is None:
+                    return
+                yield piece
+        finally:
+            if permit is not None:
+                permit.release()
+
+    def new_queue() -> asyncio.Queue:
+        nonlocal pieces
+        pieces = asyncio.Queue()
+        return pieces
+
+    monkeypatch.setattr(llm_service, "_stream_with_retries", fake_stream)
+    monkeypatch.setattr(llm_service.singleflight, "enabled", True)
+    return new_queue
+
+
+def test_flight_keeps_permit_after_leader_leaves(upstream):
+    async def scenario():
+        pieces = upstream()
+        controller = AdmissionController("test", 2, 10, 1)
+        messages = [{"role": "user", "content": "permit lifetime"}]
+
+        leader_permit = await controller.acquire(1)
+        leader = llm_service.chat_completion_stream(messages, 0, 50, permit=leader_permit)
+        pieces.put_nowait("a")
+        assert await leader.__anext__() == "a"
+
+        # 相同的请求加入进行中的流，立即归还自己的许可
+        joiner_permit = await controller.acquire(2)
+        joiner = llm_service.chat_completion_stream(messages, 0, 50, permit=joiner_permit)
+        assert await joiner.__anext__() == "a"
+        assert controller.in_flight == 1
+
+        # 发起者结束（生成被停止）：上游仍在为加入者读取，许可不能归还
+        await leader.aclose()
+        leader_permit.release()
+        assert controller.in_flight == 1
+
+        pieces.put_nowait("b")
+        pieces.put_nowait(None)
+        assert [piece async for piece in joiner] == ["b"]
+        await asyncio.sleep(0)
+        assert controller.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_flight_cancelled_before_start_returns_permit(upstream):
+    async def scenario():
+        upstream()
+        controller = AdmissionController("test", 1, 10, 1)
+        messages = [{"role": "user", "content": "cancelled before start"}]
+
+        permit = await controller.acquire(1)
+        stream = llm_service.chat_completion_stream(messages, 0, 50, permit=permit)
+        reader = asyncio.create_task(stream.__anext__())
+        await asyncio.sleep(0)
+        # 唯一的订阅者离开，上游读取任务在读到任何片段前被取消
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+        await stream.aclose()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert controller.in_flight == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,60 @@
+"""
+对话状态缓存的写穿与并发加载：加载期间提交的写入不能被加载到的旧数据覆盖
+
+运行（在 backend 目录下）:
+    python -m pytest tests
+"""
+import history_cache as history_cache_module
+from history_cache import ConversationState, HistoryCache
+
+
+def _message(message_id: int, content: str):
+    return {"id": message_id, "role": "user", "content": content, "token_count": 1}
+
+
+def _state(messages):
+    return ConversationState(1, 1, "新对话", None, None, list(messages))
+
+
+def test_load_overlapping_write_is_not_cached():
+    cache = HistoryCache(enabled=True)
+    # 加载开始时读到的是提交之前的数据
+    snapshot = cache.snapshot()
+    stale = _state([_message(1, "旧消息")])
+    # 加载期间写入提交：对话还没有缓存，写穿被忽略
+    cache.append_message("s", _message(2, "新消息"))
+    cache.put("s", stale, snapshot)
+    assert cache.get("s") is None
+    assert cache.stats()["stale_loads"] == 1
+
+    # 下次加载读到新数据
+    snapshot = cache.snapshot()
+    cache.put("s", _state([_message(1, "旧消息"), _message(2, "新消息")]), snapshot)
+    assert [message["id"] for message in cache.get("s").messages] == [1, 2]
+
+
+def test_write_after_load_is_written_through():
+    cache = HistoryCache(enabled=True)
+    cache.put("s", _state([_message(1, "a")]), cache.snapshot())
+    cache.append_message("s", _message(2, "b"))
+    cache.update_message("s", 2, "bc", 1)
+    assert [message["content"] for message in cache.get("s").messages] == ["a", "bc"]
+    # 其他对话的写入不影响本对话的加载
+    snapshot = cache.snapshot()
+    cache.append_message("other", _message(3, "c"))
+    cache.put("s2", _state([]), snapshot)
+    assert cache.get("s2") is not None
+
+
+def test_dropped_write_records_are_conservative(monkeypatch):
+    monkeypatch.setattr(history_cache_module, "_WRITTEN_LIMIT", 2)
+    cache = HistoryCache(enabled=True)
+    snapshot = cache.snapshot()
+    cache.invalidate("s")
+    # "s" 的写入记录被后来的写入挤出，仍然按丢弃的序号拒绝更早开始的加载
+    cache.invalidate("a")
+    cache.invalidate("b")
+    cache.put("s", _state([]), snapshot)
+    assert cache.get("s") is None
+    cache.put("s", _state([]), cache.snapshot())
+    assert cache.get("s") is not None
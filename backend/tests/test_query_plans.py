@@ -0,0 +1,70 @@
+"""
+执行计划回归测试：热点查询（历史、列表、保留清理、搜索）必须使用迁移创建的索引
+
+运行（在 backend 目录下）:
+    python -m pytest tests
+"""
+import re
+
+import pytest
+from sqlalchemy import create_engine, text
+
+import migrations
+import search_index
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'plans.db'}")
+    migrations.upgrade(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_hot_queries_use_indexes(engine):
+    names = {query[0] for query in migrations._hot_queries(fts=True)}
+    assert {
+        "get_conversation_history", "load_recent_messages", "summarizer_pending", "summarizer_aged",
+        "list_conversations", "list_conversations_cursor", "retention_excess", "search_like_fallback", "search_fts"
+    } <= names
+    assert migrations.check_query_plans(engine) == []
+
+
+def test_missing_index_is_reported(engine):
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_conversations_user_updated"))
+    problems = migrations.check_query_plans(engine)
+    assert {problem.split(":")[0] for problem in problems} >= {
+        "list_conversations", "list_conversations_cursor", "retention_excess"
+    }
+
+
+def test_full_text_search_uses_fts_index(engine):
+    with engine.connect() as conn:
+        if not search_index.detect_search_index(conn):
+            pytest.skip("SQLite 不支持 FTS5 trigram")
+        plan = [
+            row[3] for row in conn.execute(
+                text(f"EXPLAIN QUERY PLAN {search_index._FTS_SEARCH_SQL.text}"),
+                {"match": '"排序算法"', "user_id": 1, "limit": 20, "offset": 0}
+            )
+        ]
+    detail = " | ".join(plan)
+    # 通过全文索引定位命中的行，再按主键取消息和对话，不扫描消息表
+    assert "SCAN messages_fts VIRTUAL TABLE INDEX" in detail
+    assert "SCAN conversations_fts VIRTUAL TABLE INDEX" in detail
+    assert not any(re.match(r"SCAN (m|messages|c|conversations)\b", step) for step in plan), detail
+
+
+def test_search_index_migration_retried_until_created(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'retry.db'}")
+    monkeypatch.setattr(search_index, "create_search_index", lambda conn: False)
+    migrations.upgrade(engine)
+    with engine.begin() as conn:
+        assert 3 not in migrations.applied_versions(conn)
+
+    monkeypatch.undo()
+    migrations.upgrade(engine)
+    with engine.begin() as conn:
+        assert 3 in migrations.applied_versions(conn)
+    engine.dispose()
@@ -0,0 +1,32 @@
+"""
+部分回复的后台保存：服务关闭时 drain 要等到全部进入写入队列，才能提交并关闭数据库连接
+
+运行（在 backend 目录下）:
+    python -m pytest tests
+"""
+import asyncio
+
+import reply_checkpoint
+from message_writer import message_record
+from reply_checkpoint import ReplyCheckpoint
+
+
+def test_drain_waits_for_background_saves(monkeypatch):
+    written = []
+
+    async def slow_write(conversation_id, session_id, records):
+        await asyncio.sleep(0.05)
+        written.append([record["status"] for record in records])
+        return list(range(len(records)))
+
+    monkeypatch.setattr(reply_checkpoint.message_writer, "write", slow_write)
+
+    async def scenario():
+        checkpoint = ReplyCheckpoint(1, "session", message_record("user", "问题"), enabled=False)
+        checkpoint.append("部分回复")
+        checkpoint.finish_in_background("truncated")
+        assert written == []
+        await reply_checkpoint.drain()
+        assert written == [["complete", "truncated"]]
+
+    asyncio.run(scenario())
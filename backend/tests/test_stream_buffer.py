@@ -0,0 +1,113 @@
+"""
+可续传事件缓冲的回归测试：生成无论怎样结束，缓冲都要标记为结束，订阅者不会一直等待
+
+运行（在 backend 目录下）:
+    python -m pytest tests
+"""
+import asyncio
+
+from stream_buffer import StreamBuffer
+
+
+async def _events(count: int):
+    for index in range(count):
+        await asyncio.sleep(0)
+        yield {"chunk": str(index)}
+
+
+async def _collect(buffer: StreamBuffer, last_event_id: int = 0):
+    events = []
+    async for batch in buffer.subscribe(last_event_id):
+        events.extend(batch)
+    return events
+
+
+def test_completed_generation_replays_all_events():
+    async def scenario():
+        buffer = StreamBuffer("completed", 1, 1024 * 1024, 60, 60)
+        buffer.start(_events(3))
+        events = await asyncio.wait_for(_collect(buffer), 1)
+        assert [event for _, event in events] == [{"chunk": "0"}, {"chunk": "1"}, {"chunk": "2"}]
+        assert buffer.done
+        # 断开后从第1个事件之后续传
+        assert [event_id for event_id, _ in await _collect(buffer, 1)] == [2, 3]
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_before_first_run_marks_done():
+    async def scenario():
+        buffer = StreamBuffer("cancelled", 1, 1024 * 1024, 60, 60)
+        buffer.start(_events(3), cancelled_event={"cancelled": True})
+        # 任务还没有开始运行就被取消，_produce 的 finally 不会执行
+        await buffer.cancel()
+        assert buffer.done
+        assert buffer.finished_at is not None
+        # 订阅者立即结束而不是一直等待
+        assert await asyncio.wait_for(_collect(buffer), 1) == []
+
+    asyncio.run(scenario())
+
+
+async def _endless():
+    while True:
+        await asyncio.sleep(0.01)
+        yield {"chunk": "x"}
+
+
+def test_abandoned_when_never_attached():
+    async def scenario():
+        buffer = StreamBuffer("abandoned", 1, 1024 * 1024, 60, 0.05)
+        buffer.start(_endless(), cancelled_event={"cancelled": True})
+        await asyncio.sleep(0.2)
+        assert buffer.abandoned and buffer.done
+        events = await asyncio.wait_for(_collect(buffer), 1)
+        assert events[-1][1] == {"cancelled": True}
+
+    asyncio.run(scenario())
+
+
+def test_zero_grace_waits_for_first_subscriber():
+    async def scenario():
+        buffer = StreamBuffer("zero-grace", 1, 1024 * 1024, 0, 1)
+        buffer.start(_events(3), cancelled_event={"cancelled": True})
+        # 响应订阅之前事件循环已经运行过几轮，grace 为0也不能在此之前停止
+        for _ in range(3):
+            await asyncio.sleep(0)
+        events = await asyncio.wait_for(_collect(buffer), 1)
+        assert [event for _, event in events] == [{"chunk": "0"}, {"chunk": "1"}, {"chunk": "2"}]
+        assert not buffer.abandoned
+
+    asyncio.run(scenario())
+
+
+def test_zero_grace_stops_when_last_subscriber_leaves():
+    async def scenario():
+        buffer = StreamBuffer("zero-grace-detach", 1, 1024 * 1024, 0, 1)
+        buffer.start(_endless(), cancelled_event={"cancelled": True})
+        batches = buffer.subscribe(0)
+        await asyncio.wait_for(batches.__anext__(), 1)
+        await batches.aclose()
+        await asyncio.sleep(0.05)
+        assert buffer.abandoned and buffer.done
+
+    asyncio.run(scenario())
+
+
+def test_grace_allows_reconnect():
+    async def scenario():
+        buffer = StreamBuffer("reconnect", 1, 1024 * 1024, 0.2, 1)
+        buffer.start(_endless(), cancelled_event={"cancelled": True})
+        batches = buffer.subscribe(0)
+        last_id = (await asyncio.wait_for(batches.__anext__(), 1))[-1][0]
+        await batches.aclose()
+        await asyncio.sleep(0.05)
+        # grace 内重新连接，从断开的位置继续
+        batches = buffer.subscribe(last_id)
+        assert (await asyncio.wait_for(batches.__anext__(), 1))[0][0] == last_id + 1
+        await asyncio.sleep(0.3)
+        assert not buffer.done
+        await batches.aclose()
+        await buffer.cancel()
+
+    asyncio.run(scenario())
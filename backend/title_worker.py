@@ -0,0 +1,278 @@
+"""
+对话标题生成队列：在后台用有限并发生成标题，不占用对话请求
+"""
+import asyncio
+import re
+from typing import Dict, List, Optional, Set
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, Conversation, Message
+from llm_service import llm_service
+from model_registry import ModelTarget, PRESET_MODELS, preset_target
+from history_cache import history_cache
+from response_cache import cache_scope
+from config import (
+    TITLE_CONCURRENCY, TITLE_QUEUE_SIZE, TITLE_MAX_RETRIES, TITLE_RETRY_DELAY,
+    TITLE_DEGRADE_QUEUE_DEPTH, TITLE_FALLBACK_MODEL_TYPE
+)
+
+DEFAULT_TITLE = "新对话"
+
+# 本地生成标题的最大字数
+HEURISTIC_TITLE_LENGTH = 20
+
+TITLE_SYSTEM_PROMPT = "你是一个助手，需要根据对话内容生成一个简洁的标题（不超过20个字）。只返回标题文本，不要有其他内容。"
+
+
+def heuristic_title(text: str) -> str:
+    """
+    不调用大模型，直接从用户的第一条消息截取标题
+
+    Args:
+        text: 用户消息
+
+    Returns:
+        标题（不超过 HEURISTIC_TITLE_LENGTH 个字）
+    """
+    # 去掉代码块和多余空白，只保留第一行有内容的文本
+    text = re.sub(r"```.*?(```|$)", " ", text, flags=re.S)
+    lines = [line.strip(" #>*-\t") for line in text.splitlines()]
+    line = next((line for line in lines if line), "")
+    line = re.sub(r"\s+", " ", line)
+    if not line:
+        return DEFAULT_TITLE
+    if len(line) > HEURISTIC_TITLE_LENGTH:
+        return line[:HEURISTIC_TITLE_LENGTH] + "…"
+    return line
+
+
+def _clean_title(title: str) -> str:
+    title = title.strip().splitlines()[0] if title.strip() else ""
+    return title.strip().strip('"').strip("'").strip("“”《》")[:50]
+
+
+class _TitleJob:
+    __slots__ = ("session_id", "target", "attempt")
+
+    def __init__(self, session_id: str, target: Optional[ModelTarget], attempt: int = 0):
+        self.session_id = session_id
+        self.target = target
+        self.attempt = attempt
+
+
+class TitleWorker:
+    """
+    标题生成任务队列
+
+    - 有界队列 + 固定数量的工作协程，每个任务使用自己的数据库会话
+    - 同一对话同时最多一个任务（排队、执行、等待重试期间都算）
+    - 失败后延迟重试，重试期间不占用工作协程；最终失败时使用本地截取的标题
+    - 积压超过阈值时改用更便宜的模型（TITLE_FALLBACK_MODEL_TYPE）或本地截取
+    - 队列满时直接丢弃，标题仍是默认值，下一轮对话会再次提交
+    """
+
+    def __init__(self, concurrency: int = TITLE_CONCURRENCY, max_queue: int = TITLE_QUEUE_SIZE,
+                 max_retries: int = TITLE_MAX_RETRIES, retry_delay: float = TITLE_RETRY_DELAY,
+                 degrade_depth: int = TITLE_DEGRADE_QUEUE_DEPTH, fallback_model_type: str = TITLE_FALLBACK_MODEL_TYPE):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.degrade_depth = degrade_depth
+        self.fallback_model_type = fallback_model_type if fallback_model_type in PRESET_MODELS else ""
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: Set[str] = set()
+        self._workers: List[asyncio.Task] = []
+        self._retry_handles: Dict[str, asyncio.TimerHandle] = {}
+
+        self.submitted = 0
+        self.deduplicated = 0
+        self.dropped = 0
+        self.completed = 0
+        self.retries = 0
+        self.failed = 0
+        self.degraded = 0
+        self.heuristic = 0
+
+    def start(self):
+        """启动工作协程（需在事件循环中调用）"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def shutdown(self):
+        """停止工作协程，丢弃尚未执行的任务"""
+        for handle in self._retry_handles.values():
+            handle.cancel()
+        self._retry_handles.clear()
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._pending.clear()
+
+    def submit(self, session_id: str, target: Optional[ModelTarget] = None) -> bool:
+        """
+        提交一个标题生成任务（不等待执行）
+
+        Args:
+            session_id: 会话ID
+            target: 对话使用的模型目标
+
+        Returns:
+            是否进入队列（重复提交或队列已满时返回False）
+        """
+        if session_id in self._pending:
+            self.deduplicated += 1
+            return False
+        if self._queue is None or self._queue.full():
+            self.dropped += 1
+            return False
+        self._pending.add(session_id)
+        self._queue.put_nowait(_TitleJob(session_id, target))
+        self.submitted += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._retry_or_give_up(job, e)
+            else:
+                self._pending.discard(job.session_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: _TitleJob):
+        # 积压较多时降级：优先换用更便宜的模型，没有配置时本地截取
+        target, use_heuristic = job.target, False
+        if self._queue.qsize() >= self.degrade_depth:
+            self.degraded += 1
+            if self.fallback_model_type:
+                target = preset_target(self.fallback_model_type)
+            else:
+                use_heuristic = True
+
+        async with AsyncSessionLocal() as db:
+            await self.generate_title(db, job.session_id, target, use_heuristic)
+        self.completed += 1
+
+    def _retry_or_give_up(self, job: _TitleJob, error: Exception):
+        if job.attempt < self.max_retries:
+            self.retries += 1
+            job.attempt += 1
+            delay = self.retry_delay * (2 ** (job.attempt - 1))
+            loop = asyncio.get_running_loop()
+            self._retry_handles[job.session_id] = loop.call_later(delay, self._requeue, job)
+            return
+
+        self.failed += 1
+        print(f"[TITLE] 会话 {job.session_id} 生成标题失败，改用本地标题: {str(error)}")
+        # 最终失败时用本地截取的标题兜底，不再调用大模型
+        task = asyncio.create_task(self._apply_heuristic(job.session_id))
+        task.add_done_callback(lambda _: self._pending.discard(job.session_id))
+
+    def _requeue(self, job: _TitleJob):
+        self._retry_handles.pop(job.session_id, None)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self._pending.discard(job.session_id)
+
+    async def _apply_heuristic(self, session_id: str):
+        try:
+            async with AsyncSessionLocal() as db:
+                await self.generate_title(db, session_id, use_heuristic=True)
+        except Exception as e:
+            print(f"[TITLE] 会话 {session_id} 保存本地标题失败: {str(e)}")
+
+    async def generate_title(self, db: AsyncSession, session_id: str, target: Optional[ModelTarget] = None,
+                             use_heuristic: bool = False) -> str:
+        """
+        根据对话内容生成并保存标题
+
+        Args:
+            db: 数据库会话
+            session_id: 会话ID
+            target: 模型目标，为None时使用默认目标
+            use_heuristic: 是否不调用大模型，直接截取用户消息
+
+        Returns:
+            生成的标题；对话已有标题时返回已有标题
+        """
+        row = (await db.execute(
+            select(Conversation.id, Conversation.title, Conversation.user_id)
+            .where(Conversation.session_id == session_id)
+        )).first()
+        if row is None:
+            raise ValueError(f"会话 {session_id} 不存在")
+        conversation_id, current_title, user_id = row
+        if current_title != DEFAULT_TITLE:
+            return current_title
+
+        # 获取前几条消息用于生成标题
+        result = await db.execute(
+            select(Message.role, Message.content)
+            .where(Message.conversation_id == conversation_id)
+            .order_by(Message.created_at, Message.id)
+            .limit(4)
+        )
+        messages = result.all()
+        if not messages:
+            return DEFAULT_TITLE
+        # 读完后释放读事务，避免在等待大模型期间占用连接
+        await db.commit()
+
+        if use_heuristic:
+            first_user = next((content for role, content in messages if role == "user"), messages[0][1])
+            title = heuristic_title(first_user)
+            self.heuristic += 1
+        else:
+            conversation_text = "\n".join([f"{role}: {content[:100]}" for role, content in messages])
+            title_prompt = [
+                {"role": "system", "content": TITLE_SYSTEM_PROMPT},
+                {"role": "user", "content": f"请为以下对话生成一个简洁的标题（不超过20个字）：\n\n{conversation_text}"}
+            ]
+            # 同一用户重复的标题提示允许复用缓存的标题（开启回复缓存时）；提示中含有对话内容，按用户隔离
+            title = _clean_title(await llm_service.chat_completion(
+                title_prompt, temperature=0.5, max_tokens=50, target=target, cache=True,
+                scope=cache_scope(title_prompt, user_id)
+            ))
+            if not title:
+                raise ValueError("模型返回了空标题")
+
+        # 只在标题仍是默认值时写入；标题不是用户活动，保持 updated_at 不变
+        updated = await db.execute(
+            update(Conversation)
+            .where(Conversation.id == conversation_id, Conversation.title == DEFAULT_TITLE)
+            .values(title=title, updated_at=Conversation.updated_at)
+        )
+        await db.commit()
+        if updated.rowcount > 0:
+            history_cache.set_title(session_id, title)
+        return title
+
+    def stats(self) -> Dict[str, int]:
+        """标题任务统计"""
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "pending": len(self._pending),
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "dropped": self.dropped,
+            "completed": self.completed,
+            "retries": self.retries,
+            "failed": self.failed,
+            "degraded": self.degraded,
+            "heuristic": self.heuristic
+        }
+
+
+# 创建全局标题任务实例
+title_worker = TitleWorker()
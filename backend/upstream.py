@@ -0,0 +1,177 @@
+"""
+上游连接注册表：每个上游地址独立的连接池、限额和指标
+"""
+import httpx
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+from config import (
+    LLM_POOL_MAX_CONNECTIONS, LLM_POOL_MAX_KEEPALIVE, LLM_POOL_KEEPALIVE_EXPIRY,
+    LLM_CONNECT_TIMEOUT, LLM_HTTP2, LLM_MAX_IN_FLIGHT, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT
+)
+from admission import AdmissionController
+from resilience import CircuitBreaker
+
+# 延迟EWMA的平滑系数
+_LATENCY_EWMA_ALPHA = 0.3
+
+
+def _http2_available() -> bool:
+    """检查是否安装了HTTP/2依赖（h2）"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def upstream_key(url: str) -> str:
+    """以 scheme://host:port 作为上游的唯一标识"""
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    return f"{parts.scheme}://{parts.hostname}:{port}"
+
+
+class Upstream:
+    """单个上游地址：持有独立的长连接客户端、准入控制、熔断器和请求指标"""
+
+    def __init__(self, key: str, max_connections: int, max_keepalive: int, http2: bool, max_in_flight: int):
+        self.key = key
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.http2 = http2
+        self.client = self._create_client()
+        self.admission = AdmissionController(key, max_in_flight, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT)
+        self.breaker = CircuitBreaker(key)
+
+        self.requests = 0
+        self.in_flight = 0
+        self.errors = 0
+
+        # 首字节延迟的EWMA（秒），用于负载均衡
+        self.latency_ewma: Optional[float] = None
+
+    def _create_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive,
+                keepalive_expiry=LLM_POOL_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(120.0, connect=LLM_CONNECT_TIMEOUT)
+        )
+
+    def get_client(self) -> httpx.AsyncClient:
+        """获取长连接客户端（被关闭后自动重建）"""
+        if self.client.is_closed:
+            self.client = self._create_client()
+        return self.client
+
+    def begin(self):
+        """记录一次请求开始"""
+        self.requests += 1
+        self.in_flight += 1
+
+    def end(self, error: bool = False, latency: Optional[float] = None):
+        """
+        记录一次请求结束
+
+        Args:
+            error: 是否因上游故障（连接失败、超时、5xx等）失败，计入熔断
+            latency: 成功时的首字节延迟（秒），用于负载均衡；为None且没有故障时不影响熔断状态
+        """
+        self.in_flight -= 1
+        if error:
+            self.errors += 1
+            self.breaker.record_failure()
+        elif latency is not None:
+            self.breaker.record_success()
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma += _LATENCY_EWMA_ALPHA * (latency - self.latency_ewma)
+        else:
+            self.breaker.record_neutral()
+
+    def outstanding(self) -> int:
+        """已准入和排队中的请求数"""
+        return self.admission.in_flight + self.admission.waiting
+
+    def available(self, now: Optional[float] = None) -> bool:
+        """是否可以接收请求（熔断器未打开）"""
+        return self.breaker.available(now)
+
+    def stats(self) -> Dict:
+        """连接池占用和请求统计"""
+        connections = 0
+        idle_connections = 0
+        if not self.client.is_closed:
+            # httpx 未公开连接池统计，这里读取底层 httpcore 连接池
+            pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+            pool_connections: Optional[list] = getattr(pool, "connections", None)
+            if pool_connections is not None:
+                connections = len(pool_connections)
+                idle_connections = sum(1 for conn in pool_connections if conn.is_idle())
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "errors": self.errors,
+            "http2": self.http2,
+            "connections": connections,
+            "idle_connections": idle_connections,
+            "max_connections": self.max_connections,
+            "max_keepalive_connections": self.max_keepalive,
+            "latency_ewma": round(self.latency_ewma, 4) if self.latency_ewma is not None else None,
+            "breaker": self.breaker.stats(),
+            "admission": self.admission.stats()
+        }
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class UpstreamRegistry:
+    """上游注册表，按 scheme://host:port 懒加载创建 Upstream"""
+
+    def __init__(self):
+        self._upstreams: Dict[str, Upstream] = {}
+        self._http2 = LLM_HTTP2 and _http2_available()
+        if LLM_HTTP2 and not self._http2:
+            print("[LLM POOL] 未安装h2，HTTP/2已禁用，回退到HTTP/1.1")
+
+    def get(self, url: str, max_connections: Optional[int] = None, max_in_flight: Optional[int] = None) -> Upstream:
+        """
+        获取（必要时创建）指定地址的上游
+
+        Args:
+            url: 上游接口地址
+            max_connections: 该上游的最大连接数，为None时使用全局配置（仅首次创建时生效）
+            max_in_flight: 该上游的最大在途请求数，为None时使用全局配置（仅首次创建时生效）
+        """
+        key = upstream_key(url)
+        upstream = self._upstreams.get(key)
+        if upstream is None:
+            upstream = Upstream(
+                key,
+                max_connections=max_connections or LLM_POOL_MAX_CONNECTIONS,
+                max_keepalive=min(LLM_POOL_MAX_KEEPALIVE, max_connections or LLM_POOL_MAX_KEEPALIVE),
+                http2=self._http2,
+                max_in_flight=max_in_flight or LLM_MAX_IN_FLIGHT
+            )
+            self._upstreams[key] = upstream
+        return upstream
+
+    async def close_all(self):
+        """关闭所有上游连接"""
+        upstreams = list(self._upstreams.values())
+        self._upstreams.clear()
+        for upstream in upstreams:
+            await upstream.aclose()
+
+    def stats(self) -> Dict[str, Dict]:
+        """以上游地址为键的统计信息"""
+        return {key: upstream.stats() for key, upstream in self._upstreams.items()}
+
+
+# 创建全局上游注册表
+upstream_registry = UpstreamRegistry()
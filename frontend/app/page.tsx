@@ -1,6 +1,6 @@
 'use client';
 
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { useRouter } from 'next/navigation';
 import Sidebar from '@/components/Sidebar';
 import ChatMessages from '@/components/ChatMessages';
@@ -18,6 +18,7 @@ import {
   getConversationHistory,
   deleteConversation,
   sendMessageStream,
+  cancelGeneration,
   getConfig,
   updateConfig,
   searchConversations,
@@ -35,6 +36,8 @@ export default function Home() {
   const [userId, setUserId] = useState('');
   const [userName, setUserName] = useState('');
   const [abortController, setAbortController] = useState<AbortController | null>(null);
+  // 当前流式生成的ID，点击停止时用于停止服务端的生成
+  const generationIdRef = useRef<string | null>(null);
   const [isAuthChecking, setIsAuthChecking] = useState(true);
 
   useEffect(() => {
@@ -170,12 +173,18 @@ export default function Home() {
       setMessages((prev) => [...prev, assistantMessage]);
 
       // 使用流式响应
-      for await (const chunk of sendMessageStream({
-        user_id: userId,
-        session_id: currentSessionId,
-        message,
-        stream: true,
-      })) {
+      for await (const chunk of sendMessageStream(
+        {
+          user_id: userId,
+          session_id: currentSessionId,
+          message,
+          stream: true,
+        },
+        controller.signal,
+        (generationId) => {
+          generationIdRef.current = generationId;
+        },
+      )) {
         // 检查是否被取消
         if (controller.signal.aborted) {
           break;
@@ -216,10 +225,19 @@ export default function Home() {
     } finally {
       setIsLoading(false);
       setAbortController(null);
+      generationIdRef.current = null;
     }
   };
 
   const handleStopGeneration = () => {
+    // 断开连接只会让服务端暂停发送（等待重新连接），需要显式停止生成
+    const generationId = generationIdRef.current;
+    generationIdRef.current = null;
+    if (generationId) {
+      cancelGeneration(generationId).catch((error) => {
+        console.error('停止生成失败:', error);
+      });
+    }
     if (abortController) {
       abortController.abort();
       setAbortController(null);
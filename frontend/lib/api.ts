@@ -127,11 +127,17 @@ export async function sendMessage(request: ChatRequest): Promise<ChatResponse> {
 }
 
 // 发送消息（流式）
-export async function* sendMessageStream(request: ChatRequest): AsyncGenerator<string> {
+// signal 中止时关闭连接；onGenerationId 收到本次生成的ID，用于停止生成（见 cancelGeneration）
+export async function* sendMessageStream(
+  request: ChatRequest,
+  signal?: AbortSignal,
+  onGenerationId?: (generationId: string) => void,
+): AsyncGenerator<string> {
   const response = await fetch(`${API_BASE_URL}/chat`, {
     method: 'POST',
     headers: getAuthHeaders(),
     body: JSON.stringify({ ...request, stream: true }),
+    signal,
   });
 
   if (!response.ok) {
@@ -141,6 +147,11 @@ export async function* sendMessageStream(request: ChatRequest): AsyncGenerator<s
     throw new Error('发送消息失败');
   }
 
+  const generationId = response.headers.get('X-Generation-Id');
+  if (generationId && onGenerationId) {
+    onGenerationId(generationId);
+  }
+
   const reader = response.body?.getReader();
   if (!reader) {
     throw new Error('无法读取响应流');
@@ -174,7 +185,7 @@ export async function* sendMessageStream(request: ChatRequest): AsyncGenerator<s
             throw new Error(parsed.error);
           }
 
-          if (parsed.done) {
+          if (parsed.done || parsed.cancelled) {
             return;
           }
 
@@ -190,6 +201,23 @@ export async function* sendMessageStream(request: ChatRequest): AsyncGenerator<s
   }
 }
 
+// 停止生成（立即关闭上游连接，已生成的部分以截断状态保存）
+// 只断开连接时服务端会继续生成一段时间等待重新连接，点击停止时需要调用此接口
+export async function cancelGeneration(generationId: string): Promise<void> {
+  const response = await fetch(`${API_BASE_URL}/chat/generations/${generationId}/cancel`, {
+    method: 'POST',
+    headers: getAuthHeaders(),
+  });
+
+  // 404（已过期）和 409（已结束）表示生成已经停止
+  if (!response.ok && response.status !== 404 && response.status !== 409) {
+    if (response.status === 401) {
+      throw new Error('未登录或登录已过期');
+    }
+    throw new Error('停止生成失败');
+  }
+}
+
 // 获取配置
 export async function getConfig(userId: string): Promise<ConfigResponse> {
   const response = await fetch(`${API_BASE_URL}/api/config?user_id=${userId}`, {